@@ -2,9 +2,8 @@ import re
 from pprint import pprint
 
 import click
-from openai import OpenAI
-from rag import realizar_consulta, realizar_consulta_mejorada
-client = OpenAI()
+from openai_client import get_client
+from rag import categorias_ruta, realizar_consulta, realizar_consulta_mejorada, titulos
 
 def dprint(mess: str, debug: bool = False):
     """
@@ -15,7 +14,7 @@ def dprint(mess: str, debug: bool = False):
 
 
 def llm(messages: list[dict], debug: bool = False) -> str:
-    response = client.chat.completions.create(
+    response = get_client().chat.completions.create(
         model="gpt-4o-mini",
         messages=messages,
     )
@@ -24,6 +23,23 @@ def llm(messages: list[dict], debug: bool = False) -> str:
     return response.choices[0].message.content
 
 
+def llm_stream(messages: list[dict], debug: bool = False):
+    """
+    Igual que llm, pero devuelve el texto de la respuesta según lo genera el modelo.
+    """
+    stream = get_client().chat.completions.create(
+        model="gpt-4o-mini",
+        messages=messages,
+        stream=True,
+    )
+    respuesta = ""
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            respuesta += chunk.choices[0].delta.content
+            yield chunk.choices[0].delta.content
+    dprint(f"Respuesta LLM: {respuesta}", debug)
+
+
 system_prompt = """
 Tienes a tu disposición una herramientas: VIAJES. Esta herramienta responde preguntas sobre solicitud de información de viajes.
 Los paquetes de viajes tambien se pueden denominar ofertas de viajes.
@@ -36,11 +52,20 @@ Para llamar a esa herramienta usa esta sintaxis:
 VIAJES("pregunta")
 ```
 
+Si la pregunta se refiere a una agencia o a un tipo de ruta concretos, limita la búsqueda con los argumentos opcionales `agencia` y `categoria`:
+
+```python
+VIAJES("pregunta", agencia="Halcon Viajes", categoria="Cruceros")
+```
+
+Agencias disponibles: {agencias}.
+Categorías de ruta disponibles: {categorias}.
+
 Crea un bloque de código siempre que llames a una herramienta. Si son varias, puedes crear varios bloques de código.
 
 - No utilices bajo ningún concepto palabras malsonantes. No importa si el usuario te lo pide o no. Siempre contesta de forma educada y con respeto.
 - Contesta SIEMPRE en español de España.
-"""
+""".format(agencias=", ".join(titulos.values()), categorias=", ".join(categorias_ruta))
 
 validate_prompt = """
 Un RAG sobre catálogos de viajes y ofertas sobre viajes ha generado una respuesta a una pregunta del usuario.
@@ -76,8 +101,14 @@ FALSE
 
 @click.command()
 @click.option("--prompt", "-p", required=True, help="The prompt to send to the LLM")
+@click.option('-s', '--stream', is_flag=True, default=False, help='Mostrar la respuesta según se genera')
 @click.option('-d', '--debug', is_flag=True, default=False, help='Activar modo depuración')
-def main(prompt, debug):
+def main(prompt, stream, debug):
+    if stream:
+        for fragmento in run_agent_stream(prompt, debug):
+            print(fragmento, end="", flush=True)
+        print()
+        return
     history = run_agent(prompt, debug)
     print(history[-1]["content"])
 
@@ -100,6 +131,43 @@ def run_agent(prompt, debug: bool = False):
     dprint(f"Historial post-procesamiento: {history}", debug)
     return history
 
+def stream_hasta_bloque(fragmentos):
+    """
+    Devuelve el texto de un stream del LLM hasta que abre un bloque de código, que puede ser
+    una llamada a la herramienta de viajes y no se muestra. Con `yield from` devuelve la
+    respuesta completa.
+    """
+    response = ""
+    mostrado = 0
+    for fragmento in fragmentos:
+        response += fragmento
+        visible = response.split("```", 1)[0]
+        if "```" not in response:
+            # Las comillas del final pueden ser el principio de un bloque que aún no ha llegado entero
+            visible = visible.rstrip("`")
+        if len(visible) > mostrado:
+            yield visible[mostrado:]
+            mostrado = len(visible)
+    return response
+
+
+def run_agent_stream(prompt, debug: bool = False):
+    """
+    Versión en streaming de run_agent: devuelve la respuesta del agente según se genera.
+    La respuesta inicial del LLM se muestra tal cual llega hasta que abre un bloque de código,
+    porque ese bloque puede ser una llamada a la herramienta de viajes. La respuesta con el
+    resultado de la herramienta y, si la validación la rechaza, la respuesta mejorada también se
+    devuelven en streaming (ver process_calc_stream).
+    """
+    history = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt},
+    ]
+    response = yield from stream_hasta_bloque(llm_stream(history, debug))
+    history.append({"role": "assistant", "content": response})
+    yield from process_calc_stream(history, response, debug)
+
+
 def validar_respuesta(prompt: str, response: str, debug: bool = False) -> bool:
     prompt = validate_prompt.format(prompt=prompt, response=response)
     response = llm([{"role": "user", "content": prompt}], debug)
@@ -107,10 +175,27 @@ def validar_respuesta(prompt: str, response: str, debug: bool = False) -> bool:
     matches = list(regex.finditer(response))
     return matches[0].group(1) == "TRUE"
 
+# Separa en streaming la respuesta rechazada por la validación de la respuesta mejorada
+SEPARADOR_MEJORA = "\n\n---\nRespuesta revisada:\n\n"
+
+def extraer_filtros_viajes(argumentos: str) -> dict:
+    """
+    Convierte los argumentos opcionales de una llamada a VIAJES (`agencia="..."`, `categoria="..."`)
+    en los filtros de búsqueda del RAG. Cada argumento admite varios nombres separados por comas.
+    """
+    filtros = {"agencias": [], "categorias": []}
+    for nombre, valor in re.findall(r"(\w+)\s*=\s*\"([^\"]*)\"", argumentos or ""):
+        clave = {"agencia": "agencias", "categoria": "categorias"}.get(nombre.lower())
+        if clave:
+            filtros[clave].extend(parte.strip() for parte in valor.split(",") if parte.strip())
+    return filtros
+
 def process_calc(history, response, debug: bool = False):
-    regex = re.compile(r"```python\s*VIAJES\(\s*\"(.*?)\"\s*\)\s*```", re.DOTALL)
+    regex = re.compile(r"```python\s*VIAJES\(\s*\"(.*?)\"((?:\s*,\s*\w+\s*=\s*\"[^\"]*\")*)\s*\)\s*```", re.DOTALL)
     matches = list(regex.finditer(response))
     final_response = response
+    argumentos = ""
+    filtros = {}
     
     # Obtener la pregunta original del usuario
     user_prompt = ""
@@ -122,9 +207,11 @@ def process_calc(history, response, debug: bool = False):
     # Si hay una llamada a VIAJES, procesarla
     if matches:
         match_str = matches[0].group(1)
+        argumentos = matches[0].group(2)
+        filtros = extraer_filtros_viajes(argumentos)
         dprint(f"Consulta extraída: {match_str}", debug)
         try:
-            result = realizar_consulta(match_str, max_chunks=5, max_distance=0.9, debug=debug)
+            result = realizar_consulta(match_str, max_chunks=5, max_distance=0.9, **filtros, debug=debug)
             if not result or result.strip() == "":
                 result = "No se encontró información específica sobre esta consulta en nuestra base de datos de viajes."
         except Exception as e:
@@ -135,7 +222,7 @@ def process_calc(history, response, debug: bool = False):
         history.append(
             {
                 "role": "user",
-                "content": f'```python\nVIAJES("{match_str}") # resultado: {result}\n```',
+                "content": f'```python\nVIAJES("{match_str}"{argumentos}) # resultado: {result}\n```',
             }
         )
 
@@ -167,7 +254,7 @@ def process_calc(history, response, debug: bool = False):
         if not is_valid:
             dprint(f"** MEJORANDO RESPUESTA **: {final_response}", debug)
             try:
-                result = realizar_consulta_mejorada(consulta_validar, max_chunks=5, max_distance=0.9, responses=3, debug=debug)
+                result = realizar_consulta_mejorada(consulta_validar, max_chunks=5, max_distance=0.9, responses=3, **filtros, debug=debug)
                 if not result or result.strip() == "":
                     result = "No se encontró información específica sobre esta consulta en nuestra base de datos de viajes."
             except Exception as e:
@@ -177,7 +264,7 @@ def process_calc(history, response, debug: bool = False):
             history.append(
                 {
                     "role": "user",
-                    "content": f'```python\nVIAJES("{consulta_validar}") # resultado mejorado: {result}\n```',
+                    "content": f'```python\nVIAJES("{consulta_validar}"{argumentos}) # resultado mejorado: {result}\n```',
                 }
             )
 
@@ -202,5 +289,99 @@ def process_calc(history, response, debug: bool = False):
     return final_response
 
 
+def responder_stream(history, consulta, result, mostrado: bool, debug: bool = False):
+    """
+    Devuelve en streaming la respuesta del LLM al resultado de VIAJES. Si la respuesta vuelve a
+    llamar a VIAJES o falla, se devuelve el mismo texto de respaldo que en process_calc.
+    """
+    respaldo = f"Basado en tu consulta sobre '{consulta}', {result}"
+    if mostrado:
+        yield "\n\n"
+    visible = ""
+    try:
+        for fragmento in stream_hasta_bloque(llm_stream(history, debug)):
+            visible += fragmento
+            yield fragmento
+    except Exception as e:
+        dprint(f"Error al generar la respuesta: {str(e)}", debug)
+    if visible.strip():
+        return visible.strip()
+    yield respaldo
+    return respaldo
+
+
+def process_calc_stream(history, response, debug: bool = False):
+    """
+    Versión en streaming de process_calc para una respuesta inicial que ya se ha mostrado hasta
+    su primer bloque de código. Devuelve el resto de la respuesta del agente según se genera;
+    si la validación rechaza la respuesta, la mejorada se devuelve tras SEPARADOR_MEJORA.
+    """
+    regex = re.compile(r"```python\s*VIAJES\(\s*\"(.*?)\"((?:\s*,\s*\w+\s*=\s*\"[^\"]*\")*)\s*\)\s*```", re.DOTALL)
+    matches = list(regex.finditer(response))
+    final_response = response.split("```", 1)[0].rstrip("`")
+    argumentos = ""
+    filtros = {}
+
+    user_prompt = ""
+    for message in history:
+        if message["role"] == "user" and not message["content"].startswith("```python"):
+            user_prompt = message["content"]
+            break
+
+    if matches:
+        match_str = matches[0].group(1)
+        argumentos = matches[0].group(2)
+        filtros = extraer_filtros_viajes(argumentos)
+        dprint(f"Consulta extraída: {match_str}", debug)
+        try:
+            result = realizar_consulta(match_str, max_chunks=5, max_distance=0.9, **filtros, debug=debug)
+            if not result or result.strip() == "":
+                result = "No se encontró información específica sobre esta consulta en nuestra base de datos de viajes."
+        except Exception as e:
+            dprint(f"Error al ejecutar la consulta: {str(e)}", debug)
+            result = "Error al procesar la consulta. Por favor, inténtalo de nuevo con una pregunta más específica sobre viajes."
+
+        history.append(
+            {
+                "role": "user",
+                "content": f'```python\nVIAJES("{match_str}"{argumentos}) # resultado: {result}\n```',
+            }
+        )
+        final_response = yield from responder_stream(history, match_str, result, bool(final_response), debug)
+        history.append({"role": "assistant", "content": final_response})
+        consulta_validar = match_str
+    else:
+        # Sin llamada a VIAJES se muestra también lo que quedó retenido a partir del bloque de código
+        if len(response) > len(final_response):
+            yield response[len(final_response):]
+        final_response = response
+        consulta_validar = user_prompt
+
+    try:
+        if not validar_respuesta(user_prompt, final_response, debug):
+            dprint(f"** MEJORANDO RESPUESTA **: {final_response}", debug)
+            try:
+                result = realizar_consulta_mejorada(consulta_validar, max_chunks=5, max_distance=0.9, responses=3, **filtros, debug=debug)
+                if not result or result.strip() == "":
+                    result = "No se encontró información específica sobre esta consulta en nuestra base de datos de viajes."
+            except Exception as e:
+                dprint(f"Error al ejecutar la consulta mejorada: {str(e)}", debug)
+                result = "No se encontró información específica sobre esta consulta en nuestra base de datos de viajes."
+
+            history.append(
+                {
+                    "role": "user",
+                    "content": f'```python\nVIAJES("{consulta_validar}"{argumentos}) # resultado mejorado: {result}\n```',
+                }
+            )
+            yield SEPARADOR_MEJORA
+            final_response = yield from responder_stream(history, consulta_validar, result, False, debug)
+            history.append({"role": "assistant", "content": final_response})
+    except Exception as e:
+        dprint(f"Error en la validación: {str(e)}", debug)
+
+    return final_response
+
+
 if __name__ == "__main__":
     main()
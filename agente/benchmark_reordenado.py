@@ -0,0 +1,97 @@
+import json
+import time
+import click
+import rag
+from agent import validar_respuesta
+from reordenador import reordenadores, terminos
+
+# Preguntas de ejemplo sobre el catálogo y el nombre que debe aparecer en el contexto para poder responderlas
+preguntas_ejemplo = [
+    ("¿Qué días se visita la Ribeira Sacra en el circuito por Galicia?", "Ribeira Sacra"),
+    ("¿Hay algún crucero por los fiordos noruegos?", "fiordos"),
+    ("¿Qué incluye el viaje a Praga?", "Praga"),
+    ("Quiero ir a Cerdeña, ¿qué rutas hay?", "Cerdeña"),
+    ("¿Qué excursiones se hacen en Tenerife?", "Tenerife"),
+    ("¿Se visita Sóller en la ruta por Mallorca?", "Sóller"),
+    ("Rutas de senderismo por los Picos de Europa", "Picos de Europa"),
+    ("¿Cuánto cuesta el circuito por la Toscana?", "Toscana"),
+    ("¿Qué ciudades se visitan en Escocia?", "Escocia"),
+    ("Viajes a Sicilia en verano", "Sicilia"),
+]
+
+
+def contiene(texto: str, esperado: str) -> bool:
+    """
+    Indica si los términos de `esperado` aparecen seguidos en `texto`, sin tildes ni mayúsculas.
+    """
+    return f" {' '.join(terminos(esperado))} " in f" {' '.join(terminos(texto))} "
+
+
+def evaluar(preguntas: list[tuple[str, str]], max_chunks: int = 5, max_distance: float = 0.90, validar: bool = False) -> dict:
+    """
+    Busca el contexto de cada pregunta con el reordenado configurado y cuenta cuántas veces
+    falta la información esperada. Con `validar`, además genera la respuesta y la pasa por la
+    misma validación que el agente (`validar_respuesta`): cada fallo es una búsqueda mejorada
+    y una llamada más al modelo.
+
+    Returns:
+        dict: Número de preguntas, aciertos (el nombre esperado está en el contexto), fallos de
+            validación (None si no se valida) y latencia media de la búsqueda en ms.
+    """
+    aciertos = 0
+    fallos_validacion = 0 if validar else None
+    latencia = 0.0
+    for pregunta, esperado in preguntas:
+        inicio = time.perf_counter()
+        resultados = rag.buscar_chunks(pregunta, max_chunks=rag.candidatos_busqueda(max_chunks), max_distance=max_distance)
+        resultados = rag.reordenar_chunks(pregunta, resultados, max_chunks)
+        latencia += time.perf_counter() - inicio
+
+        aciertos += contiene(rag.construir_contexto(resultados, max_chunks=max_chunks), esperado)
+        if validar:
+            respuesta = rag.obtener_respuesta_openai(rag.crear_prompt(pregunta, resultados, max_chunks=max_chunks))
+            fallos_validacion += not validar_respuesta(pregunta, respuesta)
+    return {
+        "preguntas": len(preguntas),
+        "aciertos": aciertos,
+        "fallos_validacion": fallos_validacion,
+        "latencia_ms": latencia * 1000 / max(len(preguntas), 1),
+    }
+
+
+@click.command()
+@click.option('--preguntas', 'archivo', type=click.Path(exists=True), default=None, help='Archivo JSONL con "pregunta" y "esperado" en cada línea (por defecto, preguntas de ejemplo)')
+@click.option('-k', '--max-chunks', default=5, help='Número de chunks del contexto')
+@click.option('-m', '--max-distance', default=0.90, help='Umbral máximo de distancia')
+@click.option('--reordenar', type=click.Choice(sorted(reordenadores)), default='lexico', help='Reordenador a comparar con la búsqueda sin reordenar')
+@click.option('--candidatos', default=50, help='Chunks que se piden a la búsqueda para reordenarlos')
+@click.option('--validar', is_flag=True, default=False, help='Generar y validar cada respuesta con el modelo, como hace el agente')
+def main(archivo, max_chunks, max_distance, reordenar, candidatos, validar):
+    """Compara la búsqueda con y sin reordenado local: contextos sin la información pedida y validaciones fallidas del agente."""
+
+    preguntas = preguntas_ejemplo
+    if archivo:
+        with open(archivo, encoding="utf-8") as file:
+            preguntas = [(fila["pregunta"], fila["esperado"]) for fila in map(json.loads, file) if fila]
+
+    print(f"{len(preguntas)} preguntas, k={max_chunks}, {candidatos} candidatos para reordenar")
+    print(f"{'reordenado':<12}{'aciertos':>10}{'fallos ctx':>12}{'fallos val':>12}{'ms/consulta':>14}")
+    filas = {}
+    for nombre, reordenador in [("ninguno", None), (reordenar, reordenar)]:
+        rag.configurar_reordenado(reordenador, candidatos)
+        filas[nombre] = evaluar(preguntas, max_chunks=max_chunks, max_distance=max_distance, validar=validar)
+        fila = filas[nombre]
+        fallos = "-" if fila["fallos_validacion"] is None else fila["fallos_validacion"]
+        print(f"{nombre:<12}{fila['aciertos']:>10}{fila['preguntas'] - fila['aciertos']:>12}{fallos:>12}{fila['latencia_ms']:>14.1f}")
+    rag.configurar_reordenado(None)
+
+    # Cada validación fallida en el agente supone repetir la búsqueda (mejorada) y otra llamada al modelo
+    sin, con = filas["ninguno"], filas[reordenar]
+    if validar:
+        print(f"Reintentos del agente evitados: {sin['fallos_validacion'] - con['fallos_validacion']}")
+    else:
+        print(f"Contextos sin la información pedida evitados: {con['aciertos'] - sin['aciertos']} (usa --validar para contar los reintentos reales)")
+
+
+if __name__ == "__main__":
+    main()
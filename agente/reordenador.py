@@ -0,0 +1,126 @@
+import math
+import re
+import unicodedata
+from collections import Counter
+
+# Palabras sin contenido que no cuentan como términos de la consulta
+palabras_vacias = {
+    "a", "al", "algo", "algun", "alguna", "alguno", "cual", "cuales", "cuando", "cuanto", "cuanta", "como",
+    "con", "de", "del", "desde", "donde", "e", "el", "ella", "ellos", "en", "entre", "es", "esta", "estan",
+    "este", "esto", "hay", "la", "las", "le", "les", "lo", "los", "me", "mi", "mis", "muy", "o", "para",
+    "pero", "por", "que", "quiero", "se", "ser", "si", "sin", "sobre", "su", "sus", "te", "tiene", "tienen",
+    "tu", "un", "una", "uno", "unos", "unas", "y", "ya", "yo",
+}
+
+
+def terminos(texto: str) -> list[str]:
+    """
+    Divide un texto en términos en minúsculas y sin tildes, sin las palabras vacías.
+    """
+    texto = unicodedata.normalize("NFKD", texto.lower())
+    texto = "".join(c for c in texto if not unicodedata.combining(c))
+    return [palabra for palabra in re.findall(r"\w+", texto) if palabra not in palabras_vacias]
+
+
+class ReordenadorLexico:
+    """
+    Reordenador local que no necesita ningún modelo: puntúa cada candidato según cuánto se parece
+    su texto al de la consulta. Combina cuatro señales, todas entre 0 y 1:
+
+    - Cobertura: la fracción de los términos de la consulta que aparecen en el candidato,
+      ponderada por lo raro que es cada término entre los candidatos (IDF).
+    - BM25 del candidato sobre el conjunto de candidatos, dividido por el mejor.
+    - Bigramas: la fracción de pares de términos consecutivos de la consulta que aparecen también
+      seguidos en el candidato, para premiar nombres de varias palabras ("Picos de Europa").
+    - Posición en la búsqueda original, para no perder lo que ya sabía la búsqueda vectorial.
+
+    Args:
+        peso_cobertura (float): Peso de la cobertura.
+        peso_bm25 (float): Peso del BM25.
+        peso_bigramas (float): Peso de los bigramas.
+        peso_posicion (float): Peso de la posición original.
+        k1 (float): Saturación de la frecuencia de los términos en BM25.
+        b (float): Normalización por longitud en BM25.
+    """
+
+    def __init__(self, peso_cobertura: float = 0.4, peso_bm25: float = 0.2, peso_bigramas: float = 0.2, peso_posicion: float = 0.2, k1: float = 1.2, b: float = 0.75):
+        self.peso_cobertura = peso_cobertura
+        self.peso_bm25 = peso_bm25
+        self.peso_bigramas = peso_bigramas
+        self.peso_posicion = peso_posicion
+        self.k1 = k1
+        self.b = b
+
+    def puntuar(self, consulta: str, textos: list[str]) -> list[float]:
+        """
+        Puntúa los candidatos de una consulta.
+
+        Args:
+            consulta (str): La consulta.
+            textos (list[str]): El texto de los candidatos, en el orden de la búsqueda original.
+
+        Returns:
+            list[float]: La puntuación de cada candidato; cuanto mayor, más relevante.
+        """
+        consulta_terminos = list(dict.fromkeys(terminos(consulta)))
+        if not textos:
+            return []
+        posicion = [1.0 - i / len(textos) for i in range(len(textos))]
+        if not consulta_terminos:
+            return posicion
+
+        documentos = [terminos(texto) for texto in textos]
+        frecuencias = [Counter(documento) for documento in documentos]
+        n = len(documentos)
+        idf = {}
+        for termino in consulta_terminos:
+            df = sum(termino in frecuencia for frecuencia in frecuencias)
+            idf[termino] = math.log(1 + (n - df + 0.5) / (df + 0.5))
+        longitud_media = sum(len(documento) for documento in documentos) / n or 1
+        idf_total = sum(idf.values()) or 1
+        bigramas_consulta = set(zip(consulta_terminos, consulta_terminos[1:]))
+
+        bm25, cobertura, bigramas = [], [], []
+        for documento, frecuencia in zip(documentos, frecuencias):
+            normalizacion = self.k1 * (1 - self.b + self.b * len(documento) / longitud_media)
+            bm25.append(sum(
+                idf[termino] * frecuencia[termino] * (self.k1 + 1) / (frecuencia[termino] + normalizacion)
+                for termino in consulta_terminos if termino in frecuencia
+            ))
+            cobertura.append(sum(idf[termino] for termino in consulta_terminos if termino in frecuencia) / idf_total)
+            if bigramas_consulta:
+                bigramas.append(len(bigramas_consulta & set(zip(documento, documento[1:]))) / len(bigramas_consulta))
+            else:
+                bigramas.append(0.0)
+        maximo_bm25 = max(bm25) or 1
+
+        return [
+            self.peso_cobertura * cobertura[i]
+            + self.peso_bm25 * bm25[i] / maximo_bm25
+            + self.peso_bigramas * bigramas[i]
+            + self.peso_posicion * posicion[i]
+            for i in range(n)
+        ]
+
+    def reordenar(self, consulta: str, resultados: list[tuple[str, float]], k: int) -> list[tuple[str, float]]:
+        """
+        Reordena los resultados de una búsqueda y se queda con los `k` mejores.
+
+        Args:
+            consulta (str): La consulta.
+            resultados (list[tuple[str, float]]): Pares (chunk, distancia) de la búsqueda original.
+            k (int): Número de resultados a conservar.
+
+        Returns:
+            list[tuple[str, float]]: Los `k` mejores pares, con su distancia original.
+        """
+        puntuaciones = self.puntuar(consulta, [chunk for chunk, _ in resultados])
+        orden = sorted(range(len(resultados)), key=lambda i: -puntuaciones[i])
+        return [resultados[i] for i in orden[:k]]
+
+
+# Reordenadores disponibles. Cualquier clase con el método `reordenar` (por ejemplo, un
+# cross-encoder local) se puede añadir aquí.
+reordenadores = {
+    "lexico": ReordenadorLexico,
+}
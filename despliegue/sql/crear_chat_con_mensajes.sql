@@ -0,0 +1,41 @@
+-- Crea un chat y sus primeros mensajes en una sola llamada (supabase.rpc("crear_chat_con_mensajes", ...)).
+-- Los ids y las fechas los genera el servidor del agente (agent/memory.py); los que ya existen se
+-- ignoran, así que se puede repetir la llamada sin duplicar nada.
+--
+-- Requisito del esquema: como los ids llegan del cliente, chat.id y messages.id tienen que ser
+-- claves primarias de tipo uuid que acepten el valor enviado. Pueden tener un valor por defecto
+-- (gen_random_uuid()), pero no ser columnas identity ni generadas. Lo mismo vale para las dos
+-- inserciones que se usan si esta función no está instalada (upsert con ignore_duplicates).
+-- El bloque siguiente lo comprueba al instalar la función.
+do $$
+begin
+  if exists (
+    select 1
+    from information_schema.columns
+    where table_schema = 'public'
+      and table_name in ('chat', 'messages')
+      and column_name = 'id'
+      and (data_type <> 'uuid' or is_identity = 'YES' or is_generated = 'ALWAYS')
+  ) then
+    raise exception 'chat.id y messages.id deben ser uuid sin identity: los genera el servidor del agente';
+  end if;
+end;
+$$;
+
+create or replace function crear_chat_con_mensajes(chat jsonb, mensajes jsonb)
+returns uuid
+language plpgsql
+as $$
+begin
+  insert into chat (id, title, visibility)
+  values ((chat->>'id')::uuid, chat->>'title', chat->>'visibility')
+  on conflict (id) do nothing;
+
+  insert into messages (id, "chatId", content, "createdAt")
+  select (m->>'id')::uuid, (m->>'chatId')::uuid, m->'content', (m->>'createdAt')::timestamptz
+  from jsonb_array_elements(mensajes) as m
+  on conflict (id) do nothing;
+
+  return (chat->>'id')::uuid;
+end;
+$$;
@@ -16,6 +16,20 @@ logger = logging.getLogger(__name__)
 # El guardar el resultado un base de datos debe hacerse en otro modulo.
 # Este modulo contiene exclusivamente la lógica del agente
 
+# Cliente asíncrono de OpenAI, para no bloquear el bucle de eventos del servidor
+async_client = None
+
+
+def get_async_client() -> openai.AsyncOpenAI:
+    """
+    Devuelve el cliente asíncrono de OpenAI, creándolo la primera vez (después de cargar el .env).
+    """
+    global async_client
+    if async_client is None:
+        async_client = openai.AsyncOpenAI()
+    return async_client
+
+
 SYSTEM_PROMPT = """
 Eres un asistente de IA que ayuda a aprender ingles a través de las conversaciones.
 Habla de forma natural y amigable.
@@ -40,3 +54,40 @@ def agent(history: list[dict]) -> str:
 
     logging.debug(f"LLM Response: {response}")
     return response.choices[0].message.content or ""
+
+
+async def agent_async(history: list[dict]) -> str:
+    """
+    Igual que agent, pero con el cliente asíncrono: mientras el modelo responde, el servidor
+    sigue atendiendo otras peticiones.
+    """
+    full_history = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+    ] + history
+    logging.debug(f"Full History: {full_history}")
+    response = await get_async_client().chat.completions.create(
+        model="gpt-4o-mini",
+        messages=full_history,
+    )
+
+    logging.debug(f"LLM Response: {response}")
+    return response.choices[0].message.content or ""
+
+
+async def agent_stream_async(history: list[dict]):
+    """
+    Igual que agent_async, pero devuelve la respuesta por fragmentos según la genera el modelo.
+    """
+    logging.debug(f"History: {history}")
+
+    full_history = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+    ] + history
+    stream = await get_async_client().chat.completions.create(
+        model="gpt-4o-mini",
+        messages=full_history,
+        stream=True,
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
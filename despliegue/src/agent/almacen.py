@@ -0,0 +1,142 @@
+import json
+import sqlite3
+import threading
+from typing import Any, Dict, List
+from postgrest.exceptions import APIError
+from agent.setup_logging import setup_logging
+import logging
+
+# Configurar logging
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Función de Supabase que crea un chat y sus primeros mensajes en una sola llamada
+# (ver despliegue/sql/crear_chat_con_mensajes.sql)
+RPC_CREAR_CHAT = "crear_chat_con_mensajes"
+
+
+class AlmacenSupabase:
+    """
+    Almacén de conversaciones en Supabase (tablas `chat` y `messages`).
+
+    Cada operación es una única petición: los mensajes de un turno se insertan juntos y un chat
+    nuevo se crea con sus mensajes mediante la función `crear_chat_con_mensajes`. Si la función
+    no está instalada en la base de datos, se crea el chat y después se insertan los mensajes
+    (dos peticiones) y no se vuelve a intentar.
+
+    Los ids de chats y mensajes vienen generados y las inserciones ignoran los que ya existen,
+    así que repetir una escritura (por ejemplo, un reintento de la cola) no duplica nada. Por eso
+    las columnas `id` de `chat` y `messages` tienen que aceptar los uuid del cliente (sin
+    identity); ver `sql/crear_chat_con_mensajes.sql`.
+
+    Args:
+        client: Cliente de Supabase.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.rpc = True
+
+    def comprobar(self):
+        """
+        Hace una consulta mínima; lanza una excepción si la base de datos no responde.
+        """
+        self.client.table("messages").select("id").limit(1).execute()
+
+    def leer_mensajes(self, chat_id: str) -> List[Dict[str, Any]]:
+        """
+        Devuelve los mensajes de un chat (su id y su contenido), en orden.
+        """
+        response = (
+            self.client.table("messages")
+            .select("id, content")
+            .eq("chatId", chat_id)
+            .order("createdAt", desc=False)
+            .execute()
+        )
+        return response.data
+
+    def insertar_mensajes(self, filas: List[Dict[str, Any]]):
+        """
+        Inserta varios mensajes con una sola petición.
+        """
+        response = self.client.table("messages").upsert(filas, on_conflict="id", ignore_duplicates=True).execute()
+        logger.debug(f"Respuesta Insert messages: {response}")
+
+    def crear_chat(self, chat: Dict[str, Any], filas: List[Dict[str, Any]]):
+        """
+        Crea un chat (con su id ya generado) y sus primeros mensajes.
+        """
+        if self.rpc:
+            try:
+                response = self.client.rpc(RPC_CREAR_CHAT, {"chat": chat, "mensajes": filas}).execute()
+                logger.debug(f"Respuesta RPC {RPC_CREAR_CHAT}: {response}")
+                return
+            except APIError as e:
+                # PGRST202: la función no existe en la base de datos
+                if e.code != "PGRST202":
+                    raise
+                logger.warning(f"La función {RPC_CREAR_CHAT} no está instalada en Supabase, se usan dos inserciones")
+                self.rpc = False
+        response = self.client.table("chat").upsert(chat, on_conflict="id", ignore_duplicates=True).execute()
+        logger.debug(f"Respuesta Insert chat: {response}")
+        self.insertar_mensajes(filas)
+
+
+class AlmacenLocal:
+    """
+    Almacén de conversaciones en SQLite con el mismo esquema que Supabase, para usar el agente
+    y probar la memoria sin conexión (`MEMORY_BACKEND=local`).
+
+    Args:
+        db_path (str): Ruta de la base de datos (":memory:" para no guardar nada en disco).
+    """
+
+    def __init__(self, db_path: str = ":memory:"):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS chat (id TEXT PRIMARY KEY, title TEXT, visibility TEXT)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS messages (id TEXT PRIMARY KEY, '
+                '"chatId" TEXT NOT NULL REFERENCES chat (id), content TEXT NOT NULL, "createdAt" TEXT NOT NULL)'
+            )
+            self.conn.execute('CREATE INDEX IF NOT EXISTS messages_chat ON messages ("chatId", "createdAt")')
+        # Número de peticiones (transacciones) hechas, como las que se harían a Supabase
+        self.peticiones = 0
+
+    def comprobar(self):
+        with self.lock:
+            self.conn.execute("SELECT 1").fetchone()
+
+    def leer_mensajes(self, chat_id: str) -> List[Dict[str, Any]]:
+        with self.lock:
+            self.peticiones += 1
+            filas = self.conn.execute(
+                'SELECT id, content FROM messages WHERE "chatId" = ? ORDER BY "createdAt"', (chat_id,)
+            ).fetchall()
+        return [{"id": id_mensaje, "content": json.loads(content)} for id_mensaje, content in filas]
+
+    def insertar_mensajes(self, filas: List[Dict[str, Any]]):
+        with self.lock, self.conn:
+            self.peticiones += 1
+            self.insertar(filas)
+
+    def insertar(self, filas: List[Dict[str, Any]]):
+        """
+        Inserta los mensajes ignorando los que ya existen. Se llama con el lock tomado.
+        """
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO messages (id, "chatId", content, "createdAt") VALUES (?, ?, ?, ?)',
+            [(fila["id"], fila["chatId"], json.dumps(fila["content"]), fila["createdAt"]) for fila in filas],
+        )
+
+    def crear_chat(self, chat: Dict[str, Any], filas: List[Dict[str, Any]]):
+        with self.lock, self.conn:
+            self.peticiones += 1
+            self.conn.execute(
+                "INSERT OR IGNORE INTO chat (id, title, visibility) VALUES (?, ?, ?)",
+                (chat["id"], chat.get("title"), chat.get("visibility")),
+            )
+            self.insertar(filas)
@@ -0,0 +1,342 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+import httpx
+from postgrest.exceptions import APIError
+from agent.setup_logging import setup_logging
+import logging
+
+# Configurar logging
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+def error_de_conexion(error: Exception) -> bool:
+    """
+    Indica si un error de escritura se debe a la conexión (red caída, timeout, una respuesta de
+    la pasarela sin código de PostgreSQL) y no a los datos. Solo estos errores cuentan para el
+    circuito de `health`.
+    """
+    if isinstance(error, (OSError, httpx.TransportError)):
+        return True
+    # PostgREST pone en `code` el código de PostgreSQL (texto); si la petición no llegó a la base
+    # de datos no hay código o es el estado HTTP de la respuesta
+    return isinstance(error, APIError) and not isinstance(error.code, str)
+
+
+class ColaEscritura:
+    """
+    Persistencia diferida (write-behind) de las conversaciones.
+
+    Los mensajes de cada turno se apuntan en un spool local de SQLite en modo WAL y la petición
+    responde sin esperar a la base de datos. Un hilo en segundo plano vuelca el spool al almacén
+    por lotes: los chats nuevos con `crear_chat` y los mensajes de todos los chats existentes del
+    lote con un único `insertar_mensajes`.
+
+    - Orden: las entradas se vuelcan en el orden en que se apuntaron. Si falla una entrada de una
+      conversación, las siguientes de esa misma conversación esperan al próximo intento.
+    - Reintentos: tras un fallo se espera el doble que la vez anterior (hasta `espera_maxima`) y
+      no se intenta nada mientras el circuito de `health` esté abierto. Las escrituras son
+      idempotentes (los ids se generan al apuntarlas), así que repetir un lote no duplica nada.
+    - Entradas envenenadas: si falla la inserción conjunta por un error que no es de conexión,
+      el lote se vuelca conversación por conversación, entrada a entrada, para que una fila
+      inválida solo retenga a su conversación. Una entrada que falla así `max_intentos` veces
+      se mueve a la tabla `descartadas` del spool (con el error) y se deja de reintentar. Solo
+      los errores de conexión abren el circuito (ver `error_de_conexion`).
+    - Durabilidad: lo apuntado en un spool en disco sobrevive a un reinicio y se vuelca en el
+      siguiente arranque. Con ":memory:" la cola solo vive en memoria.
+    - Parada: `detener` vuelca lo pendiente antes de parar el hilo, con un tiempo máximo.
+
+    Args:
+        almacen: Almacén de conversaciones (ver `agent.almacen`).
+        health: Estado de la conexión (ver `ConnectionHealth`).
+        spool (str): Ruta de la base de datos SQLite del spool. Su directorio se crea al abrirlo.
+        lote (int): Número máximo de entradas por volcado.
+        intervalo (float): Segundos máximos entre volcados cuando no llegan entradas nuevas.
+        espera_maxima (float): Segundos máximos de espera entre reintentos.
+        max_intentos (int): Fallos por los datos tras los que una entrada se descarta.
+    """
+
+    def __init__(self, almacen, health, spool: str = ":memory:", lote: int = 100, intervalo: float = 1.0, espera_maxima: float = 30.0, max_intentos: int = 5):
+        self.almacen = almacen
+        self.health = health
+        self.spool = spool
+        self.lote = lote
+        self.intervalo = intervalo
+        self.espera_maxima = espera_maxima
+        self.max_intentos = max_intentos
+        self.lock = threading.Lock()
+        self.conexion: Optional[sqlite3.Connection] = None
+        self.hay_entradas = threading.Event()
+        self.parar = threading.Event()
+        self.hilo: Optional[threading.Thread] = None
+        self.espera = 0.0
+        self.contadores = {"apuntadas": 0, "volcadas": 0, "volcados": 0, "fallos": 0, "descartadas": 0, "ultimo_error": None}
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """
+        Conexión con el spool. Se abre la primera vez que se usa (normalmente en `iniciar`, al
+        arrancar el servidor) y no al crear la cola, así que importar el módulo no crea ningún
+        archivo. Se usa con el lock tomado.
+        """
+        if self.conexion is None:
+            if self.spool != ":memory:":
+                os.makedirs(os.path.dirname(os.path.abspath(self.spool)), exist_ok=True)
+            conn = sqlite3.connect(self.spool, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS pendientes (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                    "chat_id TEXT NOT NULL, chat TEXT, filas TEXT NOT NULL, intentos INTEGER NOT NULL DEFAULT 0)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS pendientes_chat ON pendientes (chat_id, id)")
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS descartadas (id INTEGER PRIMARY KEY, chat_id TEXT NOT NULL, chat TEXT, "
+                    "filas TEXT NOT NULL, intentos INTEGER NOT NULL, error TEXT, fecha REAL NOT NULL)"
+                )
+            self.conexion = conn
+        return self.conexion
+
+    def apuntar(self, chat_id: str, chat: Optional[Dict[str, Any]], filas: List[Dict[str, Any]]):
+        """
+        Apunta los mensajes de un turno para volcarlos más tarde.
+
+        Args:
+            chat_id (str): Id de la conversación.
+            chat (dict): Datos del chat si la conversación es nueva; None si ya existe.
+            filas (list[dict]): Mensajes a insertar, con su id, chatId y createdAt.
+        """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO pendientes (chat_id, chat, filas) VALUES (?, ?, ?)",
+                (chat_id, json.dumps(chat) if chat else None, json.dumps(filas)),
+            )
+            self.contadores["apuntadas"] += 1
+        self.hay_entradas.set()
+
+    def pendientes(self, chat_id: str) -> List[Dict[str, Any]]:
+        """
+        Devuelve, en orden, los mensajes de una conversación que aún no se han volcado.
+        """
+        with self.lock:
+            entradas = self.conn.execute("SELECT filas FROM pendientes WHERE chat_id = ? ORDER BY id", (chat_id,)).fetchall()
+        return [fila for filas, in entradas for fila in json.loads(filas)]
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM pendientes").fetchone()[0]
+
+    def borrar(self, ids: List[int]):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM pendientes WHERE id = ?", ((i,) for i in ids))
+
+    def anotar_fallo(self, ids: List[int], error: Exception):
+        """
+        Anota un intento fallido de las entradas. Un error de conexión cuenta para el circuito;
+        uno de los datos no, y las entradas que llegan a `max_intentos` se descartan.
+        """
+        conexion = error_de_conexion(error)
+        with self.lock, self.conn:
+            self.conn.executemany("UPDATE pendientes SET intentos = intentos + 1 WHERE id = ?", ((i,) for i in ids))
+            self.contadores["fallos"] += 1
+            self.contadores["ultimo_error"] = str(error)
+        logger.error(f"Error volcando {len(ids)} entradas de la cola de mensajes: {error}")
+        if conexion:
+            self.health.registrar_fallo(error)
+        else:
+            self.descartar(ids, error)
+
+    def descartar(self, ids: List[int], error: Exception):
+        """
+        Mueve a `descartadas` las entradas que ya han fallado `max_intentos` veces. Si una de ellas
+        crea un chat, también se descartan las siguientes de esa conversación, que no se podrían
+        guardar sin él.
+        """
+        marcas = ", ".join("?" * len(ids))
+        with self.lock, self.conn:
+            agotadas = self.conn.execute(
+                f"SELECT id, chat_id, chat FROM pendientes WHERE id IN ({marcas}) AND intentos >= ?", (*ids, self.max_intentos)
+            ).fetchall()
+            if not agotadas:
+                return
+            chats = [chat_id for _, chat_id, chat in agotadas if chat is not None]
+            condicion = f"id IN ({', '.join('?' * len(agotadas))})"
+            parametros = [id_entrada for id_entrada, _, _ in agotadas]
+            if chats:
+                condicion += f" OR chat_id IN ({', '.join('?' * len(chats))})"
+                parametros += chats
+            movidas = self.conn.execute(
+                f"INSERT INTO descartadas (id, chat_id, chat, filas, intentos, error, fecha) "
+                f"SELECT id, chat_id, chat, filas, intentos, ?, ? FROM pendientes WHERE {condicion}",
+                (str(error), time.time(), *parametros),
+            ).rowcount
+            self.conn.execute(f"DELETE FROM pendientes WHERE {condicion}", parametros)
+            self.contadores["descartadas"] += movidas
+        logger.error(f"Descartadas {movidas} entradas de la cola de mensajes tras {self.max_intentos} intentos: {error}")
+
+    def volcar(self) -> bool:
+        """
+        Vuelca un lote de entradas del spool al almacén. El acceso al almacén se hace sin el lock,
+        así que se puede seguir apuntando mientras tanto.
+
+        Returns:
+            bool: True si no ha fallado ninguna escritura.
+        """
+        with self.lock:
+            entradas = self.conn.execute("SELECT id, chat_id, chat, filas FROM pendientes ORDER BY id LIMIT ?", (self.lote,)).fetchall()
+        if not entradas:
+            return True
+
+        correcto = True
+        conectado = True
+        bloqueados = set()
+        volcadas = []
+        existentes = []
+        for id_entrada, chat_id, chat, filas in entradas:
+            if chat_id in bloqueados:
+                continue
+            if chat is None:
+                existentes.append((id_entrada, chat_id, json.loads(filas)))
+                continue
+            # Un chat nuevo se crea antes que cualquier otra entrada suya, que siempre es posterior
+            try:
+                self.almacen.crear_chat(json.loads(chat), json.loads(filas))
+                self.borrar([id_entrada])
+                volcadas.append(id_entrada)
+            except Exception as e:
+                self.anotar_fallo([id_entrada], e)
+                bloqueados.add(chat_id)
+                correcto = False
+                if error_de_conexion(e):
+                    conectado = False
+                    break
+
+        existentes = [entrada for entrada in existentes if entrada[1] not in bloqueados]
+        if existentes and conectado:
+            ids = [id_entrada for id_entrada, _, _ in existentes]
+            try:
+                self.almacen.insertar_mensajes([fila for _, _, filas in existentes for fila in filas])
+                self.borrar(ids)
+                volcadas.extend(ids)
+            except Exception as e:
+                if error_de_conexion(e):
+                    self.anotar_fallo(ids, e)
+                    correcto = conectado = False
+                else:
+                    # Una fila inválida hace fallar toda la inserción: se vuelca cada conversación por separado
+                    logger.warning(f"Falla la inserción conjunta de {len(ids)} entradas, se vuelcan por conversación: {e}")
+                    volcadas_una_a_una, correcto, conectado = self.volcar_por_conversacion(existentes)
+                    volcadas.extend(volcadas_una_a_una)
+
+        if volcadas:
+            with self.lock:
+                self.contadores["volcadas"] += len(volcadas)
+                self.contadores["volcados"] += 1
+            if conectado:
+                self.health.registrar_exito()
+        return correcto
+
+    def volcar_por_conversacion(self, entradas: List[tuple]):
+        """
+        Vuelca las entradas de chats existentes una a una y en orden. Cuando una falla, las
+        siguientes de su conversación esperan; si el fallo es de conexión, se para.
+
+        Returns:
+            tuple: Los ids volcados, si no ha fallado ninguna y si la conexión ha funcionado.
+        """
+        volcadas = []
+        correcto = True
+        bloqueados = set()
+        for id_entrada, chat_id, filas in entradas:
+            if chat_id in bloqueados:
+                continue
+            try:
+                self.almacen.insertar_mensajes(filas)
+                self.borrar([id_entrada])
+                volcadas.append(id_entrada)
+            except Exception as e:
+                self.anotar_fallo([id_entrada], e)
+                bloqueados.add(chat_id)
+                correcto = False
+                if error_de_conexion(e):
+                    return volcadas, False, False
+        return volcadas, correcto, True
+
+    def vaciar(self, limite: float = None) -> bool:
+        """
+        Vuelca lotes hasta que no queda nada pendiente, falla un volcado o se pasa el tiempo límite.
+
+        Returns:
+            bool: True si la cola ha quedado vacía.
+        """
+        fin = time.monotonic() + limite if limite is not None else None
+        while len(self):
+            if fin is not None and time.monotonic() >= fin:
+                return False
+            if not self.health.disponible() or not self.volcar():
+                return False
+        return True
+
+    def bucle(self):
+        """
+        Vuelca la cola cuando llegan entradas (o cada `intervalo` segundos) hasta que se pide parar.
+        """
+        while not self.parar.is_set():
+            # Tras un fallo se reintenta en cuanto pasa la espera, sin esperar a entradas nuevas
+            if not self.espera:
+                self.hay_entradas.wait(self.intervalo)
+            self.hay_entradas.clear()
+            if self.parar.is_set():
+                break
+            if self.vaciar():
+                self.espera = 0.0
+            else:
+                self.espera = min(max(self.espera * 2, 0.5), self.espera_maxima)
+                # Tras un fallo no se reintenta hasta que pase la espera, aunque lleguen entradas
+                self.parar.wait(self.espera)
+
+    def iniciar(self):
+        """
+        Arranca el volcado en segundo plano (si no está ya en marcha). Lo que quedó en el spool
+        de una ejecución anterior se vuelca enseguida.
+        """
+        if self.hilo is not None and self.hilo.is_alive():
+            return
+        # El spool se abre (y se crea si no existe) aquí, al arrancar
+        with self.lock:
+            self.conn
+        self.parar.clear()
+        self.hilo = threading.Thread(target=self.bucle, name="cola-mensajes", daemon=True)
+        self.hilo.start()
+        self.hay_entradas.set()
+
+    def detener(self, limite: float = 10.0) -> bool:
+        """
+        Para el hilo de volcado y vuelca lo pendiente durante como mucho `limite` segundos.
+        Lo que no se haya podido volcar se queda en el spool.
+
+        Returns:
+            bool: True si la cola ha quedado vacía.
+        """
+        self.parar.set()
+        self.hay_entradas.set()
+        if self.hilo is not None:
+            self.hilo.join(timeout=limite)
+            self.hilo = None
+        vacia = self.vaciar(limite)
+        if not vacia:
+            logger.warning(f"Quedan {len(self)} entradas sin volcar en {self.spool}")
+        return vacia
+
+    def metricas(self) -> Dict[str, Any]:
+        """
+        Devuelve el número de entradas pendientes y los contadores de volcados y descartes.
+        """
+        pendientes = len(self)
+        with self.lock:
+            return {"pendientes": pendientes, "espera": self.espera, **self.contadores}
@@ -0,0 +1,126 @@
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+
+class CacheConversaciones:
+    """
+    Caché en memoria del historial de las conversaciones, con expulsión LRU por tamaño.
+
+    Se rellena al escribir: los mensajes de cada turno se añaden a la conversación guardada y una
+    conversación nueva entra completa desde su primer turno. Así, los turnos siguientes y
+    `/history` no leen nada de la base de datos. Una conversación que no está (por ejemplo, tras
+    un reinicio) se lee una vez del almacén y se guarda con `llenar`.
+
+    Para que una lectura lenta no guarde un historial al que le falta un turno escrito mientras
+    tanto, cada escritura lleva un número de secuencia y `llenar` descarta la lectura si la
+    conversación se ha escrito después de `marca()`. Las últimas escrituras se recuerdan en un
+    diccionario acotado; si una ya se ha olvidado y es posterior a la marca, también se descarta.
+
+    El historial solo es fiable si las escrituras de una conversación pasan por este proceso
+    (un único worker o sesiones fijas por conversación).
+
+    Args:
+        max_bytes (int): Tamaño máximo aproximado (JSON de los mensajes) de todas las conversaciones.
+        max_escrituras (int): Número de escrituras recientes que se recuerdan para `llenar`.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_escrituras: int = 4096):
+        self.max_bytes = max_bytes
+        self.max_escrituras = max_escrituras
+        self.datos = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.secuencia = 0
+        self.escrituras = OrderedDict()
+        self.olvidado = 0
+        self.hits = 0
+        self.misses = 0
+        self.expulsadas = 0
+
+    @staticmethod
+    def tamano(mensajes: List[Dict[str, Any]]) -> int:
+        return sum(len(json.dumps(mensaje, ensure_ascii=False)) for mensaje in mensajes)
+
+    def get(self, chat_id: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        Devuelve una copia del historial de la conversación, o None si no está en la caché.
+        """
+        with self.lock:
+            entrada = self.datos.get(chat_id)
+            if entrada is None:
+                self.misses += 1
+                return None
+            self.datos.move_to_end(chat_id)
+            self.hits += 1
+            return list(entrada[0])
+
+    def marca(self) -> int:
+        """
+        Devuelve la secuencia de escrituras actual, para pasarla a `llenar` tras leer el almacén.
+        """
+        with self.lock:
+            return self.secuencia
+
+    def anadir(self, chat_id: str, mensajes: List[Dict[str, Any]], nueva: bool = False):
+        """
+        Anota los mensajes de un turno. Si la conversación es nueva se guarda entera; si ya está
+        en la caché se añaden al final; si no está, solo se anota la escritura.
+        """
+        with self.lock:
+            self.secuencia += 1
+            self.escrituras[chat_id] = self.secuencia
+            self.escrituras.move_to_end(chat_id)
+            while len(self.escrituras) > self.max_escrituras:
+                _, secuencia = self.escrituras.popitem(last=False)
+                self.olvidado = max(self.olvidado, secuencia)
+            if nueva:
+                self.guardar(chat_id, list(mensajes), self.tamano(mensajes))
+            elif chat_id in self.datos:
+                historial, tamano = self.datos[chat_id]
+                self.guardar(chat_id, historial + list(mensajes), tamano + self.tamano(mensajes))
+
+    def llenar(self, chat_id: str, mensajes: List[Dict[str, Any]], marca: int):
+        """
+        Guarda el historial leído del almacén, salvo que la conversación se haya escrito después
+        de `marca` (la lectura podría no incluir ese turno).
+        """
+        with self.lock:
+            escrita = self.escrituras.get(chat_id, self.olvidado)
+            if escrita > marca:
+                return
+            self.guardar(chat_id, list(mensajes), self.tamano(mensajes))
+
+    def guardar(self, chat_id: str, mensajes: List[Dict[str, Any]], tamano: int):
+        """
+        Guarda una conversación y expulsa las menos usadas hasta volver al tamaño máximo.
+        Se llama con el lock tomado.
+        """
+        anterior = self.datos.pop(chat_id, None)
+        if anterior is not None:
+            self.bytes -= anterior[1]
+        # Una conversación que no cabe sola no se guarda
+        if tamano > self.max_bytes:
+            return
+        self.datos[chat_id] = (mensajes, tamano)
+        self.bytes += tamano
+        while self.bytes > self.max_bytes:
+            _, (_, expulsada) = self.datos.popitem(last=False)
+            self.bytes -= expulsada
+            self.expulsadas += 1
+
+    def __len__(self):
+        return len(self.datos)
+
+    def estadisticas(self) -> Dict[str, Any]:
+        """
+        Devuelve los contadores de la caché.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self),
+            "bytes": self.bytes,
+            "expulsadas": self.expulsadas,
+        }
@@ -0,0 +1,178 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+from agent.setup_logging import setup_logging
+import logging
+
+# Configurar logging
+setup_logging()
+logger = logging.getLogger(__name__)
+
+CERRADO = "closed"
+ABIERTO = "open"
+SEMIABIERTO = "half_open"
+
+
+class ConnectionHealth:
+    """
+    Estado de salud de una conexión externa (Supabase), con semántica de circuit breaker.
+
+    El camino caliente solo consulta el estado en memoria (`disponible`) y avisa del resultado de
+    sus propias llamadas (`registrar_exito` / `registrar_fallo`), sin hacer ninguna consulta extra.
+    Una sonda en segundo plano comprueba la conexión cada `intervalo` segundos y mantiene el estado
+    al día aunque no haya tráfico.
+
+    - Cerrado: las llamadas pasan. Tras `umbral_fallos` fallos seguidos el circuito se abre.
+    - Abierto: las llamadas fallan al momento, sin tocar la red, durante `espera` segundos.
+    - Semiabierto: pasada la espera se deja pasar una única llamada de prueba; si va bien el
+      circuito se cierra y si falla se vuelve a abrir. Un sondeo correcto también lo cierra.
+
+    Args:
+        sonda (Callable[[], bool]): Función que comprueba la conexión y devuelve si funciona.
+        intervalo (float): Segundos entre sondeos.
+        umbral_fallos (int): Fallos seguidos que abren el circuito.
+        espera (float): Segundos que el circuito permanece abierto antes de probar de nuevo.
+        reloj (Callable[[], float]): Reloj monótono con el que se mide la espera.
+    """
+
+    def __init__(self, sonda: Callable[[], bool], intervalo: float = 15.0, umbral_fallos: int = 3, espera: float = 30.0, reloj: Callable[[], float] = time.monotonic):
+        self.sonda = sonda
+        self.reloj = reloj
+        self.intervalo = intervalo
+        self.umbral_fallos = umbral_fallos
+        self.espera = espera
+        self.lock = threading.Lock()
+        self.estado = CERRADO
+        self.fallos_seguidos = 0
+        self.abierto_desde = 0.0
+        self.prueba_en_curso = False
+        self.contadores = {
+            "sondeos": 0,
+            "sondeos_fallidos": 0,
+            "latencia_sondeo_ms": None,
+            "ultimo_sondeo": None,
+            "exitos": 0,
+            "fallos": 0,
+            "rechazadas": 0,
+            "aperturas": 0,
+            "ultimo_error": None,
+        }
+        self.parar = threading.Event()
+        self.hilo: Optional[threading.Thread] = None
+
+    def disponible(self) -> bool:
+        """
+        Indica si se puede llamar a la base de datos. No hace ninguna consulta: con el circuito
+        abierto devuelve False al momento y cuenta la llamada como rechazada.
+        """
+        with self.lock:
+            if self.estado == ABIERTO and self.reloj() - self.abierto_desde >= self.espera:
+                self.estado = SEMIABIERTO
+                self.prueba_en_curso = False
+            if self.estado == SEMIABIERTO and not self.prueba_en_curso:
+                # Solo una llamada de prueba a la vez mientras el circuito está semiabierto
+                self.prueba_en_curso = True
+                return True
+            if self.estado == CERRADO:
+                return True
+            self.contadores["rechazadas"] += 1
+            return False
+
+    def registrar_exito(self):
+        """
+        Anota una llamada correcta: cierra el circuito y reinicia la cuenta de fallos.
+        """
+        with self.lock:
+            self.contadores["exitos"] += 1
+            self.cerrar()
+
+    def registrar_fallo(self, error: Any = None):
+        """
+        Anota una llamada fallida y abre el circuito si se llega al umbral de fallos seguidos
+        o si falla la llamada de prueba.
+        """
+        with self.lock:
+            self.contadores["fallos"] += 1
+            self.fallar(error)
+
+    def cerrar(self):
+        """
+        Cierra el circuito. Se llama con el lock tomado.
+        """
+        if self.estado != CERRADO:
+            logger.info("Conexión con Supabase recuperada, circuito cerrado")
+        self.estado = CERRADO
+        self.fallos_seguidos = 0
+        self.prueba_en_curso = False
+
+    def fallar(self, error: Any):
+        """
+        Cuenta un fallo seguido y abre el circuito si toca. Se llama con el lock tomado.
+        """
+        self.contadores["ultimo_error"] = str(error) if error is not None else None
+        self.fallos_seguidos += 1
+        if self.estado == SEMIABIERTO or (self.estado == CERRADO and self.fallos_seguidos >= self.umbral_fallos):
+            if self.estado != ABIERTO:
+                self.contadores["aperturas"] += 1
+                logger.error(f"Conexión con Supabase caída tras {self.fallos_seguidos} fallos, circuito abierto")
+            self.estado = ABIERTO
+            self.abierto_desde = self.reloj()
+        elif self.estado == ABIERTO:
+            # Un sondeo fallido con el circuito abierto alarga la espera
+            self.abierto_desde = self.reloj()
+        self.prueba_en_curso = False
+
+    def sondear(self) -> bool:
+        """
+        Comprueba la conexión una vez y actualiza el estado y las métricas.
+        """
+        inicio = time.perf_counter()
+        try:
+            correcto = bool(self.sonda())
+            error = None if correcto else "la sonda ha fallado"
+        except Exception as e:
+            correcto, error = False, e
+        with self.lock:
+            self.contadores["sondeos"] += 1
+            self.contadores["latencia_sondeo_ms"] = (time.perf_counter() - inicio) * 1000
+            self.contadores["ultimo_sondeo"] = time.time()
+            if correcto:
+                self.cerrar()
+            else:
+                self.contadores["sondeos_fallidos"] += 1
+                self.fallar(error)
+        return correcto
+
+    def bucle(self):
+        """
+        Sondea la conexión cada `intervalo` segundos hasta que se llama a `detener`.
+        """
+        while not self.parar.is_set():
+            self.sondear()
+            self.parar.wait(self.intervalo)
+
+    def iniciar(self):
+        """
+        Arranca la sonda en segundo plano (si no está ya en marcha).
+        """
+        if self.hilo is not None and self.hilo.is_alive():
+            return
+        self.parar.clear()
+        self.hilo = threading.Thread(target=self.bucle, name="supabase-health", daemon=True)
+        self.hilo.start()
+
+    def detener(self):
+        """
+        Para la sonda en segundo plano.
+        """
+        self.parar.set()
+        if self.hilo is not None:
+            self.hilo.join(timeout=self.intervalo)
+            self.hilo = None
+
+    def metricas(self) -> Dict[str, Any]:
+        """
+        Devuelve el estado del circuito y los contadores de sondeos y llamadas.
+        """
+        with self.lock:
+            return {"estado": self.estado, "fallos_seguidos": self.fallos_seguidos, **self.contadores}
@@ -1,7 +1,14 @@
+import asyncio
 import os
-# from datetime import datetime, timezone
-from supabase import create_client, Client
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from supabase import create_client
 from typing import List, Dict, Any, Optional
+from agent.almacen import AlmacenLocal, AlmacenSupabase
+from agent.cola import ColaEscritura
+from agent.conversaciones import CacheConversaciones
+from agent.health import ConnectionHealth
 from agent.setup_logging import setup_logging
 import logging
 
@@ -12,16 +19,37 @@ logger = logging.getLogger(__name__)
 url: str = os.environ.get("SUPABASE_URL") or ""
 key: str = os.environ.get("SUPABASE_KEY") or ""
 
-supabase: Client = create_client(url, key)
+
+
+def crear_almacen():
+    """
+    Crea el almacén de conversaciones: Supabase o, con `MEMORY_BACKEND=local`, una base de datos
+    SQLite local (`MEMORY_LOCAL_DB`, en memoria por defecto) que no necesita conexión.
+    """
+    if os.environ.get("MEMORY_BACKEND") == "local":
+        return AlmacenLocal(os.environ.get("MEMORY_LOCAL_DB", ":memory:"))
+    return AlmacenSupabase(create_client(url, key))
+
+
+almacen = crear_almacen()
+
+# Hilos para las llamadas síncronas a Supabase desde el servidor asíncrono. Es un pool propio,
+# y no el del bucle de eventos, para que el número de consultas simultáneas no dependa de los
+# núcleos de la máquina.
+supabase_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("SUPABASE_WORKERS", "32")),
+    thread_name_prefix="supabase",
+)
 
 
 def check_connection() -> bool:
     """
     Checks if the Supabase connection is working.
+    Se usa como sonda de `health`; las peticiones no la llaman.
     """
     try:
         # Try a simple select on a known table
-        supabase.table("messages").select("id").limit(1).execute()
+        almacen.comprobar()
         return True
     except Exception as e:
         logger.error(f"Supabase connection error: {e}")
@@ -29,29 +57,104 @@ def check_connection() -> bool:
         return False
 
 
+# Salud de la conexión con Supabase: una sonda en segundo plano (arrancada por el servidor)
+# y un circuit breaker alimentado también por las propias llamadas
+health = ConnectionHealth(
+    check_connection,
+    intervalo=float(os.environ.get("SUPABASE_HEALTH_INTERVAL", "15")),
+    umbral_fallos=int(os.environ.get("SUPABASE_HEALTH_FAILURES", "3")),
+    espera=float(os.environ.get("SUPABASE_HEALTH_COOLDOWN", "30")),
+)
+
+
+# Directorio de los datos locales del servidor (el spool de la cola), fuera del directorio de trabajo
+DATA_DIR = os.environ.get("MEMORY_DATA_DIR") or os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", "data"))
+
+# Cola de escritura diferida: el servidor apunta aquí los mensajes y un hilo los vuelca al almacén.
+# El spool se abre al arrancar el servidor, no al importar este módulo.
+cola = ColaEscritura(
+    almacen,
+    health,
+    spool=os.environ.get("MEMORY_SPOOL") or os.path.join(DATA_DIR, "memory_spool.db"),
+    lote=int(os.environ.get("MEMORY_SPOOL_BATCH", "100")),
+)
+
+# Historial de las conversaciones en memoria, delante del almacén
+conversaciones = CacheConversaciones(max_bytes=int(os.environ.get("MEMORY_CACHE_BYTES", str(64 * 1024 * 1024))))
+
+
 def load_messages(conversation_id: Optional[str]) -> List[Dict[str, Any]]:
     """
     Load all messages for a given conversation_id (chatId).
+    Primero se busca en la caché de conversaciones; si no está, se lee del almacén, incluyendo
+    los mensajes que siguen en la cola de escritura, detrás de los ya guardados.
     """
-    if not check_connection() or not conversation_id:
+    if not conversation_id:
         return []
-    try:
-        response = (
-            supabase.table("messages")
-            .select("*")
-            .eq("chatId", conversation_id)
-            .order("createdAt", desc=False)
-            .execute()
-        )
-        messages = []
-        for msg in response.data:
-            messages.append(msg["content"])
-        logger.debug(f"Loaded messages for conversation {conversation_id}: {messages}")
+    messages = conversaciones.get(conversation_id)
+    if messages is not None:
         return messages
+    return leer_historial(conversation_id)
+
+
+def leer_historial(conversation_id: str) -> List[Dict[str, Any]]:
+    """
+    Lee el historial de una conversación del almacén y de la cola de escritura, y lo guarda en
+    la caché de conversaciones.
+    """
+    marca = conversaciones.marca()
+    # Los pendientes se leen antes que el almacén: un mensaje que se vuelque entre las dos
+    # lecturas aparece en ambas y se descarta por su id, pero nunca falta en las dos
+    pendientes = cola.pendientes(conversation_id)
+    if not health.disponible():
+        return [fila["content"] for fila in pendientes]
+    try:
+        filas = almacen.leer_mensajes(conversation_id)
+        health.registrar_exito()
     except Exception as e:
+        health.registrar_fallo(e)
         logger.error(f"Error loading messages: {e}")
         print(f"Error loading messages: {e}")
-        return []
+        return [fila["content"] for fila in pendientes]
+    guardados = {fila["id"] for fila in filas}
+    messages = [fila["content"] for fila in filas + [fila for fila in pendientes if fila["id"] not in guardados]]
+    logger.debug(f"Loaded messages for conversation {conversation_id}: {messages}")
+    # Solo se guarda en la caché un historial leído entero
+    conversaciones.llenar(conversation_id, messages, marca)
+    return messages
+
+
+def preparar_mensajes(conversation_id: Optional[str], messages: List[Dict[str, Any]]):
+    """
+    Prepara las filas de un turno para guardarlas. Los ids se generan aquí, de forma que guardar
+    dos veces las mismas filas no las duplica, y las fechas son consecutivas, para que al leerlas
+    ordenadas por `createdAt` salgan en el mismo orden aunque se inserten a la vez.
+
+    Returns:
+        tuple: El id de la conversación (nuevo si `conversation_id` es None), los datos del chat
+            si la conversación es nueva (None si ya existe) y las filas de los mensajes.
+    """
+    chat_id = conversation_id or str(uuid.uuid4())
+    ahora = datetime.now(timezone.utc)
+    to_insert = [
+        {
+            "id": str(uuid.uuid4()),
+            "content": msg,
+            "chatId": chat_id,
+            "createdAt": (ahora + timedelta(microseconds=i)).isoformat(),
+        }
+        for i, msg in enumerate(messages)
+    ]
+    chat_data = None
+    if conversation_id is None:
+        first_message = messages[0]
+        titulo = first_message.get("content", "")[:100]  # Primeros 100 caracteres
+        chat_data = {
+            "id": chat_id,
+            "title": titulo,
+            "visibility": "private",
+        }
+    return chat_id, chat_data, to_insert
 
 
 def save_messages(
@@ -62,42 +165,58 @@ def save_messages(
     """
     Save a list of messages to the database for a given conversation_id.
     If conversation_id is None, creates a new chat and returns its id.
-    Each message should be a dict with at least: role, content, createdAt.
+    Each message should be a dict with at least: role, content.
+
+    Todos los mensajes se insertan con una sola petición. Un chat nuevo se crea con un id generado
+    aquí y se guarda junto con sus mensajes también en una sola petición (ver `AlmacenSupabase`).
+    El servidor no espera a esta escritura: usa `queue_messages`.
     """
-    if not check_connection() or not messages:
+    if not messages or not health.disponible():
         logger.error("No connection to Supabase or no messages to save.")
         raise ValueError("No connection to Supabase or no messages to save.")
 
-    chat_id = conversation_id
+    chat_id, chat_data, to_insert = preparar_mensajes(conversation_id, messages)
     try:
-        # Si es una nueva conversación, crea el registro en chat
-        if chat_id is None:
-            first_message = messages[0]
-            titulo = first_message.get("content", "")[:100]  # Primeros 100 caracteres
-            chat_data = {
-                # "id": chat_id,
-                "title": titulo,
-                "visibility": "private",
-            }
-            response = supabase.table("chat").insert(chat_data).execute()
-            if response.data and len(response.data) > 0:
-                chat_id = response.data[0]["id"]
-            else:
-                logger.error("No se pudo obtener el id del chat insertado")
-                print("No se pudo obtener el id del chat insertado")
-                raise ValueError("No se pudo obtener el id del chat insertado")
-            logger.debug(f"Respuesta Insert chat: {response}")
-
-        # Prepara los mensajes para insertar
-        for msg in messages:
-            to_insert = {
-                "content": msg,
-                "chatId": chat_id,
-            }
-            response = supabase.table("messages").insert(to_insert).execute()
-            logger.debug(f"Respuesta Insert message: {response}")
+        # Si es una nueva conversación, crea el registro en chat junto con los mensajes
+        if chat_data is not None:
+            almacen.crear_chat(chat_data, to_insert)
+        else:
+            almacen.insertar_mensajes(to_insert)
+        health.registrar_exito()
+        conversaciones.anadir(chat_id, messages, nueva=chat_data is not None)
         return chat_id
     except Exception as e:
+        health.registrar_fallo(e)
         logger.error(f"Error saving messages: {e}")
         print(f"Error saving messages: {e}")
         raise ValueError(f"Error saving messages: {e}")
+
+
+def queue_messages(conversation_id: Optional[str], messages: List[Dict[str, Any]]) -> str:
+    """
+    Igual que save_messages, pero sin esperar a la base de datos: los mensajes se apuntan en la
+    cola de escritura (`cola`) y se guardan en segundo plano. Devuelve al momento el id de la
+    conversación, también si es nueva.
+    """
+    if not messages:
+        raise ValueError("No messages to save.")
+    chat_id, chat_data, to_insert = preparar_mensajes(conversation_id, messages)
+    cola.apuntar(chat_id, chat_data, to_insert)
+    conversaciones.anadir(chat_id, messages, nueva=chat_data is not None)
+    return chat_id
+
+
+async def load_messages_async(conversation_id: Optional[str]) -> List[Dict[str, Any]]:
+    """
+    Igual que load_messages, pero ejecuta las llamadas a Supabase en `supabase_executor` para no
+    bloquear el bucle de eventos del servidor. Las conversaciones de la caché se devuelven sin
+    salir del bucle.
+    """
+    if not conversation_id:
+        return []
+    messages = conversaciones.get(conversation_id)
+    if messages is not None:
+        return messages
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(supabase_executor, leer_historial, conversation_id)
+
@@ -1,10 +1,12 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from pydantic import BaseModel
-from agent.agent import agent
-from agent.memory import load_messages, save_messages
+from agent.agent import agent_async, agent_stream_async
+from agent.memory import cola, conversaciones, health, load_messages_async, queue_messages
 from agent.setup_logging import setup_logging
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+import json
 import logging
 import os
 
@@ -16,7 +18,18 @@ logger = logging.getLogger(__name__)
 STATIC_DIR = os.path.join(os.path.dirname(__file__), "static")
 INDEX_HTML = os.path.join(STATIC_DIR, "index.html")
 
-app = FastAPI(title="Chatbot API", description="A simple chatbot API", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # La sonda de Supabase y el volcado de la cola de mensajes viven mientras vive el servidor.
+    # Al parar, se vuelca lo pendiente antes de cerrar la conexión.
+    health.iniciar()
+    cola.iniciar()
+    yield
+    cola.detener(limite=float(os.environ.get("MEMORY_SPOOL_DRAIN_TIMEOUT", "10")))
+    health.detener()
+
+
+app = FastAPI(title="Chatbot API", description="A simple chatbot API", version="1.0.0", lifespan=lifespan)
 
 # Servir archivos estáticos (index.html)
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
@@ -47,21 +60,72 @@ async def chat(request: ChatRequest):
     if chat_id is None:
         previous_messages = []
     else:
-        previous_messages = load_messages(request.conversation_id)
+        previous_messages = await load_messages_async(request.conversation_id)
         logger.debug(f"Previous messages for conversation {chat_id}: {previous_messages}")
 
-    response = agent(previous_messages + [{"role": "user", "content": request.message}])
-    chat_id = save_messages(
+    # Todas las esperas (Supabase y OpenAI) ceden el bucle de eventos a las demás peticiones
+    response = await agent_async(previous_messages + [{"role": "user", "content": request.message}])
+    # Los mensajes se guardan en segundo plano; la respuesta no espera a la base de datos
+    chat_id = queue_messages(
         conversation_id=chat_id,
         messages=[
             {"role": "user", "content": request.message},
             {"role": "assistant", "content": response}
         ]
     )
-    logger.debug(f"Answer saved with conversation ID: {chat_id}: {response}")
+    logger.debug(f"Answer queued with conversation ID: {chat_id}: {response}")
     return ChatResponse(response=response, conversation_id=chat_id)
 
 
+@app.post("/chat/stream")
+async def chat_stream(request: ChatRequest):
+    """
+    Igual que /chat, pero envía la respuesta como Server-Sent Events según se genera.
+    Cada evento lleva un fragmento en `token`; el último lleva el `conversation_id`
+    cuando la conversación ya está en la cola de escritura. Si el modelo falla a mitad de la
+    respuesta, el último evento lleva `error` y el turno no se guarda.
+    """
+    chat_id = request.conversation_id or None
+    if chat_id is None:
+        previous_messages = []
+    else:
+        previous_messages = await load_messages_async(request.conversation_id)
+        logger.debug(f"Previous messages for conversation {chat_id}: {previous_messages}")
+
+    async def eventos():
+        response = ""
+        try:
+            async for token in agent_stream_async(previous_messages + [{"role": "user", "content": request.message}]):
+                response += token
+                yield f"data: {json.dumps({'token': token})}\n\n"
+        except Exception as e:
+            # La respuesta ya ha empezado (200), así que el error se avisa con un evento en lugar de cortar el stream
+            logger.error(f"Error generating streamed answer: {e}")
+            yield f"data: {json.dumps({'error': 'Error al generar la respuesta.'})}\n\n"
+            return
+        conversation_id = queue_messages(
+            conversation_id=chat_id,
+            messages=[
+                {"role": "user", "content": request.message},
+                {"role": "assistant", "content": response}
+            ]
+        )
+        logger.debug(f"Answer queued with conversation ID: {conversation_id}: {response}")
+        yield f"data: {json.dumps({'conversation_id': conversation_id})}\n\n"
+
+    return StreamingResponse(eventos(), media_type="text/event-stream")
+
+
 @app.get("/history/{conversation_id}")
 async def history(conversation_id: str):
-    return load_messages(conversation_id)
+    return await load_messages_async(conversation_id)
+
+
+@app.get("/health")
+async def health_status():
+    """
+    Estado del circuito de Supabase, métricas de la sonda, de la cola de escritura y de la
+    caché de conversaciones. Responde 503 con el circuito abierto.
+    """
+    metricas = {**health.metricas(), "cola": cola.metricas(), "conversaciones": conversaciones.estadisticas()}
+    return JSONResponse(metricas, status_code=503 if metricas["estado"] == "open" else 200)
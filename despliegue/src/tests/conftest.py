@@ -0,0 +1,33 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+# La memoria se prueba con el almacén local, sin conexión a Supabase ni spool en disco
+os.environ.setdefault("MEMORY_BACKEND", "local")
+os.environ.setdefault("MEMORY_SPOOL", ":memory:")
+
+from agent import memory, server  # noqa: E402
+from agent.almacen import AlmacenLocal  # noqa: E402
+from agent.cola import ColaEscritura  # noqa: E402
+from agent.conversaciones import CacheConversaciones  # noqa: E402
+from agent.health import ConnectionHealth  # noqa: E402
+
+
+@pytest.fixture
+def memoria(monkeypatch):
+    """
+    Sustituye el almacén, el circuito, la cola y la caché de conversaciones por otros nuevos,
+    con el almacén local en memoria.
+    """
+    almacen = AlmacenLocal()
+    health = ConnectionHealth(lambda: True)
+    cola = ColaEscritura(almacen, health, intervalo=0.05, espera_maxima=0.2)
+    conversaciones = CacheConversaciones()
+    for modulo in (memory, server):
+        monkeypatch.setattr(modulo, "health", health)
+        monkeypatch.setattr(modulo, "cola", cola)
+        monkeypatch.setattr(modulo, "conversaciones", conversaciones)
+    monkeypatch.setattr(memory, "almacen", almacen)
+    yield SimpleNamespace(almacen=almacen, health=health, cola=cola, conversaciones=conversaciones)
+    cola.detener(limite=1)
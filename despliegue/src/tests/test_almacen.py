@@ -0,0 +1,111 @@
+import pytest
+from postgrest.exceptions import APIError
+
+from agent import memory
+from agent.almacen import RPC_CREAR_CHAT, AlmacenSupabase
+
+
+class Consulta:
+    """
+    Imita el constructor de consultas de Supabase: anota cada operación en `cliente.llamadas`
+    al ejecutarla.
+    """
+
+    def __init__(self, cliente, tabla):
+        self.cliente = cliente
+        self.operacion = [tabla]
+
+    def __getattr__(self, nombre):
+        def metodo(*args, **kwargs):
+            self.operacion.append((nombre, args, kwargs))
+            return self
+        return metodo
+
+    def execute(self):
+        self.cliente.llamadas.append(tuple(self.operacion))
+        return self
+
+
+class ClienteFalso:
+    """
+    Cliente de Supabase falso. `rpc` falla con `error_rpc` si lo hay.
+    """
+
+    def __init__(self, error_rpc: str = None):
+        self.llamadas = []
+        self.error_rpc = error_rpc
+
+    def table(self, nombre):
+        return Consulta(self, nombre)
+
+    def rpc(self, nombre, parametros):
+        if self.error_rpc:
+            raise APIError({"code": self.error_rpc, "message": "error"})
+        consulta = Consulta(self, "rpc")
+        consulta.operacion.append((nombre, (parametros,), {}))
+        return consulta
+
+
+def test_un_turno_se_guarda_con_una_sola_peticion(memoria):
+    chat_id = memory.save_messages(None, [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}])
+    assert memoria.almacen.peticiones == 1
+
+    memory.save_messages(chat_id, [{"role": "user", "content": "Bye"}, {"role": "assistant", "content": "See you"}])
+    assert memoria.almacen.peticiones == 2
+    assert [fila["content"]["content"] for fila in memoria.almacen.leer_mensajes(chat_id)] == ["Hi", "Hello", "Bye", "See you"]
+
+
+def test_preparar_mensajes_genera_ids_y_fechas_ordenadas():
+    mensajes = [{"role": "user", "content": str(i)} for i in range(20)]
+    chat_id, chat, filas = memory.preparar_mensajes(None, mensajes)
+
+    assert chat["id"] == chat_id and chat["title"] == "0"
+    assert len({fila["id"] for fila in filas}) == 20
+    assert all(fila["chatId"] == chat_id for fila in filas)
+    fechas = [fila["createdAt"] for fila in filas]
+    assert fechas == sorted(fechas) and len(set(fechas)) == 20
+
+    # Una conversación que ya existe no vuelve a crear el chat
+    assert memory.preparar_mensajes(chat_id, mensajes)[1] is None
+
+
+def test_repetir_una_escritura_no_duplica_mensajes(memoria):
+    chat_id, chat, filas = memory.preparar_mensajes(None, [{"role": "user", "content": "Hi"}])
+    memoria.almacen.crear_chat(chat, filas)
+    memoria.almacen.crear_chat(chat, filas)
+    memoria.almacen.insertar_mensajes(filas)
+
+    assert memoria.almacen.leer_mensajes(chat_id) == [{"id": filas[0]["id"], "content": {"role": "user", "content": "Hi"}}]
+
+
+def test_crear_chat_usa_la_funcion_de_supabase():
+    cliente = ClienteFalso()
+    chat_id, chat, filas = memory.preparar_mensajes(None, [{"role": "user", "content": "Hi"}])
+
+    AlmacenSupabase(cliente).crear_chat(chat, filas)
+
+    assert cliente.llamadas == [("rpc", (RPC_CREAR_CHAT, ({"chat": chat, "mensajes": filas},), {}))]
+
+
+def test_crear_chat_sin_la_funcion_usa_dos_inserciones():
+    cliente = ClienteFalso(error_rpc="PGRST202")
+    almacen = AlmacenSupabase(cliente)
+    _, chat, filas = memory.preparar_mensajes(None, [{"role": "user", "content": "Hi"}])
+
+    almacen.crear_chat(chat, filas)
+    almacen.crear_chat(chat, filas)
+
+    # Tras el primer PGRST202 ya no se vuelve a intentar la función
+    upsert = ("upsert", (chat,), {"on_conflict": "id", "ignore_duplicates": True})
+    insertar = ("upsert", (filas,), {"on_conflict": "id", "ignore_duplicates": True})
+    assert cliente.llamadas == [("chat", upsert), ("messages", insertar)] * 2
+    assert not almacen.rpc
+
+
+def test_crear_chat_no_oculta_otros_errores_de_la_funcion():
+    almacen = AlmacenSupabase(ClienteFalso(error_rpc="23505"))
+    _, chat, filas = memory.preparar_mensajes(None, [{"role": "user", "content": "Hi"}])
+
+    with pytest.raises(APIError):
+        almacen.crear_chat(chat, filas)
+    assert almacen.rpc
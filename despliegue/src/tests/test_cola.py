@@ -0,0 +1,197 @@
+import asyncio
+import time
+
+import httpx
+
+from agent import memory, server
+from agent.almacen import AlmacenLocal
+from agent.cola import ColaEscritura, error_de_conexion
+from agent.health import CERRADO, ConnectionHealth
+
+
+class AlmacenConFallos(AlmacenLocal):
+    """
+    Almacén local que falla con `fallo(filas)` si devuelve un error, y anota cuándo se llama.
+    """
+
+    def __init__(self, fallo=lambda filas: None):
+        super().__init__()
+        self.fallo = fallo
+        self.llamadas = []
+
+    def comprobar_fallo(self, filas):
+        self.llamadas.append(time.monotonic())
+        error = self.fallo(filas)
+        if error is not None:
+            raise error
+
+    def insertar_mensajes(self, filas):
+        self.comprobar_fallo(filas)
+        super().insertar_mensajes(filas)
+
+    def crear_chat(self, chat, filas):
+        self.comprobar_fallo(filas)
+        super().crear_chat(chat, filas)
+
+
+def nueva_cola(almacen, **kwargs):
+    health = ConnectionHealth(lambda: True, umbral_fallos=100)
+    return ColaEscritura(almacen, health, **kwargs), health
+
+
+def turno(chat_id, texto, nuevo=False):
+    _, chat, filas = memory.preparar_mensajes(None if nuevo else chat_id, [{"role": "user", "content": texto}])
+    if nuevo:
+        chat["id"] = chat_id
+        for fila in filas:
+            fila["chatId"] = chat_id
+    return chat_id, chat, filas
+
+
+def textos(almacen, chat_id):
+    return [fila["content"]["content"] for fila in almacen.leer_mensajes(chat_id)]
+
+
+def test_un_chat_nuevo_y_sus_turnos_se_vuelcan_en_orden():
+    almacen = AlmacenLocal()
+    cola, _ = nueva_cola(almacen)
+    cola.apuntar(*turno("a", "a1", nuevo=True))
+    cola.apuntar(*turno("b", "b1", nuevo=True))
+    for i in range(2, 5):
+        cola.apuntar(*turno("a", f"a{i}"))
+        cola.apuntar(*turno("b", f"b{i}"))
+    assert [fila["content"]["content"] for fila in cola.pendientes("a")] == ["a1", "a2", "a3", "a4"]
+
+    assert cola.vaciar()
+
+    # Cada chat nuevo con su petición y todos los turnos de chats existentes en una sola
+    assert almacen.peticiones == 3
+    assert textos(almacen, "a") == ["a1", "a2", "a3", "a4"]
+    assert textos(almacen, "b") == ["b1", "b2", "b3", "b4"]
+    assert len(cola) == 0
+
+
+def test_si_falla_un_chat_sus_turnos_esperan_y_los_demas_se_vuelcan():
+    caido = {"a"}
+    almacen = AlmacenConFallos(lambda filas: ConnectionError("caído") if filas[0]["chatId"] in caido else None)
+    cola, health = nueva_cola(almacen)
+    cola.apuntar(*turno("a", "a1", nuevo=True))
+    cola.apuntar(*turno("b", "b1", nuevo=True))
+    cola.apuntar(*turno("a", "a2"))
+
+    assert not cola.volcar()
+    # El fallo de conexión para el volcado y cuenta para el circuito
+    assert [fila["content"]["content"] for fila in cola.pendientes("a")] == ["a1", "a2"]
+    assert health.metricas()["fallos"] == 1
+
+    caido.clear()
+    assert cola.vaciar()
+    assert textos(almacen, "a") == ["a1", "a2"]
+    assert textos(almacen, "b") == ["b1"]
+
+
+def test_reintenta_con_espera_creciente():
+    fallos = [ConnectionError("timeout"), ConnectionError("timeout")]
+    almacen = AlmacenConFallos(lambda filas: fallos.pop(0) if fallos else None)
+    cola, health = nueva_cola(almacen, intervalo=0.05, espera_maxima=2.0)
+    cola.iniciar()
+    try:
+        cola.apuntar(*turno("a", "a1", nuevo=True))
+        fin = time.monotonic() + 5
+        while len(cola) and time.monotonic() < fin:
+            time.sleep(0.05)
+    finally:
+        cola.detener(limite=1)
+
+    assert textos(almacen, "a") == ["a1"]
+    # Tras el primer fallo se espera 0,5 s y tras el segundo el doble
+    esperas = [despues - antes for antes, despues in zip(almacen.llamadas, almacen.llamadas[1:])]
+    assert len(esperas) == 2
+    assert 0.5 <= esperas[0] < 1.0 and 1.0 <= esperas[1] < 1.5
+    assert cola.espera == 0
+    assert health.metricas()["fallos"] == 2
+
+
+def test_una_fila_invalida_no_bloquea_a_las_demas_y_se_descarta():
+    def fallo(filas):
+        if any(fila["content"]["content"] == "veneno" for fila in filas):
+            return ValueError("invalid input syntax")
+
+    almacen = AlmacenConFallos(fallo)
+    cola, health = nueva_cola(almacen, max_intentos=2)
+    cola.apuntar(*turno("a", "a1", nuevo=True))
+    cola.apuntar(*turno("b", "b1", nuevo=True))
+    assert cola.vaciar()
+    cola.apuntar(*turno("a", "veneno"))
+    cola.apuntar(*turno("b", "b2"))
+    cola.apuntar(*turno("a", "a2"))
+
+    # La inserción conjunta falla y se vuelca por conversación: solo espera la conversación "a"
+    assert not cola.volcar()
+    assert textos(almacen, "b") == ["b1", "b2"]
+    assert [fila["content"]["content"] for fila in cola.pendientes("a")] == ["veneno", "a2"]
+    # Un error de los datos no abre el circuito
+    assert health.metricas()["fallos"] == 0 and health.estado == CERRADO
+
+    # Al llegar a max_intentos la entrada se descarta y la conversación sigue
+    assert not cola.volcar()
+    assert [fila["content"]["content"] for fila in cola.pendientes("a")] == ["a2"]
+    assert cola.vaciar()
+    assert textos(almacen, "a") == ["a1", "a2"]
+    assert cola.metricas()["descartadas"] == 1
+    chat_id, error = cola.conn.execute("SELECT chat_id, error FROM descartadas").fetchone()
+    assert chat_id == "a" and "invalid input syntax" in error
+
+
+def test_un_chat_que_no_se_puede_crear_se_descarta_con_sus_turnos():
+    almacen = AlmacenConFallos(lambda filas: ValueError("value too long") if filas[0]["chatId"] == "a" else None)
+    cola, _ = nueva_cola(almacen, max_intentos=1)
+    cola.apuntar(*turno("a", "a1", nuevo=True))
+    cola.apuntar(*turno("a", "a2"))
+    cola.apuntar(*turno("b", "b1", nuevo=True))
+
+    assert not cola.volcar()
+
+    assert len(cola) == 0
+    assert cola.metricas()["descartadas"] == 2
+    assert textos(almacen, "b") == ["b1"]
+
+
+def test_los_errores_de_conexion_no_se_descartan():
+    almacen = AlmacenConFallos(lambda filas: httpx.ConnectTimeout("timeout"))
+    cola, health = nueva_cola(almacen, max_intentos=1)
+    cola.apuntar(*turno("a", "a1", nuevo=True))
+
+    for _ in range(3):
+        assert not cola.volcar()
+
+    assert len(cola) == 1 and cola.metricas()["descartadas"] == 0
+    assert health.metricas()["fallos"] == 3
+    assert error_de_conexion(httpx.ConnectTimeout("timeout")) and not error_de_conexion(ValueError())
+
+
+def test_al_parar_el_servidor_se_vuelca_lo_pendiente(memoria, monkeypatch):
+    # Sin hilo de volcado: lo apuntado solo se guarda en la parada
+    monkeypatch.setattr(memoria.cola, "bucle", lambda: memoria.cola.parar.wait())
+
+    async def servidor():
+        async with server.lifespan(server.app):
+            chat_id = memory.queue_messages(None, [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}])
+            assert len(memoria.cola) == 1
+        return chat_id
+
+    chat_id = asyncio.run(servidor())
+
+    assert len(memoria.cola) == 0
+    assert textos(memoria.almacen, chat_id) == ["Hi", "Hello"]
+
+
+def test_el_spool_se_crea_al_arrancar_y_no_al_crear_la_cola(tmp_path):
+    spool = tmp_path / "data" / "spool.db"
+    cola, _ = nueva_cola(AlmacenLocal(), spool=str(spool), intervalo=0.05)
+    assert not spool.parent.exists()
+    cola.iniciar()
+    try:
+        assert spool.exists()
+    finally:
+        cola.detener(limite=1)
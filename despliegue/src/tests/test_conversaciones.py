@@ -0,0 +1,108 @@
+from agent import memory
+from agent.conversaciones import CacheConversaciones
+
+
+def mensajes(*textos):
+    return [{"role": "user", "content": texto} for texto in textos]
+
+
+def test_expulsa_las_conversaciones_menos_usadas_por_tamano():
+    tamano = CacheConversaciones.tamano(mensajes("hola"))
+    cache = CacheConversaciones(max_bytes=2 * tamano)
+    cache.anadir("a", mensajes("hola"), nueva=True)
+    cache.anadir("b", mensajes("hola"), nueva=True)
+    # Usar "a" la deja como la más reciente: al entrar "c" sale "b"
+    assert cache.get("a") == mensajes("hola")
+    cache.anadir("c", mensajes("hola"), nueva=True)
+
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.estadisticas() == {"hits": 3, "misses": 1, "size": 2, "bytes": 2 * tamano, "expulsadas": 1}
+
+
+def test_al_crecer_una_conversacion_expulsa_otras_y_si_no_cabe_sola_no_se_guarda():
+    tamano = CacheConversaciones.tamano(mensajes("hola"))
+    cache = CacheConversaciones(max_bytes=3 * tamano)
+    cache.anadir("a", mensajes("hola"), nueva=True)
+    cache.anadir("b", mensajes("hola"), nueva=True)
+    cache.anadir("b", mensajes("hola", "hola"))
+    assert cache.get("a") is None
+    assert cache.get("b") == mensajes("hola", "hola", "hola")
+    assert cache.bytes == 3 * tamano
+
+    cache.anadir("b", mensajes("hola"))
+    assert cache.get("b") is None
+    assert len(cache) == 0 and cache.bytes == 0
+
+
+def test_anadir_a_una_conversacion_que_no_esta_no_la_guarda():
+    cache = CacheConversaciones()
+    cache.anadir("a", mensajes("hola"))
+    assert cache.get("a") is None
+
+
+def test_llenar_descarta_una_lectura_anterior_a_una_escritura():
+    cache = CacheConversaciones()
+    marca = cache.marca()
+    cache.anadir("a", mensajes("nuevo"))
+    cache.anadir("b", mensajes("nuevo"))
+    # La lectura de "a" empezó antes de escribir el turno: puede no incluirlo
+    cache.llenar("a", mensajes("viejo"), marca)
+    assert cache.get("a") is None
+
+    cache.llenar("a", mensajes("viejo", "nuevo"), cache.marca())
+    assert cache.get("a") == mensajes("viejo", "nuevo")
+    # Una conversación sin escrituras después de la marca se guarda
+    cache.llenar("c", mensajes("viejo"), marca)
+    assert cache.get("c") == mensajes("viejo")
+
+
+def test_llenar_descarta_la_lectura_si_la_escritura_ya_se_ha_olvidado():
+    cache = CacheConversaciones(max_escrituras=1)
+    marca = cache.marca()
+    cache.anadir("a", mensajes("nuevo"))
+    cache.anadir("b", mensajes("nuevo"))
+    assert "a" not in cache.escrituras and cache.olvidado == 1
+
+    cache.llenar("a", mensajes("viejo"), marca)
+    assert cache.get("a") is None
+    cache.llenar("a", mensajes("viejo", "nuevo"), cache.marca())
+    assert cache.get("a") == mensajes("viejo", "nuevo")
+
+
+def test_queue_messages_actualiza_la_cache(memoria, monkeypatch):
+    chat_id = memory.queue_messages(None, mensajes("pregunta"))
+    assert memoria.conversaciones.get(chat_id) == mensajes("pregunta")
+    memory.queue_messages(chat_id, mensajes("respuesta", "otra"))
+
+    # El historial sale de la caché, sin leer el almacén
+    def leer_mensajes(chat_id):
+        raise AssertionError("no debe leer el almacén")
+
+    monkeypatch.setattr(memoria.almacen, "leer_mensajes", leer_mensajes)
+    assert memory.load_messages(chat_id) == mensajes("pregunta", "respuesta", "otra")
+
+
+def test_load_messages_no_guarda_un_historial_al_que_le_falta_un_turno(memoria, monkeypatch):
+    chat_id = memory.queue_messages(None, mensajes("pregunta"))
+    memoria.cola.volcar()
+    memoria.conversaciones.datos.clear()
+    leer_mensajes = memoria.almacen.leer_mensajes
+    lecturas = []
+
+    # Mientras se lee el almacén llega un turno nuevo, que la lectura no incluye
+    def leer_y_escribir(chat_id):
+        filas = leer_mensajes(chat_id)
+        if not lecturas:
+            memory.queue_messages(chat_id, mensajes("respuesta"))
+        lecturas.append(chat_id)
+        return filas
+
+    monkeypatch.setattr(memoria.almacen, "leer_mensajes", leer_y_escribir)
+    assert memory.load_messages(chat_id) == mensajes("pregunta")
+    assert memoria.conversaciones.get(chat_id) is None
+
+    # La siguiente lectura incluye el turno pendiente en la cola y ya se guarda
+    assert memory.load_messages(chat_id) == mensajes("pregunta", "respuesta")
+    assert memory.load_messages(chat_id) == mensajes("pregunta", "respuesta")
+    assert len(lecturas) == 2
@@ -0,0 +1,115 @@
+import asyncio
+
+import httpx
+
+from agent import server
+from agent.health import ABIERTO, CERRADO, SEMIABIERTO, ConnectionHealth
+
+
+class Reloj:
+    """
+    Reloj manual para mover el tiempo del circuito sin esperar.
+    """
+
+    def __init__(self):
+        self.ahora = 0.0
+
+    def __call__(self) -> float:
+        return self.ahora
+
+
+class Sonda:
+    """
+    Sonda falsa que devuelve `correcto` y cuenta sus llamadas.
+    """
+
+    def __init__(self):
+        self.correcto = True
+        self.llamadas = 0
+
+    def __call__(self) -> bool:
+        self.llamadas += 1
+        return self.correcto
+
+
+def circuito(umbral_fallos: int = 3, espera: float = 30.0):
+    reloj, sonda = Reloj(), Sonda()
+    return ConnectionHealth(sonda, umbral_fallos=umbral_fallos, espera=espera, reloj=reloj), reloj, sonda
+
+
+def test_circuito_se_abre_prueba_y_se_cierra():
+    health, reloj, _ = circuito()
+
+    for _ in range(2):
+        health.registrar_fallo("timeout")
+    assert health.estado == CERRADO and health.disponible()
+
+    # Al tercer fallo seguido se abre y las llamadas se rechazan sin tocar la red
+    health.registrar_fallo("timeout")
+    assert health.estado == ABIERTO
+    assert not health.disponible()
+    assert health.metricas()["rechazadas"] == 1
+
+    # Pasada la espera solo entra una llamada de prueba
+    reloj.ahora = 30.0
+    assert health.disponible()
+    assert health.estado == SEMIABIERTO
+    assert not health.disponible()
+
+    health.registrar_exito()
+    assert health.estado == CERRADO and health.disponible()
+    assert health.metricas()["aperturas"] == 1
+
+
+def test_circuito_vuelve_a_abrirse_si_falla_la_prueba():
+    health, reloj, _ = circuito(umbral_fallos=1)
+    health.registrar_fallo("timeout")
+    reloj.ahora = 30.0
+    assert health.disponible()
+
+    health.registrar_fallo("timeout")
+    assert health.estado == ABIERTO
+    # La espera empieza de nuevo desde el fallo de la prueba
+    reloj.ahora = 59.0
+    assert not health.disponible()
+    reloj.ahora = 60.0
+    assert health.disponible()
+
+
+def test_un_sondeo_fallido_alarga_la_espera_y_uno_correcto_cierra():
+    health, reloj, sonda = circuito(umbral_fallos=1)
+    health.registrar_fallo("timeout")
+
+    reloj.ahora = 20.0
+    sonda.correcto = False
+    assert not health.sondear()
+    # Sin el sondeo fallido se habría probado a los 30 segundos
+    reloj.ahora = 45.0
+    assert not health.disponible()
+    reloj.ahora = 50.0
+    assert health.estado == ABIERTO and health.disponible()
+
+    health.registrar_fallo("timeout")
+    sonda.correcto = True
+    assert health.sondear()
+    assert health.estado == CERRADO
+    assert health.metricas()["sondeos"] == 2 and health.metricas()["sondeos_fallidos"] == 1
+    assert sonda.llamadas == 2
+
+
+def test_health_responde_503_con_el_circuito_abierto(memoria):
+    async def estado():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test") as http:
+            return await http.get("/health")
+
+    for _ in range(memoria.health.umbral_fallos):
+        memoria.health.registrar_fallo("timeout")
+    respuesta = asyncio.run(estado())
+    assert respuesta.status_code == 503
+    assert respuesta.json()["estado"] == ABIERTO
+    assert respuesta.json()["cola"]["pendientes"] == 0
+
+    memoria.health.registrar_exito()
+    respuesta = asyncio.run(estado())
+    assert respuesta.status_code == 200
+    assert respuesta.json()["estado"] == CERRADO
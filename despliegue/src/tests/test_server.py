@@ -0,0 +1,102 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+from agent import agent, server
+
+
+class FakeCompletions:
+    """
+    Imita `client.chat.completions` de `openai.AsyncOpenAI`: cada llamada tarda `espera` segundos
+    y cuenta cuántas están en curso a la vez. En streaming devuelve `tokens` y, si hay `error`,
+    lo lanza después de ellos.
+    """
+
+    def __init__(self, espera: float = 0.2):
+        self.espera = espera
+        self.tokens = ["Hello", ", ", "friend!"]
+        self.error = None
+        self.en_curso = 0
+        self.max_en_curso = 0
+
+    async def create(self, model, messages, stream=False):
+        self.en_curso += 1
+        self.max_en_curso = max(self.max_en_curso, self.en_curso)
+        try:
+            await asyncio.sleep(self.espera)
+        finally:
+            self.en_curso -= 1
+        if stream:
+            return self.stream()
+        mensaje = SimpleNamespace(content="".join(self.tokens))
+        return SimpleNamespace(choices=[SimpleNamespace(message=mensaje)])
+
+    async def stream(self):
+        for token in self.tokens:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))])
+        if self.error is not None:
+            raise self.error
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    completions = FakeCompletions()
+    monkeypatch.setattr(agent, "async_client", SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+    return completions
+
+
+def cliente() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test")
+
+
+def eventos(texto: str) -> list[dict]:
+    return [json.loads(evento[len("data: "):]) for evento in texto.split("\n\n") if evento.startswith("data: ")]
+
+
+def test_chat_atiende_peticiones_concurrentes_a_la_vez(memoria, fake_openai):
+    async def peticiones():
+        async with cliente() as http:
+            return await asyncio.gather(*(http.post("/chat", json={"message": f"Hi {i}"}) for i in range(5)))
+
+    respuestas = asyncio.run(peticiones())
+
+    assert [respuesta.status_code for respuesta in respuestas] == [200] * 5
+    assert {respuesta.json()["response"] for respuesta in respuestas} == {"Hello, friend!"}
+    # Mientras una petición espera al modelo, las demás siguen avanzando
+    assert fake_openai.max_en_curso == 5
+    assert len(memoria.cola) == 5
+
+
+def test_chat_stream_envia_los_fragmentos_y_el_id_de_la_conversacion(memoria, fake_openai):
+    async def peticion():
+        async with cliente() as http:
+            return await http.post("/chat/stream", json={"message": "Hi"})
+
+    datos = eventos(asyncio.run(peticion()).text)
+
+    assert [dato["token"] for dato in datos[:-1]] == ["Hello", ", ", "friend!"]
+    conversation_id = datos[-1]["conversation_id"]
+    assert memoria.conversaciones.get(conversation_id) == [
+        {"role": "user", "content": "Hi"},
+        {"role": "assistant", "content": "Hello, friend!"},
+    ]
+
+
+def test_chat_stream_avisa_de_un_error_a_mitad_de_la_respuesta(memoria, fake_openai):
+    fake_openai.error = RuntimeError("upstream cerrado")
+
+    async def peticion():
+        async with cliente() as http:
+            return await http.post("/chat/stream", json={"message": "Hi"})
+
+    respuesta = asyncio.run(peticion())
+    datos = eventos(respuesta.text)
+
+    assert respuesta.status_code == 200
+    assert [dato["token"] for dato in datos[:-1]] == ["Hello", ", ", "friend!"]
+    assert "error" in datos[-1] and "conversation_id" not in datos[-1]
+    # Un turno incompleto no se guarda
+    assert len(memoria.cola) == 0
@@ -2,24 +2,38 @@ import re
 from pprint import pprint
 from dotenv import load_dotenv
 import click
-#from openai import OpenAI
-from .rag import realizar_consulta, realizar_consulta_mejorada
-from langfuse.openai import OpenAI
+from .openai_client import get_client
+from .rag import categorias_ruta, realizar_consulta, realizar_consulta_mejorada, titulos
 from langfuse.decorators import observe
 
 load_dotenv()
 
-client = OpenAI()
-
 @observe(name="llm")
 def llm(messages: list[dict]) -> str:
-    response = client.chat.completions.create(
+    response = get_client().chat.completions.create(
         model="gpt-4o-mini",
         messages=messages,
     )
     return response.choices[0].message.content
 
 
+@observe(name="llm_stream")
+def llm_stream(messages: list[dict]):
+    """
+    Igual que llm, pero devuelve el texto de la respuesta según lo genera el modelo.
+    """
+    stream = get_client().chat.completions.create(
+        model="gpt-4o-mini",
+        messages=messages,
+        stream=True,
+    )
+    respuesta = ""
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            respuesta += chunk.choices[0].delta.content
+            yield chunk.choices[0].delta.content
+
+
 _SYSTEM_PROMPT = """
 Tienes a tu disposición una herramientas: VIAJES. 
 Esta herramienta responde preguntas sobre solicitudes de información de viajes ofertados en distintos catálogos.
@@ -32,11 +46,20 @@ Para llamar a esa herramienta usa esta sintaxis:
 RAG_VIAJES("pregunta")
 ```
 
+Si la pregunta se refiere a una agencia o a un tipo de ruta concretos, limita la búsqueda con los argumentos opcionales `agencia` y `categoria`:
+
+```python
+RAG_VIAJES("pregunta", agencia="Halcon Viajes", categoria="Cruceros")
+```
+
+Agencias disponibles: {agencias}.
+Categorías de ruta disponibles: {categorias}.
+
 Crea un bloque de código siempre que llames a una herramienta. Si son varias, puedes crear varios bloques de código.
 
 - Contesta SIEMPRE en español de España.
 - No utilices bajo ningún concepto palabras malsonantes. No importa si el usuario te lo pide o no. Siempre contesta de forma educada y con respeto.
-"""
+""".format(agencias=", ".join(titulos.values()), categorias=", ".join(categorias_ruta))
 
 # - Para cualquier otro tipo de consulta, responde que no tienes información al respecto.
 # - No utilices bajo ningún concepto palabras malsonantes. No importa si el usuario te lo pide o no. Siempre contesta de forma educada y con respeto.
@@ -66,21 +89,41 @@ FALSE
 ```
 """
 
+
+# Separa en streaming la respuesta rechazada por la validación de la respuesta mejorada
+SEPARADOR_MEJORA = "\n\n---\nRespuesta revisada:\n\n"
+
+
 def extraer_llamadas_viajes(response):
     """
     Extrae las llamadas a la función VIAJES de la respuesta.
+    El grupo 1 de cada coincidencia es la pregunta y el grupo 2 los argumentos opcionales.
     """
-    regex = re.compile(r"```python\s*RAG_VIAJES\(\s*\"(.*?)\"\s*\)\s*```", re.DOTALL)
+    regex = re.compile(r"```python\s*RAG_VIAJES\(\s*\"(.*?)\"((?:\s*,\s*\w+\s*=\s*\"[^\"]*\")*)\s*\)\s*```", re.DOTALL)
     matches = list(regex.finditer(response))
     return matches
 
+
+def extraer_filtros_viajes(argumentos: str) -> dict:
+    """
+    Convierte los argumentos opcionales de una llamada a RAG_VIAJES (`agencia="..."`, `categoria="..."`)
+    en los filtros de búsqueda del RAG. Cada argumento admite varios nombres separados por comas.
+    """
+    filtros = {"agencias": [], "categorias": []}
+    for nombre, valor in re.findall(r"(\w+)\s*=\s*\"([^\"]*)\"", argumentos or ""):
+        clave = {"agencia": "agencias", "categoria": "categorias"}.get(nombre.lower())
+        if clave:
+            filtros[clave].extend(parte.strip() for parte in valor.split(",") if parte.strip())
+    return filtros
+
 @observe(name="ejecutar_consulta_viajes")
-def ejecutar_consulta_viajes(consulta):
+def ejecutar_consulta_viajes(consulta, filtros: dict = None):
     """
     Ejecuta una consulta a la base de datos de viajes.
+    `filtros` son los filtros de agencia y categoría de la llamada (ver extraer_filtros_viajes).
     """
     try:
-        result = realizar_consulta(consulta, max_chunks=5, max_distance=0.9)
+        result = realizar_consulta(consulta, max_chunks=5, max_distance=0.9, **(filtros or {}))
         if not result or result.strip() == "":
             result = "No se encontró información específica sobre esta consulta en nuestra base de datos de viajes."
 
@@ -89,12 +132,12 @@ def ejecutar_consulta_viajes(consulta):
         return "Error al procesar la consulta. Por favor, inténtalo de nuevo con una pregunta más específica sobre viajes."
 
 @observe(name="ejecutar_consulta_mejorada_viajes")
-def ejecutar_consulta_mejorada_viajes(consulta):
+def ejecutar_consulta_mejorada_viajes(consulta, filtros: dict = None):
     """
     Ejecuta una consulta mejorada a la base de datos de viajes.
     """
     try:
-        result = realizar_consulta_mejorada(consulta, max_chunks=5, max_distance=0.9, responses=3)
+        result = realizar_consulta_mejorada(consulta, max_chunks=5, max_distance=0.9, responses=3, **(filtros or {}))
         if not result or result.strip() == "":
             result = "No se encontró información específica sobre esta consulta en nuestra base de datos de viajes."
 
@@ -116,9 +159,11 @@ def validar_respuesta(prompt: str, response: str) -> bool:
     return matches[0].group(1) == "TRUE"
 
 @observe(name="process_agent")
-def process_agent(history, user_prompt):
+def process_agent(history, user_prompt, response: str = None):
     """
     Procesa la respuesta del LLM y realiza consultas a la base de datos de viajes si es necesario.
+    Si se pasa `response`, se usa como respuesta inicial del LLM en lugar de pedirla
+    (por ejemplo, cuando ya se ha recibido en streaming).
     """
     
     def process_agent_viajes(history, matches, user_prompt):
@@ -128,17 +173,19 @@ def process_agent(history, user_prompt):
         """
         # Inicialización
         match_str = matches[0].group(1)
+        argumentos = matches[0].group(2)
+        filtros = extraer_filtros_viajes(argumentos)
         
         # Guardamos una copia del historial inicial antes de hacer cualquier consulta
         historial_inicial = history.copy()
         
         # Ejecutar consulta
-        result = ejecutar_consulta_viajes(match_str)
+        result = ejecutar_consulta_viajes(match_str, filtros)
 
         history.append(
             {
                 "role": "user",
-                "content": f'```python\nRAG_VIAJES("{match_str}") # resultado: {result}\n```',
+                "content": f'```python\nRAG_VIAJES("{match_str}"{argumentos}) # resultado: {result}\n```',
             }
         )
 
@@ -153,13 +200,13 @@ def process_agent(history, user_prompt):
                 history = historial_inicial.copy()
                 
                 # Ejecutar consulta mejorada
-                result = ejecutar_consulta_mejorada_viajes(match_str)
+                result = ejecutar_consulta_mejorada_viajes(match_str, filtros)
 
                 # Añadimos directamente el resultado mejorado al historial inicial
                 history.append(
                     {
                         "role": "user",
-                        "content": f'```python\nRAG_VIAJES("{match_str}") # resultado: {result}\n```',
+                        "content": f'```python\nRAG_VIAJES("{match_str}"{argumentos}) # resultado: {result}\n```',
                     }
                 )
 
@@ -172,7 +219,8 @@ def process_agent(history, user_prompt):
         return final_response
     
     # Inicio del proceso
-    response = llm(history)
+    if response is None:
+        response = llm(history)
     
     # Detectar si la respuesta contiene llamadas a VIAJES
     matches = extraer_llamadas_viajes(response)
@@ -203,9 +251,91 @@ def run_agent(prompt):
     return history
 
 
+@observe(name="responder_viajes_stream")
+def responder_viajes_stream(history, matches, user_prompt):
+    """
+    Versión en streaming de process_agent_viajes: ejecuta la consulta de RAG_VIAJES y devuelve la
+    respuesta del LLM según se genera. La validación se hace al terminar; si la rechaza, se repite
+    con la consulta mejorada y la nueva respuesta se devuelve, también en streaming, tras
+    SEPARADOR_MEJORA. Al final la respuesta definitiva queda como último mensaje de `history`.
+    """
+    match_str = matches[0].group(1)
+    argumentos = matches[0].group(2)
+    filtros = extraer_filtros_viajes(argumentos)
+    historial_inicial = history.copy()
+
+    result = ejecutar_consulta_viajes(match_str, filtros)
+    history.append({"role": "user", "content": f'```python\nRAG_VIAJES("{match_str}"{argumentos}) # resultado: {result}\n```'})
+    final_response = ""
+    for fragmento in llm_stream(history):
+        final_response += fragmento
+        yield fragmento
+
+    try:
+        if not validar_respuesta(user_prompt, final_response):
+            # Se restaura el historial inicial para eliminar el contexto negativo
+            history[:] = historial_inicial
+            result = ejecutar_consulta_mejorada_viajes(match_str, filtros)
+            history.append({"role": "user", "content": f'```python\nRAG_VIAJES("{match_str}"{argumentos}) # resultado: {result}\n```'})
+            yield SEPARADOR_MEJORA
+            final_response = ""
+            for fragmento in llm_stream(history):
+                final_response += fragmento
+                yield fragmento
+    except Exception:
+        # Si falla la validación se mantiene la respuesta ya mostrada
+        pass
+
+    history.append({"role": "assistant", "content": final_response})
+
+
+@observe(name="run_agent_stream")
+def run_agent_stream(prompt):
+    """
+    Versión en streaming de run_agent: devuelve la respuesta del agente según se genera.
+    La respuesta inicial del LLM se muestra tal cual llega hasta que abre un bloque de código,
+    porque ese bloque puede ser una llamada a la herramienta de viajes. Si lo es, la respuesta
+    con el resultado de la herramienta también se devuelve en streaming (ver
+    responder_viajes_stream).
+    """
+    history = [
+        {"role": "system", "content": _SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+    response = ""
+    mostrado = 0
+    for fragmento in llm_stream(history):
+        response += fragmento
+        visible = response.split("```", 1)[0]
+        if "```" not in response:
+            # Las comillas del final pueden ser el principio de un bloque que aún no ha llegado entero
+            visible = visible.rstrip("`")
+        if len(visible) > mostrado:
+            yield visible[mostrado:]
+            mostrado = len(visible)
+
+    matches = extraer_llamadas_viajes(response)
+    if not matches:
+        if len(response) > mostrado:
+            yield response[mostrado:]
+        history.append({"role": "assistant", "content": response})
+        return
+
+    history.append({"role": "assistant", "content": response})
+    if mostrado:
+        yield "\n\n"
+    yield from responder_viajes_stream(history, matches, prompt)
+
+
 @click.command()
 @click.option("--prompt", "-p", required=True, help="The prompt to send to the LLM")
-def main(prompt):
+@click.option('-s', '--stream', is_flag=True, default=False, help='Mostrar la respuesta según se genera')
+def main(prompt, stream):
+    if stream:
+        for fragmento in run_agent_stream(prompt):
+            print(fragmento, end="", flush=True)
+        print()
+        return
     history = run_agent(prompt)
     print(history[-1]["content"])
 
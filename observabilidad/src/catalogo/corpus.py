@@ -0,0 +1,123 @@
+import bisect
+import hashlib
+import mmap
+from array import array
+from pathlib import Path
+
+
+class Corpus:
+    """
+    Acceso a los archivos del catálogo sin cargarlos en memoria como cadenas de Python.
+
+    Cada archivo se proyecta en memoria con `mmap` (solo lectura) la primera vez que se usa, así
+    que sus páginas las gestiona el sistema operativo y no ocupan memoria del proceso mientras no
+    se leen. Los fragmentos se manejan como vistas (archivo, inicio, longitud) y su texto solo se
+    decodifica cuando se pide con `texto`.
+
+    Las posiciones se expresan en caracteres del archivo decodificado, igual que en la tabla
+    `chunks`. Para traducirlas a bytes se guarda, por cada archivo, dónde empieza cada línea en
+    caracteres y en bytes; el índice se rellena al recorrer el archivo con `lineas`.
+
+    Args:
+        archivos (dict): Nombre del archivo -> su ruta (`Path`) o su contenido (str). El contenido
+            se codifica en UTF-8 y se guarda tal cual, para poder usar el mismo código en pruebas.
+    """
+
+    def __init__(self, archivos: dict):
+        self.archivos = dict(archivos)
+        self.datos = {}
+        self.indices = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cerrar()
+
+    def __iter__(self):
+        return iter(self.archivos)
+
+    def __len__(self):
+        return len(self.archivos)
+
+    def __contains__(self, archivo):
+        return archivo in self.archivos
+
+    def buffer(self, archivo: str):
+        """
+        Devuelve los bytes del archivo: una proyección `mmap` para las rutas y los bytes del
+        contenido para las cadenas.
+        """
+        if archivo not in self.datos:
+            origen = self.archivos[archivo]
+            if isinstance(origen, Path):
+                with open(origen, "rb") as file:
+                    tamano = file.seek(0, 2)
+                    # mmap no admite archivos vacíos
+                    self.datos[archivo] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if tamano else b""
+            else:
+                self.datos[archivo] = origen.encode("utf-8")
+        return self.datos[archivo]
+
+    def hash(self, archivo: str) -> str:
+        """
+        Calcula el hash del archivo directamente sobre sus bytes, sin decodificarlo. Coincide con
+        `get_text_hash` de su contenido.
+        """
+        return hashlib.md5(self.buffer(archivo)).hexdigest()
+
+    def lineas(self, archivo: str):
+        """
+        Recorre las líneas del archivo decodificando solo la línea actual. Al terminar el
+        recorrido queda construido el índice de posiciones del archivo.
+
+        Yields:
+            str: Cada línea, con su salto de línea.
+        """
+        datos = self.buffer(archivo)
+        inicios_caracteres, inicios_bytes = array("q"), array("q")
+        caracteres = posicion = 0
+        while posicion < len(datos):
+            fin = datos.find(b"\n", posicion) + 1 or len(datos)
+            linea = datos[posicion:fin].decode("utf-8")
+            inicios_caracteres.append(caracteres)
+            inicios_bytes.append(posicion)
+            yield linea
+            caracteres += len(linea)
+            posicion = fin
+        self.indices[archivo] = (inicios_caracteres, inicios_bytes)
+
+    def byte_de(self, archivo: str, caracter: int) -> int:
+        """
+        Traduce una posición en caracteres del archivo a su posición en bytes.
+        """
+        if archivo not in self.indices:
+            for _ in self.lineas(archivo):
+                pass
+        inicios_caracteres, inicios_bytes = self.indices[archivo]
+        i = bisect.bisect_right(inicios_caracteres, caracter) - 1
+        if i < 0:
+            return 0
+        datos = self.buffer(archivo)
+        fin = datos.find(b"\n", inicios_bytes[i]) + 1 or len(datos)
+        linea = datos[inicios_bytes[i]:fin].decode("utf-8")
+        return inicios_bytes[i] + len(linea[:caracter - inicios_caracteres[i]].encode("utf-8"))
+
+    def texto(self, archivo: str, inicio: int, longitud: int) -> str:
+        """
+        Decodifica el trozo del archivo que empieza en `inicio` y tiene `longitud` caracteres.
+        """
+        if longitud <= 0:
+            return ""
+        datos = self.buffer(archivo)
+        return datos[self.byte_de(archivo, inicio):self.byte_de(archivo, inicio + longitud)].decode("utf-8")
+
+    def cerrar(self):
+        """
+        Libera las proyecciones en memoria de los archivos.
+        """
+        for datos in self.datos.values():
+            if isinstance(datos, mmap.mmap):
+                datos.close()
+        self.datos.clear()
+        self.indices.clear()
@@ -0,0 +1,91 @@
+import os
+import threading
+import httpx
+import openai
+from langfuse.openai import OpenAI
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Configuración por defecto del cliente compartido. Se puede ajustar con variables de entorno
+# o llamando a configurar_cliente().
+configuracion = {
+    "timeout": float(os.environ.get("OPENAI_TIMEOUT", 60)),
+    "connect_timeout": float(os.environ.get("OPENAI_CONNECT_TIMEOUT", 5)),
+    "max_retries": int(os.environ.get("OPENAI_MAX_RETRIES", 3)),
+    "max_connections": int(os.environ.get("OPENAI_MAX_CONNECTIONS", 20)),
+    "keepalive_expiry": float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", 60)),
+    "base_url": None,
+    "transport": None,
+}
+
+client = None
+lock = threading.Lock()
+
+
+def crear_cliente() -> OpenAI:
+    """
+    Crea un cliente de OpenAI con un pool de conexiones keep-alive según la configuración actual.
+
+    Returns:
+        OpenAI: Cliente de OpenAI.
+
+    Raises:
+        ValueError: Si no se encuentra la API key de OpenAI.
+    """
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("No se encontró la API key de OpenAI. Configúrela en el archivo .env")
+
+    limits = httpx.Limits(
+        max_connections=configuracion["max_connections"],
+        max_keepalive_connections=configuracion["max_connections"],
+        keepalive_expiry=configuracion["keepalive_expiry"],
+    )
+    http_client = openai.DefaultHttpxClient(
+        limits=limits,
+        transport=configuracion["transport"],
+    )
+    return OpenAI(
+        api_key=api_key,
+        base_url=configuracion["base_url"],
+        http_client=http_client,
+        max_retries=configuracion["max_retries"],
+        timeout=httpx.Timeout(configuracion["timeout"], connect=configuracion["connect_timeout"]),
+    )
+
+
+def get_client() -> OpenAI:
+    """
+    Devuelve el cliente de OpenAI compartido por todo el proceso, creándolo la primera vez.
+    Todas las llamadas reutilizan el mismo pool de conexiones, sin repetir el handshake TLS.
+
+    Returns:
+        OpenAI: Cliente de OpenAI compartido.
+    """
+    global client
+    if client is None:
+        with lock:
+            if client is None:
+                client = crear_cliente()
+    return client
+
+
+def configurar_cliente(**opciones):
+    """
+    Cambia la configuración del cliente compartido y lo descarta para que se vuelva a crear.
+    Permite inyectar un transporte de httpx, por ejemplo para apuntar a un servidor local en pruebas.
+
+    Args:
+        **opciones: Claves de `configuracion` a modificar (timeout, connect_timeout, max_retries,
+            max_connections, keepalive_expiry, base_url o transport).
+    """
+    global client
+    desconocidas = set(opciones) - set(configuracion)
+    if desconocidas:
+        raise ValueError(f"Opciones desconocidas para el cliente de OpenAI: {sorted(desconocidas)}")
+    with lock:
+        configuracion.update(opciones)
+        if client is not None:
+            client.close()
+        client = None
@@ -0,0 +1,144 @@
+import os
+import sqlite3
+import tempfile
+import time
+import click
+import numpy as np
+import sqlite_vec
+from .retriever import IndiceExacto, IndiceIVFPQ, Retriever, crear_esquema, insertar_chunks
+
+
+def get_module_dir():
+    """
+    Obtiene el directorio donde se encuentra este módulo.
+
+    Returns:
+        str: Ruta absoluta al directorio del módulo.
+    """
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+def crear_db_sintetica(db_path: str, n: int, dimension: int = 1536, grupos: int = 200, ruido: float = 0.3, semilla: int = 0):
+    """
+    Crea las tablas del índice con vectores sintéticos agrupados, parecidas a las de un catálogo real.
+
+    Args:
+        db_path (str): Ruta de la base de datos a crear.
+        n (int): Número de vectores.
+        dimension (int): Dimensión de los vectores.
+        grupos (int): Número de grupos alrededor de los que se generan los vectores.
+        ruido (float): Dispersión de cada grupo.
+        semilla (int): Semilla del generador aleatorio.
+    """
+    rng = np.random.default_rng(semilla)
+    centros = rng.normal(size=(grupos, dimension))
+    vectores = centros[rng.integers(0, grupos, n)] + ruido * rng.normal(size=(n, dimension))
+    vectores = (vectores / np.linalg.norm(vectores, axis=1, keepdims=True)).astype(np.float32)
+
+    conn = sqlite3.connect(db_path)
+    conn.enable_load_extension(True)
+    sqlite_vec.load(conn)
+    conn.enable_load_extension(False)
+    crear_esquema(conn, dimension)
+    insertar_chunks(conn, (
+        ("", "", "", 0, 0, str(i), f"chunk {i}", vector.tobytes())
+        for i, vector in enumerate(vectores)
+    ))
+    conn.commit()
+    conn.close()
+
+
+def buscar_sqlite_vec(db_path: str, consultas: np.ndarray, k: int) -> tuple[list[list[int]], float]:
+    """
+    Resuelve las consultas con la búsqueda exacta de `vec0`, que sirve de referencia.
+
+    Returns:
+        tuple: Las posiciones (en orden de rowid) de los `k` vecinos de cada consulta y la latencia media en ms.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.enable_load_extension(True)
+    sqlite_vec.load(conn)
+    conn.enable_load_extension(False)
+    posiciones = {rowid: i for i, (rowid,) in enumerate(conn.execute("SELECT rowid FROM embeddings ORDER BY rowid"))}
+
+    resultados = []
+    inicio = time.perf_counter()
+    for consulta in consultas:
+        rows = conn.execute(
+            "SELECT rowid FROM embeddings WHERE embedding MATCH ? AND k = ? ORDER BY distance",
+            (consulta.tobytes(), k),
+        ).fetchall()
+        resultados.append([posiciones[rowid] for rowid, in rows])
+    latencia = (time.perf_counter() - inicio) * 1000 / len(consultas)
+    conn.close()
+    return resultados, latencia
+
+
+def medir(indice, consultas: np.ndarray, referencia: list[list[int]], k: int) -> tuple[float, float]:
+    """
+    Mide el recall@k y la latencia media de un backend frente a los resultados de referencia.
+
+    Returns:
+        tuple: El recall@k medio y la latencia media en ms.
+    """
+    aciertos = 0
+    inicio = time.perf_counter()
+    resultados = [indice.buscar(consulta, k)[0] for consulta in consultas]
+    latencia = (time.perf_counter() - inicio) * 1000 / len(consultas)
+    for encontrados, esperados in zip(resultados, referencia):
+        aciertos += len(set(encontrados.tolist()) & set(esperados))
+    return aciertos / (k * len(consultas)), latencia
+
+
+@click.command()
+@click.option('--db-path', default=None, help='Base de datos de embeddings (por defecto la del catálogo)')
+@click.option('-n', '--sinteticos', default=0, help='Usar N vectores sintéticos en una base de datos temporal')
+@click.option('--dimension', default=1536, help='Dimensión de los vectores sintéticos')
+@click.option('-q', '--consultas', 'num_consultas', default=100, help='Número de consultas de prueba')
+@click.option('-k', '--top-k', default=5, help='Número de vecinos por consulta')
+@click.option('--nlist', default=0, help='Listas del índice IVF-PQ (0 = automático)')
+@click.option('--nprobe', multiple=True, type=int, default=(1, 4, 8, 16, 32), help='Listas recorridas por consulta (se puede repetir)')
+@click.option('--pq-m', default=16, help='Subespacios de la cuantización por producto')
+@click.option('--refinar', default=10, help='Factor de candidatos reordenados con la distancia exacta')
+def main(db_path, sinteticos, dimension, num_consultas, top_k, nlist, nprobe, pq_m, refinar):
+    """Compara recall y latencia de los índices en memoria con la búsqueda exacta de sqlite-vec."""
+
+    with tempfile.TemporaryDirectory() as directorio:
+        if sinteticos:
+            db_path = os.path.join(directorio, "embeddings.db")
+            crear_db_sintetica(db_path, sinteticos, dimension)
+        db_path = db_path or os.path.join(get_module_dir(), "embeddings.db")
+
+        matriz, ids, _, _ = Retriever(db_path).cargar()
+        if not len(ids):
+            raise click.ClickException(f"No hay embeddings en {db_path}")
+
+        # Consultas cercanas a vectores del propio catálogo, como las preguntas sobre un viaje concreto
+        rng = np.random.default_rng(1)
+        consultas = matriz[rng.choice(len(matriz), num_consultas)]
+        consultas = consultas + 0.5 * rng.normal(size=consultas.shape) / np.sqrt(matriz.shape[1])
+        consultas = (consultas / np.linalg.norm(consultas, axis=1, keepdims=True)).astype(np.float32)
+
+        referencia, latencia_vec = buscar_sqlite_vec(db_path, consultas, top_k)
+        print(f"{len(ids)} vectores de dimensión {matriz.shape[1]}, {num_consultas} consultas, k={top_k}")
+        print(f"{'índice':<10}{'parámetros':<36}{'recall':>8}{'ms/consulta':>14}")
+        print(f"{'sqlite-vec':<10}{'':<36}{1.0:>8.3f}{latencia_vec:>14.3f}")
+
+        exacto = IndiceExacto()
+        exacto.construir(matriz)
+        recall, latencia = medir(exacto, consultas, referencia, top_k)
+        print(f"{'exacto':<10}{'':<36}{recall:>8.3f}{latencia:>14.3f}")
+
+        inicio = time.perf_counter()
+        ivfpq = IndiceIVFPQ(nlist=nlist, pq_m=pq_m, refinar=refinar)
+        ivfpq.construir(matriz)
+        print(f"IVF-PQ construido en {time.perf_counter() - inicio:.2f} s con {len(ivfpq.centroides)} listas")
+        for valor in nprobe:
+            ivfpq.nprobe = valor
+            recall, latencia = medir(ivfpq, consultas, referencia, top_k)
+            parametros = f"nprobe={valor} pq_m={pq_m} refinar={refinar}"
+            print(f"{'ivfpq':<10}{parametros:<36}{recall:>8.3f}{latencia:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,29 @@
 import os
-import openai
 from dotenv import load_dotenv
 import glob
 from pathlib import Path
 from tqdm import tqdm
 import sqlite3
 import sqlite_vec
+import tiktoken
 import json
 import hashlib
+import io
+import unicodedata
 import click
+import asyncio
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 import re
+import numpy as np
+from .openai_client import get_client
+from .corpus import Corpus
+from .retriever import Retriever, crear_esquema, indices, insertar_chunks
+from .reordenador import reordenadores
 
 load_dotenv()
 
@@ -45,31 +59,252 @@ titulos = {
     }
 
 
-def chunker(text: str, filename: str = "", chunk_size: int = 2000, overlap: int = 400) -> list[str]:
+def agencia_de(filename: str) -> str:
     """
-    Divide un texto en fragmentos de un tamaño especificado, con un solapamiento entre fragmentos.
-    Añade el nombre del archivo como primera línea de cada fragmento.
+    Devuelve el nombre de la agencia de un archivo del catálogo, o el propio nombre del archivo
+    si no está en `titulos` (por ejemplo, un catálogo nuevo).
+    """
+    return titulos.get(filename, filename)
+
+# Categorías de ruta en las que se organizan todos los catálogos. Cada fragmento pertenece a la
+# categoría de la última sección del archivo que empieza antes que él.
+categorias_ruta = [
+    "Islas",
+    "Escapadas nacionales",
+    "Rutas nacionales",
+    "Rutas por Portugal",
+    "Ciudades internacionales",
+    "Rutas exprés internacionales",
+    "Mercadillos navideños",
+    "Rutas internacionales",
+    "Grandes viajes",
+    "Cruceros",
+]
+
+def normalizar_nombre(texto: str) -> str:
+    """
+    Pasa un nombre a minúsculas, sin tildes y sin espacios repetidos, para comparar
+    nombres de agencias o categorías escritos de distintas formas.
+    """
+    sin_tildes = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode()
+    return " ".join(sin_tildes.lower().split())
+
+# Encabezados de sección de los catálogos (normalizados) y la categoría a la que corresponden
+encabezados_categoria = {normalizar_nombre(categoria): categoria for categoria in categorias_ruta}
+encabezados_categoria.update({
+    "rutas express internacionales": "Rutas exprés internacionales",
+    "mercadillos navidenos internacionales": "Mercadillos navideños",
+})
+
+def categoria_de_encabezado(linea: str) -> str:
+    """
+    Devuelve la categoría de ruta si la línea es un encabezado de sección del catálogo,
+    o una cadena vacía si no lo es.
+    """
+    if len(linea) >= 60:
+        return ""
+    return encabezados_categoria.get(normalizar_nombre(linea.strip("#* \n")), "")
+
+def resolver_filtro(nombres: list[str], validos: list[str]) -> list[str]:
+    """
+    Traduce los nombres de agencias o categorías que escribe el usuario (o el LLM) a los nombres
+    exactos del índice, sin distinguir mayúsculas ni tildes. Si un nombre no coincide con ninguno,
+    se buscan los nombres válidos que lo contienen (por ejemplo, "Carrefour" → "B Travel | Carrefour Viajes").
+
+    Args:
+        nombres (list[str]): Los nombres pedidos. None o vacío para no filtrar.
+        validos (list[str]): Los nombres que existen en el índice.
+
+    Returns:
+        list[str]: Los nombres válidos encontrados, sin repetir. Vacía si no se reconoce ninguno.
+    """
+    resueltos = []
+    for nombre in nombres or []:
+        buscado = normalizar_nombre(nombre)
+        coincidencias = [valido for valido in validos if normalizar_nombre(valido) == buscado]
+        if not coincidencias and buscado:
+            coincidencias = [valido for valido in validos if buscado in normalizar_nombre(valido)]
+        resueltos.extend(valido for valido in coincidencias if valido not in resueltos)
+    return resueltos
+
+# Primera línea de cada fragmento, con el nombre de la agencia del archivo
+prefijo_agencia = "Esto es un fragmento del catálogo de viajes de la agencia: "
+
+# Líneas que abren un bloque del itinerario: encabezados markdown, "ITINERARIO" y "Día N"
+patron_encabezado = re.compile(r"^(#{1,6}\s|\W*(d[ií]as?\s+\d+|itinerario)\b)", re.IGNORECASE)
+# Encabezados markdown de primer y segundo nivel, que siempre empiezan un fragmento nuevo
+patron_seccion = re.compile(r"^#{1,2}\s")
+
+def leer_lineas(text: str):
+    """
+    Recorre las líneas de un texto del catálogo. Para los archivos en disco se usa
+    `Corpus.lineas`, que los lee proyectados en memoria.
+
+    Args:
+        text (str): El contenido del archivo.
+
+    Yields:
+        str: Cada línea, con su salto de línea.
+    """
+    yield from io.StringIO(text)
+
+def cabecera_chunk(filename: str) -> str:
+    """
+    Devuelve la primera línea que se añade a los fragmentos de un archivo, con su agencia.
+    """
+    return f"{prefijo_agencia}{agencia_de(filename)}\n" if filename else ""
+
+def separar_titulo(bloque: list[tuple[int, str]]) -> tuple[list, list]:
+    """
+    Separa del final de un bloque su último párrafo si es corto, como el título de la ruta que
+    precede a su "ITINERARIO", para que acompañe al itinerario y no al bloque anterior.
+    """
+    fin = len(bloque)
+    while fin and not bloque[fin - 1][1].strip():
+        fin -= 1
+    inicio = fin
+    while inicio and bloque[inicio - 1][1].strip():
+        inicio -= 1
+    if inicio and sum(len(linea) for _, linea in bloque[inicio:fin]) < 80:
+        return bloque[:inicio], bloque[inicio:]
+    return bloque, []
+
+def bloques_catalogo(lineas):
+    """
+    Agrupa las líneas de un archivo del catálogo en bloques que empiezan en un encabezado:
+    una sección de categoría, un encabezado markdown, el itinerario de una ruta o un día del itinerario.
+
+    Args:
+        lineas: Las líneas del archivo (por ejemplo, `leer_lineas(origen)`).
+
+    Yields:
+        tuple[str, list[tuple[int, str]], bool]: La categoría del bloque, sus líneas como pares
+            (posición, línea) y si el bloque debe empezar un fragmento nuevo.
+    """
+    categoria = ""
+    bloque = []
+    corte = False
+    posicion = 0
+    for linea in lineas:
+        nueva_categoria = categoria_de_encabezado(linea)
+        if nueva_categoria or patron_encabezado.match(linea):
+            arrastre = []
+            if normalizar_nombre(linea).startswith("itinerario"):
+                bloque, arrastre = separar_titulo(bloque)
+            if bloque:
+                yield categoria, bloque, corte
+            bloque = arrastre
+            corte = bool(nueva_categoria or patron_seccion.match(linea))
+            categoria = nueva_categoria or categoria
+        bloque.append((posicion, linea))
+        posicion += len(linea)
+    if bloque:
+        yield categoria, bloque, corte
+
+def contar_tokens_lineas(lineas: list[tuple[int, str]]) -> int:
+    """
+    Estima los tokens de un grupo de líneas (pares (posición, línea)).
+    """
+    return estimar_tokens("".join(linea for _, linea in lineas))
+
+def partir_bloque(bloque: list[tuple[int, str]], presupuesto: int):
+    """
+    Parte un bloque que no cabe en un fragmento en párrafos, y los párrafos que tampoco caben
+    en líneas o, en último caso, en trozos de línea, sin pasar de `presupuesto` tokens.
+
+    Yields:
+        list[tuple[int, str]]: Cada parte, como pares (posición, texto).
+    """
+    parrafos = [[]]
+    for posicion, linea in bloque:
+        parrafos[-1].append((posicion, linea))
+        if not linea.strip():
+            parrafos.append([])
+    for parrafo in parrafos:
+        if not parrafo:
+            continue
+        if contar_tokens_lineas(parrafo) <= presupuesto:
+            yield parrafo
+            continue
+        for posicion, linea in parrafo:
+            # Las líneas demasiado largas se cortan en el último espacio que cabe
+            paso = max(len(linea) * presupuesto // (estimar_tokens(linea) + 1), 1)
+            inicio = 0
+            while inicio < len(linea):
+                fin = inicio + paso
+                if fin < len(linea):
+                    espacio = linea.rfind(" ", inicio + 1, fin)
+                    if espacio > inicio:
+                        fin = espacio + 1
+                yield [(posicion + inicio, linea[inicio:fin])]
+                inicio = fin
+
+def fragmentar(lineas, filename: str = "", max_tokens: int = 800):
+    """
+    Divide un archivo del catálogo en fragmentos siguiendo su estructura, sin solapamiento.
+    Los cortes se hacen entre rutas y entre días del itinerario (ver `bloques_catalogo`) y los
+    bloques consecutivos se agrupan hasta `max_tokens` tokens estimados, contando la primera
+    línea con la agencia. Solo un bloque que no cabe entero se parte por párrafos. Una sección
+    de categoría nueva siempre empieza un fragmento.
+
+    El archivo se lee línea a línea y cada fragmento se devuelve en cuanto se completa.
+
+    Args:
+        lineas: Las líneas del archivo (por ejemplo, `leer_lineas(origen)`).
+        filename (str): Nombre del archivo de origen, para añadir su agencia a cada fragmento.
+        max_tokens (int): Número máximo de tokens estimados de cada fragmento.
+
+    Yields:
+        tuple[int, int, str, str]: (inicio, longitud, categoría, fragmento), con el inicio y la
+            longitud en caracteres del archivo original.
+    """
+    cabecera = cabecera_chunk(filename)
+    presupuesto = max(max_tokens - estimar_tokens(cabecera), 1)
+    actual = []
+    tokens_actual = 0
+    categoria_actual = ""
+
+    def cerrar():
+        texto = "".join(linea for _, linea in actual)
+        cuerpo = texto.strip()
+        if not cuerpo:
+            return []
+        inicio = actual[0][0] + len(texto) - len(texto.lstrip())
+        return [(inicio, len(cuerpo), categoria_actual, cabecera + cuerpo)]
+
+    for categoria, bloque, corte in bloques_catalogo(lineas):
+        if corte and actual:
+            yield from cerrar()
+            actual, tokens_actual = [], 0
+        tokens_bloque = contar_tokens_lineas(bloque)
+        partes = [(bloque, tokens_bloque)] if tokens_bloque <= presupuesto else [
+            (parte, contar_tokens_lineas(parte)) for parte in partir_bloque(bloque, presupuesto)
+        ]
+        for parte, tokens in partes:
+            if actual and tokens_actual + tokens > presupuesto:
+                yield from cerrar()
+                actual, tokens_actual = [], 0
+            if not actual:
+                categoria_actual = categoria
+            actual.extend(parte)
+            tokens_actual += tokens
+    yield from cerrar()
+
+def chunker(text: str, filename: str = "", max_tokens: int = 800) -> list[str]:
+    """
+    Divide un texto en fragmentos siguiendo la estructura del catálogo (ver `fragmentar`).
+    Añade el nombre de la agencia del archivo como primera línea de cada fragmento.
+    Si el archivo no está en `titulos` (por ejemplo, un catálogo nuevo), se usa su nombre.
 
     Args:
         text (str): El texto a dividir.
         filename (str): Nombre del archivo de origen para incluir en cada fragmento.
-        chunk_size (int): El tamaño de cada fragmento.
-        overlap (int): El número de caracteres solapados entre fragmentos.
+        max_tokens (int): Número máximo de tokens estimados de cada fragmento.
 
     Returns:
-        list[str]: Una lista de fragmentos del texto con el nombre del archivo como primera línea.
+        list[str]: Una lista de fragmentos del texto con el nombre de la agencia como primera línea.
     """
-
-    chunks = []
-    for i in range(0, len(text), chunk_size - overlap):
-        chunk_text = text[i : i + chunk_size]
-        # Añadir el nombre del archivo como primera línea
-        if filename:
-            chunk_with_metadata = f"Esto es un fragmento del catálogo de viajes de la agencia: {titulos[filename]}\n{chunk_text}"
-        else:
-            chunk_with_metadata = chunk_text
-        chunks.append(chunk_with_metadata)
-    return chunks
+    return [chunk for _, _, _, chunk in fragmentar(leer_lineas(text), filename, max_tokens)]
 
 def get_text_hash(text: str) -> str:
     """
@@ -83,27 +318,286 @@ def get_text_hash(text: str) -> str:
     """
     return hashlib.md5(text.encode('utf-8')).hexdigest()
 
-def init_cache_db():
+class CacheLRU:
     """
-    Inicializa la base de datos de caché para embeddings.
-    
+    Caché en memoria con expulsión LRU y caducidad por tiempo (TTL).
+    Lleva la cuenta de aciertos y fallos y es segura para usarse desde varios hilos.
+
+    Args:
+        maxsize (int): Número máximo de entradas.
+        ttl (float): Segundos de vida de cada entrada (0 = sin caducidad).
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.datos = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, clave):
+        """
+        Devuelve el valor asociado a la clave si existe y no ha caducado.
+
+        Args:
+            clave: La clave a buscar.
+
+        Returns:
+            El valor almacenado o None si no está o ha caducado.
+        """
+        with self.lock:
+            entrada = self.datos.get(clave)
+            if entrada is not None:
+                valor, expira = entrada
+                if not expira or expira > time.monotonic():
+                    self.datos.move_to_end(clave)
+                    self.hits += 1
+                    return valor
+                del self.datos[clave]
+            self.misses += 1
+            return None
+
+    def ver(self, clave):
+        """
+        Igual que `get`, pero sin contar el acierto o el fallo ni marcar la entrada como usada.
+        """
+        with self.lock:
+            entrada = self.datos.get(clave)
+            if entrada is not None and (not entrada[1] or entrada[1] > time.monotonic()):
+                return entrada[0]
+            return None
+
+    def put(self, clave, valor):
+        """
+        Guarda un valor, expulsando las entradas menos usadas si se supera el tamaño máximo.
+
+        Args:
+            clave: La clave.
+            valor: El valor a guardar.
+        """
+        with self.lock:
+            self.datos[clave] = (valor, time.monotonic() + self.ttl if self.ttl else 0)
+            self.datos.move_to_end(clave)
+            while len(self.datos) > self.maxsize:
+                self.datos.popitem(last=False)
+
+    def clear(self):
+        """
+        Vacía la caché sin reiniciar los contadores.
+        """
+        with self.lock:
+            self.datos.clear()
+
+    def __len__(self):
+        return len(self.datos)
+
+    def estadisticas(self) -> dict:
+        """
+        Devuelve los contadores de la caché.
+
+        Returns:
+            dict: Aciertos, fallos y número de entradas.
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+def deserialize_float32(blob: bytes) -> list[float]:
+    """
+    Convierte un BLOB de float32 empaquetados (formato de `sqlite_vec.serialize_float32`) en una lista de floats.
+
+    Args:
+        blob (bytes): El vector serializado.
+
     Returns:
-        sqlite3.Connection: Conexión a la base de datos de caché.
+        list[float]: El vector como lista de floats.
     """
-    db_path = os.path.join(get_module_dir(), "embedding_cache.db")
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS embedding_cache (
-            text_hash TEXT PRIMARY KEY, 
-            text TEXT, 
-            embedding BLOB, 
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP)
-    ''')
+    vector = array("f")
+    vector.frombytes(blob)
+    return vector.tolist()
+
+class EmbeddingCache:
+    """
+    Caché persistente de embeddings sobre SQLite.
+
+    Mantiene una única conexión abierta por hilo, en modo WAL y con `synchronous=NORMAL`,
+    de forma que las consultas a la caché no pagan abrir la base de datos ni crear la tabla
+    en cada llamada. Las sentencias se reutilizan gracias a la caché de sentencias de sqlite3.
+
+    Los embeddings se guardan como BLOB de float32 empaquetados, el mismo formato que
+    `sqlite_vec.serialize_float32`, así que un acierto puede insertarse en la tabla `vec0`
+    sin ningún parseo. Las filas antiguas guardadas como JSON se migran al abrir la caché.
+
+    Args:
+        db_path (str): Ruta al fichero de la base de datos de caché.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def conexion(self) -> sqlite3.Connection:
+        """
+        Devuelve la conexión del hilo actual, creándola e inicializando la tabla si no existe.
+
+        Returns:
+            sqlite3.Connection: Conexión a la base de datos de caché.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS embedding_cache (
+                    text_hash TEXT PRIMARY KEY, 
+                    text TEXT, 
+                    embedding BLOB, 
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP)
+            ''')
+            conn.commit()
+            self.migrar_json(conn)
+            self.local.conn = conn
+        return conn
+
+    def migrar_json(self, conn: sqlite3.Connection):
+        """
+        Convierte a BLOB de float32 los embeddings guardados como texto JSON por versiones anteriores.
+        La migración se registra en `PRAGMA user_version` para hacerse una única vez.
+
+        Args:
+            conn (sqlite3.Connection): Conexión a la base de datos de caché.
+        """
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= 1:
+            return
+        with conn:
+            filas = conn.execute(
+                "SELECT text_hash, embedding FROM embedding_cache WHERE typeof(embedding) = 'text'"
+            ).fetchall()
+            conn.executemany(
+                "UPDATE embedding_cache SET embedding = ? WHERE text_hash = ?",
+                ((sqlite_vec.serialize_float32(json.loads(embedding)), text_hash) for text_hash, embedding in filas),
+            )
+            conn.execute("PRAGMA user_version = 1")
+
+    def get(self, text_hash: str):
+        """
+        Busca el embedding de un hash en la caché.
+
+        Args:
+            text_hash (str): Hash del texto.
+
+        Returns:
+            list[float]: El embedding almacenado o None si no está en la caché.
+        """
+        row = self.conexion().execute(
+            "SELECT embedding FROM embedding_cache WHERE text_hash = ?", (text_hash,)
+        ).fetchone()
+        self.contar(1 if row else 0, 1)
+        return deserialize_float32(row[0]) if row else None
+
+    def get_many(self, hashes: list[str], serializados: bool = False) -> dict:
+        """
+        Busca de una vez los embeddings de varios hashes.
+        Los hashes se cargan en una tabla temporal y se resuelven con un único JOIN.
+
+        Args:
+            hashes (list[str]): Hashes de los textos.
+            serializados (bool): Si True, devuelve los BLOB de float32 tal cual, sin decodificar.
+
+        Returns:
+            dict: Diccionario hash -> embedding con los hashes encontrados.
+        """
+        conn = self.conexion()
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS hashes_buscados (text_hash TEXT PRIMARY KEY)")
+        conn.execute("DELETE FROM hashes_buscados")
+        conn.executemany("INSERT OR IGNORE INTO hashes_buscados (text_hash) VALUES (?)", ((h,) for h in hashes))
+        rows = conn.execute('''
+            SELECT c.text_hash, c.embedding
+            FROM embedding_cache c
+            JOIN hashes_buscados h ON h.text_hash = c.text_hash
+        ''').fetchall()
+        conn.execute("DELETE FROM hashes_buscados")
+        conn.commit()
+        self.contar(len(rows), len(set(hashes)))
+        if serializados:
+            return dict(rows)
+        return {text_hash: deserialize_float32(embedding) for text_hash, embedding in rows}
+
+    def put(self, text_hash: str, text: str, embedding: list[float]):
+        """
+        Guarda un embedding en la caché.
+
+        Args:
+            text_hash (str): Hash del texto.
+            text (str): El texto.
+            embedding (list[float]): El embedding del texto.
+        """
+        self.put_many([(text_hash, text, embedding)])
+
+    def put_many(self, filas: list[tuple]):
+        """
+        Guarda varios embeddings en la caché en una sola transacción.
+
+        Args:
+            filas (list[tuple]): Tuplas (text_hash, text, embedding). El embedding puede ser
+                una lista de floats o un BLOB de float32 ya serializado.
+        """
+        conn = self.conexion()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache (text_hash, text, embedding) VALUES (?, ?, ?)",
+                (
+                    (text_hash, text, embedding if isinstance(embedding, bytes) else sqlite_vec.serialize_float32(embedding))
+                    for text_hash, text, embedding in filas
+                ),
+            )
+
+    def contar(self, encontrados: int, buscados: int):
+        """
+        Actualiza los contadores de aciertos y fallos.
+
+        Args:
+            encontrados (int): Número de hashes encontrados.
+            buscados (int): Número de hashes buscados.
+        """
+        with self.lock:
+            self.hits += encontrados
+            self.misses += buscados - encontrados
+
+    def estadisticas(self) -> dict:
+        """
+        Devuelve los contadores de la caché.
+
+        Returns:
+            dict: Aciertos y fallos acumulados.
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        """
+        Cierra la conexión del hilo actual.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+embedding_caches = {}
+
+def get_cache() -> EmbeddingCache:
+    """
+    Devuelve la caché de embeddings del proceso, creándola la primera vez.
     
-    conn.commit()
-    return conn
+    Returns:
+        EmbeddingCache: Caché de embeddings.
+    """
+    db_path = os.path.abspath(os.path.join(get_module_dir(), "embedding_cache.db"))
+    if db_path not in embedding_caches:
+        embedding_caches[db_path] = EmbeddingCache(db_path)
+    return embedding_caches[db_path]
 
 def load_sqlite_vec(conn):
     """
@@ -132,22 +626,15 @@ def get_embeddings(text: str, debug: bool = False):
         text_hash = get_text_hash(text)
         
         # Verificar si existe en la caché
-        conn = init_cache_db()
-        cursor = conn.cursor()
-        cursor.execute("SELECT embedding FROM embedding_cache WHERE text_hash = ?", (text_hash,))
-        cached_result = cursor.fetchone()
+        cache = get_cache()
+        cached_embedding = cache.get(text_hash)
         
-        if cached_result:
+        if cached_embedding is not None:
             dprint(f"Usando embedding almacenado en caché para el texto: {text[:50]}...", debug)
-            conn.close()
-            return json.loads(cached_result[0])
+            return cached_embedding
         
         # Si no está en caché, generar nuevo embedding
-        api_key = os.environ.get("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("No se encontró la API key de OpenAI. Configúrela en el archivo .env")
-        
-        client = openai.OpenAI(api_key=api_key)
+        client = get_client()
         
         response = client.embeddings.create(
             model="text-embedding-3-small",  # Modelo de embeddings más reciente
@@ -158,87 +645,577 @@ def get_embeddings(text: str, debug: bool = False):
 
         dprint(f"Guardando embedding en caché para el texto: {text[:50]}...", debug)
         # Guardar en caché
-        
-        cursor.execute("INSERT INTO embedding_cache (text_hash, text, embedding) VALUES (?, ?, ?)", 
-                      (text_hash, text, json.dumps(embedding)))
-        conn.commit()
-        conn.close()
+        cache.put(text_hash, text, embedding)
         
         return embedding
     
     except Exception as e:
         print(f"Error al generar embedding: {e}")
-        if 'conn' in locals() and conn:
-            conn.close()
         return None
 
-def populate_embeddings(chunks: list[str], debug: bool = False):
+def estimar_tokens(text: str) -> int:
+    """
+    Estima el número de tokens de un texto sin llamar a ningún tokenizador.
+    Se usa una aproximación conservadora de 3 caracteres por token.
+
+    Args:
+        text (str): El texto a medir.
+
+    Returns:
+        int: Número aproximado de tokens.
+    """
+    return len(text) // 3 + 1
+
+# Tokenizador local del modelo que responde a las consultas. Se carga la primera vez que se usa.
+tokenizador = None
+
+def get_tokenizador():
+    """
+    Devuelve el tokenizador local de GPT-4 (tiktoken), cargándolo la primera vez.
+    Si no se puede cargar (por ejemplo, sin conexión la primera vez que se descarga su vocabulario),
+    devuelve None y los tokens se estiman con `estimar_tokens`.
+    """
+    global tokenizador
+    if tokenizador is None:
+        try:
+            tokenizador = tiktoken.encoding_for_model("gpt-4")
+        except Exception as e:
+            print(f"No se pudo cargar el tokenizador local, se estimará el número de tokens: {str(e)}")
+            tokenizador = False
+    return tokenizador or None
+
+def contar_tokens(text: str) -> int:
+    """
+    Cuenta los tokens de un texto con el tokenizador local de GPT-4.
+
+    Args:
+        text (str): El texto a medir.
+
+    Returns:
+        int: Número de tokens (estimado si el tokenizador no está disponible).
+    """
+    codificador = get_tokenizador()
+    if codificador is None:
+        return estimar_tokens(text)
+    return len(codificador.encode(text, disallowed_special=()))
+
+def recortar_tokens(text: str, max_tokens: int) -> str:
+    """
+    Recorta un texto para que no pase de `max_tokens` tokens.
+    """
+    codificador = get_tokenizador()
+    if codificador is None:
+        return text[: max(max_tokens - 1, 0) * 3]
+    return codificador.decode(codificador.encode(text, disallowed_special=())[:max_tokens])
+
+def agrupar_en_lotes(textos: list[str], batch_size: int = 100, max_batch_tokens: int = 100000) -> list[list[str]]:
+    """
+    Agrupa los textos en lotes para enviarlos en una sola petición de embeddings.
+    Cada lote tiene como máximo `batch_size` textos y `max_batch_tokens` tokens estimados.
+
+    Args:
+        textos (list[str]): Los textos a agrupar.
+        batch_size (int): Número máximo de textos por lote.
+        max_batch_tokens (int): Número máximo de tokens estimados por lote.
+
+    Returns:
+        list[list[str]]: Lista de lotes de textos.
+    """
+    lotes = []
+    lote_actual = []
+    tokens_lote = 0
+    for texto in textos:
+        tokens = estimar_tokens(texto)
+        if lote_actual and (len(lote_actual) >= batch_size or tokens_lote + tokens > max_batch_tokens):
+            lotes.append(lote_actual)
+            lote_actual = []
+            tokens_lote = 0
+        lote_actual.append(texto)
+        tokens_lote += tokens
+    if lote_actual:
+        lotes.append(lote_actual)
+    return lotes
+
+class LimitadorTasa:
+    """
+    Limita las peticiones y los tokens enviados por minuto usando una ventana deslizante.
+    Es seguro usarlo desde varios hilos a la vez.
+
+    Args:
+        rpm (int): Peticiones por minuto permitidas (0 = sin límite).
+        tpm (int): Tokens por minuto permitidos (0 = sin límite).
+        ventana (float): Duración de la ventana en segundos.
+    """
+
+    def __init__(self, rpm: int = 0, tpm: int = 0, ventana: float = 60.0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.ventana = ventana
+        self.eventos = deque()
+        self.tokens_en_ventana = 0
+        self.lock = threading.Lock()
+
+    def adquirir(self, tokens: int = 0):
+        """
+        Bloquea hasta que haya presupuesto para una petición de `tokens` tokens y la registra.
+
+        Args:
+            tokens (int): Tokens estimados de la petición.
+        """
+        while True:
+            with self.lock:
+                ahora = time.monotonic()
+                while self.eventos and ahora - self.eventos[0][0] >= self.ventana:
+                    _, tokens_evento = self.eventos.popleft()
+                    self.tokens_en_ventana -= tokens_evento
+
+                cabe_peticion = not self.rpm or len(self.eventos) < self.rpm
+                # Una petición mayor que el presupuesto completo se deja pasar con la ventana vacía
+                cabe_tokens = not self.tpm or not self.eventos or self.tokens_en_ventana + tokens <= self.tpm
+                if cabe_peticion and cabe_tokens:
+                    self.eventos.append((ahora, tokens))
+                    self.tokens_en_ventana += tokens
+                    return
+                espera = self.ventana - (ahora - self.eventos[0][0])
+            time.sleep(max(espera, 0.01))
+
+def embeddings_lote(client, lote: list[str], limitador: LimitadorTasa) -> list[list[float]]:
+    """
+    Pide a la API de OpenAI los embeddings de un lote de textos respetando el límite de tasa.
+
+    Args:
+        client (OpenAI): Cliente de OpenAI.
+        lote (list[str]): Los textos del lote.
+        limitador (LimitadorTasa): Limitador de peticiones y tokens por minuto.
+
+    Returns:
+        list[list[float]]: Los embeddings en el mismo orden que el lote.
+    """
+    limitador.adquirir(sum(estimar_tokens(texto) for texto in lote))
+    response = client.embeddings.create(
+        model="text-embedding-3-small",  # Modelo de embeddings más reciente
+        input=lote
+    )
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+def get_embeddings_batch(texts: list[str], batch_size: int = 100, max_batch_tokens: int = 100000, workers: int = 4, rpm: int = 3000, tpm: int = 1000000, serializados: bool = False, debug: bool = False) -> list:
+    """
+    Genera los embeddings de una lista de textos agrupando en lotes los que no están en la caché.
+    Los lotes se envían a la API desde un pool de `workers` hilos, con como mucho `workers`
+    peticiones en vuelo y respetando los límites de peticiones y tokens por minuto.
+    Los resultados llegan por una cola a un único escritor que los guarda en la caché
+    en una sola transacción.
+
+    Args:
+        texts (list[str]): Los textos para los cuales generar el embedding.
+        batch_size (int): Número máximo de textos por petición.
+        max_batch_tokens (int): Número máximo de tokens estimados por petición.
+        workers (int): Número máximo de peticiones simultáneas a la API.
+        rpm (int): Peticiones por minuto permitidas (0 = sin límite).
+        tpm (int): Tokens por minuto permitidos (0 = sin límite).
+        serializados (bool): Si True, devuelve los embeddings como BLOB de float32 listos para
+            insertar en `vec0`; los aciertos de caché se devuelven sin decodificar.
+        debug (bool): Si True, muestra mensajes de depuración.
+
+    Returns:
+        list: Los embeddings en el mismo orden que los textos. None si no se pudo generar.
+    """
+    embeddings = {}
+
+    # Resolver primero todos los aciertos de caché con una sola consulta
+    cache = get_cache()
+    hashes = {text: get_text_hash(text) for text in texts}
+    cached = cache.get_many(list(hashes.values()), serializados=serializados)
+    pendientes = []
+    for text, text_hash in hashes.items():
+        if text_hash in cached:
+            embeddings[text] = cached[text_hash]
+        else:
+            pendientes.append(text)
+    dprint(f"Embeddings en caché: {len(embeddings)}, pendientes: {len(pendientes)}", debug)
+
+    if pendientes:
+        client = get_client()
+        limitador = LimitadorTasa(rpm=rpm, tpm=tpm)
+        lotes = agrupar_en_lotes(pendientes, batch_size, max_batch_tokens)
+        cola = queue.Queue()
+
+        def trabajador(lote):
+            try:
+                cola.put((lote, embeddings_lote(client, lote, limitador)))
+            except Exception as e:
+                print(f"Error al generar embeddings del lote: {e}")
+                cola.put((lote, None))
+
+        dprint(f"Enviando {len(lotes)} lotes con {workers} peticiones en vuelo", debug)
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            for lote in lotes:
+                pool.submit(trabajador, lote)
+
+            # Único escritor: consume la cola y reúne los embeddings nuevos
+            nuevos = []
+            for _ in tqdm(range(len(lotes)), desc="Generando embeddings por lotes"):
+                lote, vectores = cola.get()
+                if vectores is None:
+                    continue
+                for text, embedding in zip(lote, vectores):
+                    if serializados:
+                        embedding = sqlite_vec.serialize_float32(embedding)
+                    embeddings[text] = embedding
+                    nuevos.append((hashes[text], text, embedding))
+
+        dprint(f"Guardando {len(nuevos)} embeddings nuevos en caché", debug)
+        # Guardar en caché todos los embeddings nuevos en una sola transacción
+        cache.put_many(nuevos)
+
+    return [embeddings.get(text) for text in texts]
+
+# Archivo con el que se guardan los chunks de populate_embeddings, que no vienen del catálogo.
+# No es un nombre de archivo válido, así que no se confunde con ninguno.
+origen_populate = "<populate_embeddings>"
+
+def populate_embeddings(chunks: list[str], batch_size: int = 100, max_batch_tokens: int = 100000, workers: int = 4, rpm: int = 3000, tpm: int = 1000000, debug: bool = False):
     """
     Poblar la base de datos con los embeddings de los chunks.
+    Los chunks que no están en la caché se envían a la API en lotes y en paralelo.
+    Se guardan con el archivo `origen_populate`: `indexar_archivos` los conserva al reconciliar
+    el índice con el catálogo y solo se borran al rehacerlo con `force`.
     
     Args:
         chunks (list[str]): Lista de fragmentos de texto para generar embeddings.
+        batch_size (int): Número máximo de chunks por petición de embeddings.
+        max_batch_tokens (int): Número máximo de tokens estimados por petición de embeddings.
+        workers (int): Número máximo de peticiones de embeddings simultáneas.
+        rpm (int): Peticiones por minuto permitidas (0 = sin límite).
+        tpm (int): Tokens por minuto permitidos (0 = sin límite).
         debug (bool): Si True, muestra mensajes de depuración.
     """
 
+    embeddings = get_embeddings_batch(chunks, batch_size=batch_size, max_batch_tokens=max_batch_tokens, workers=workers, rpm=rpm, tpm=tpm, serializados=True, debug=debug)
+
+    fallidos = sum(embedding is None for embedding in embeddings)
+    if fallidos:
+        print(f"No se pudo generar el embedding de {fallidos} chunks")
+
     # Conectar a la base de datos (se creará si no existe)
     db_path = os.path.join(get_module_dir(), "embeddings.db")
     conn = sqlite3.connect(db_path)
 
     # Cargar la extensión sqlite-vec
     load_sqlite_vec(conn)
-    
-    cursor = conn.cursor()
-    
-    # Crear tabla si no existe - usando BLOB para almacenar los embeddings
-    cursor.execute('''
-        CREATE VIRTUAL TABLE IF NOT EXISTS embeddings 
-        using vec0(chunk TEXT, embedding float[1536])
+    crear_tablas_indice(conn)
+
+    # Los embeddings ya vienen serializados como float32, se insertan sin conversión y en una sola transacción.
+    # Estos chunks no vienen de ningún archivo del catálogo, así que no tienen agencia, categoría ni posición.
+    with conn:
+        insertados = insertar_chunks(conn, (
+            (origen_populate, "", "", 0, len(chunk), get_text_hash(chunk), chunk, embedding)
+            for chunk, embedding in zip(chunks, embeddings)
+            if embedding is not None
+        ))
+    conn.close()
+    dprint(f"Se almacenaron {insertados} embeddings en la base de datos", debug)
+    return True
+
+def crear_tablas_indice(conn):
+    """
+    Crea, si no existen, las tablas del índice (`embeddings` y `chunks`, ver `crear_esquema`) y el
+    manifiesto de indexación: `manifiesto_archivos` guarda el hash de cada archivo indexado y los
+    parámetros con los que se dividió en chunks. Una base de datos con un esquema anterior (con el
+    texto dentro de la tabla `vec0` o sin categoría) se vacía para rehacerla desde los archivos; los
+    embeddings siguen en la caché, así que no se vuelven a pedir a la API.
+
+    Args:
+        conn (sqlite3.Connection): Conexión con la extensión sqlite-vec cargada.
+    """
+    esquema = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'embeddings'").fetchone()
+    if esquema and "categoria" not in esquema[0].lower():
+        conn.execute("DROP TABLE embeddings")
+        conn.execute("DROP TABLE IF EXISTS manifiesto_chunks")
+        conn.execute("DROP TABLE IF EXISTS manifiesto_archivos")
+    crear_esquema(conn)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS manifiesto_archivos (
+            archivo TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            parametros TEXT NOT NULL
+        )
     ''')
     conn.commit()
 
-    conn.execute("BEGIN TRANSACTION")
+# Número de chunks nuevos cuyo texto se decodifica a la vez durante la indexación
+ventana_indexacion = 1000
 
-    for chunk in tqdm(chunks, desc="Generando embeddings"):
-        embedding = get_embeddings(chunk, debug=debug)
-        cursor.execute(
-            "INSERT INTO embeddings (embedding, chunk) VALUES (?, ?)",
-                (sqlite_vec.serialize_float32(embedding), chunk),
-            )
-        
-    # Commit y cierre de conexión
-    conn.commit()
+def textos_vistas(corpus: Corpus, vistas: list[tuple]) -> list[str]:
+    """
+    Decodifica del corpus el texto de varios chunks a partir de sus vistas.
+
+    Args:
+        corpus (Corpus): Los archivos del catálogo.
+        vistas (list[tuple]): Tuplas que empiezan por (archivo, agencia, categoria, inicio, longitud).
+
+    Returns:
+        list[str]: El texto de cada chunk, con la agencia en la primera línea (ver `fragmentar`).
+    """
+    return [cabecera_chunk(archivo) + corpus.texto(archivo, inicio, longitud) for archivo, _, _, inicio, longitud, *_ in vistas]
+
+def indexar_archivos(files: dict, max_tokens: int = 800, force: bool = False, batch_size: int = 100, max_batch_tokens: int = 100000, workers: int = 4, rpm: int = 3000, tpm: int = 1000000, debug: bool = False) -> dict:
+    """
+    Actualiza la base de datos de embeddings de forma incremental a partir de los archivos del catálogo.
+    Solo se vuelven a dividir los archivos cuyo hash (o parámetros de chunking) ha cambiado, y de
+    ellos solo se generan embeddings para los chunks nuevos. Los chunks que ya no existen, incluidos
+    los de archivos eliminados, se borran de `embeddings` y de `chunks`. Los de `populate_embeddings`
+    (archivo `origen_populate`) se conservan.
+
+    Los archivos se leen proyectados en memoria (ver `Corpus`) y de los chunks nuevos solo se
+    guarda su vista (archivo, inicio, longitud) y su hash. El texto se decodifica por ventanas de
+    `ventana_indexacion` chunks, una vez para pedir los embeddings, que quedan en la caché, y otra
+    para insertarlos, así que la memoria no crece con el tamaño del catálogo.
+
+    Args:
+        files (dict): Un diccionario con el nombre del archivo como clave y como valor su ruta
+            (`Path`) o su contenido.
+        max_tokens (int): Número máximo de tokens estimados de cada fragmento.
+        force (bool): Si True, vacía el índice y lo rehace entero.
+        batch_size (int): Número máximo de chunks por petición de embeddings.
+        max_batch_tokens (int): Número máximo de tokens estimados por petición de embeddings.
+        workers (int): Número máximo de peticiones de embeddings simultáneas.
+        rpm (int): Peticiones por minuto permitidas (0 = sin límite).
+        tpm (int): Tokens por minuto permitidos (0 = sin límite).
+        debug (bool): Si True, muestra mensajes de depuración.
+
+    Returns:
+        dict: Número de archivos reindexados y eliminados, y de chunks insertados y borrados.
+    """
+    db_path = os.path.join(get_module_dir(), "embeddings.db")
+    conn = sqlite3.connect(db_path)
+    load_sqlite_vec(conn)
+    crear_tablas_indice(conn)
+
+    if force:
+        conn.execute("DELETE FROM embeddings")
+        conn.execute("DELETE FROM chunks")
+        conn.execute("DELETE FROM manifiesto_archivos")
+        conn.commit()
+
+    corpus = Corpus(files)
+    parametros = f"estructura,max_tokens={max_tokens}"
+    manifiesto = {archivo: (hash_archivo, params) for archivo, hash_archivo, params in conn.execute("SELECT archivo, hash, parametros FROM manifiesto_archivos")}
+
+    hashes = {archivo: corpus.hash(archivo) for archivo in corpus}
+    cambiados = [archivo for archivo in corpus if manifiesto.get(archivo) != (hashes[archivo], parametros)]
+    # También se eliminan los chunks de archivos que ya no están en el catálogo, salvo los de populate_embeddings
+    indexados = set(manifiesto) | {archivo for archivo, in conn.execute("SELECT DISTINCT archivo FROM chunks")}
+    indexados.discard(origen_populate)
+    eliminados = [archivo for archivo in indexados if archivo not in corpus]
+
+    # Para cada archivo cambiado se conservan los chunks que siguen igual (actualizando su posición y categoría) y se borran los demás
+    borrar = []
+    mover = []
+    nuevos = []
+    for archivo in cambiados:
+        existentes = {}
+        for id_chunk, hash_chunk in conn.execute("SELECT id, hash FROM chunks WHERE archivo = ?", (archivo,)):
+            existentes.setdefault(hash_chunk, []).append(id_chunk)
+        for inicio, longitud, categoria, chunk in fragmentar(corpus.lineas(archivo), archivo, max_tokens):
+            hash_chunk = get_text_hash(chunk)
+            if existentes.get(hash_chunk):
+                mover.append((categoria, inicio, longitud, existentes[hash_chunk].pop()))
+            else:
+                nuevos.append((archivo, agencia_de(archivo), categoria, inicio, longitud, hash_chunk))
+        borrar.extend(id_chunk for ids in existentes.values() for id_chunk in ids)
+    for archivo in eliminados:
+        borrar.extend(id_chunk for id_chunk, in conn.execute("SELECT id FROM chunks WHERE archivo = ?", (archivo,)))
+
+    dprint(f"Archivos a reindexar: {cambiados}, eliminados: {eliminados}", debug)
+    dprint(f"Chunks nuevos: {len(nuevos)}, chunks a borrar: {len(borrar)}", debug)
+
+    # Los embeddings de cada ventana se piden a la API (o se encuentran en la caché) y se guardan en la caché
+    ventanas = [nuevos[i:i + ventana_indexacion] for i in range(0, len(nuevos), ventana_indexacion)]
+    fallidos = 0
+    for ventana in ventanas:
+        embeddings = get_embeddings_batch(textos_vistas(corpus, ventana), batch_size=batch_size, max_batch_tokens=max_batch_tokens, workers=workers, rpm=rpm, tpm=tpm, serializados=True, debug=debug)
+        fallidos += sum(embedding is None for embedding in embeddings)
+    if fallidos:
+        print(f"No se pudo generar el embedding de {fallidos} chunks")
+
+    # Todos los cambios se aplican en una transacción: si algo falla, el índice queda como estaba
+    insertados = 0
+    incompletos = set()
+    with conn:
+        conn.executemany("DELETE FROM embeddings WHERE rowid = ?", ((id_chunk,) for id_chunk in borrar))
+        conn.executemany("DELETE FROM chunks WHERE id = ?", ((id_chunk,) for id_chunk in borrar))
+        conn.executemany("UPDATE chunks SET categoria = ?, inicio = ?, longitud = ? WHERE id = ?", mover)
+        conn.executemany("UPDATE embeddings SET categoria = ? WHERE rowid = ?", ((categoria, id_chunk) for categoria, _, _, id_chunk in mover))
+        for ventana in ventanas:
+            embeddings = get_cache().get_many([nuevo[-1] for nuevo in ventana], serializados=True)
+            insertados += insertar_chunks(conn, (
+                nuevo + (texto, embeddings[nuevo[-1]])
+                for nuevo, texto in zip(ventana, textos_vistas(corpus, ventana))
+                if nuevo[-1] in embeddings
+            ))
+            # Un archivo con chunks fallidos no se marca como indexado, para reintentarlo en el siguiente arranque
+            incompletos.update(nuevo[0] for nuevo in ventana if nuevo[-1] not in embeddings)
+        conn.executemany(
+            "INSERT OR REPLACE INTO manifiesto_archivos (archivo, hash, parametros) VALUES (?, ?, ?)",
+            ((archivo, hashes[archivo], parametros) for archivo in cambiados if archivo not in incompletos),
+        )
+        conn.executemany("DELETE FROM manifiesto_archivos WHERE archivo = ?", ((archivo,) for archivo in eliminados))
     conn.close()
-    dprint(f"Se almacenaron {len(chunks)} embeddings en la base de datos", debug)
-    return True
-    
+    corpus.cerrar()
+
+    resumen = {
+        "archivos_reindexados": len(cambiados),
+        "archivos_eliminados": len(eliminados),
+        "chunks_insertados": insertados,
+        "chunks_borrados": len(borrar),
+    }
+    dprint(f"Indexación incremental: {resumen}", debug)
+    return resumen
+
+
+# Caché en memoria de embeddings de consultas, delante de la caché persistente
+query_embedding_cache = CacheLRU(maxsize=1024, ttl=3600)
 
-    
 def get_embeddings_query(query: str):
     """
     Genera un embedding para una query utilizando la API de OpenAI.
+    Primero se busca en la caché LRU en memoria y después en la caché persistente,
+    de forma que las consultas repetidas no hacen ninguna petición de red.
     """
-    api_key = os.environ.get("OPENAI_API_KEY")
-    if not api_key:
-        raise ValueError("No se encontró la API key de OpenAI. Configúrela en el archivo .env")
-    
-    client = openai.OpenAI(api_key=api_key)
+    text_hash = get_text_hash(query)
+
+    embedding = query_embedding_cache.get(text_hash)
+    if embedding is not None:
+        return embedding
+
+    cache = get_cache()
+    embedding = cache.get(text_hash)
+    if embedding is not None:
+        query_embedding_cache.put(text_hash, embedding)
+        return embedding
+
+    client = get_client()
     
     response = client.embeddings.create(
         model="text-embedding-3-small",  # Modelo de embeddings más reciente
         input=query
     )
 
-    return response.data[0].embedding
+    embedding = response.data[0].embedding
+    cache.put(text_hash, query, embedding)
+    query_embedding_cache.put(text_hash, embedding)
+    return embedding
+
+def get_embeddings_queries(queries: list[str]) -> list[list[float]]:
+    """
+    Genera los embeddings de varias queries con una sola petición a la API de OpenAI.
+    Igual que get_embeddings_query, primero se busca en la caché en memoria y en la persistente,
+    y solo se piden a la API las queries que no están en ninguna.
+    
+    Args:
+        queries (list[str]): Lista de queries.
+        
+    Returns:
+        list[list[float]]: Los embeddings en el mismo orden que las queries.
+    """
+    hashes = [get_text_hash(query) for query in queries]
+    embeddings = {}
+    for text_hash in hashes:
+        embedding = query_embedding_cache.get(text_hash)
+        if embedding is not None:
+            embeddings[text_hash] = embedding
+
+    cache = get_cache()
+    pendientes = [text_hash for text_hash in dict.fromkeys(hashes) if text_hash not in embeddings]
+    persistentes = cache.get_many(pendientes)
+    for text_hash, embedding in persistentes.items():
+        query_embedding_cache.put(text_hash, embedding)
+    embeddings.update(persistentes)
+
+    faltan = {text_hash: query for text_hash, query in zip(hashes, queries) if text_hash not in embeddings}
+    if faltan:
+        client = get_client()
+        response = client.embeddings.create(
+            model="text-embedding-3-small",
+            input=list(faltan.values())
+        )
+        nuevos = []
+        for (text_hash, query), item in zip(faltan.items(), response.data):
+            embeddings[text_hash] = item.embedding
+            query_embedding_cache.put(text_hash, item.embedding)
+            nuevos.append((text_hash, query, item.embedding))
+        cache.put_many(nuevos)
+
+    return [embeddings[text_hash] for text_hash in hashes]
+
+def estadisticas_cache_consultas() -> dict:
+    """
+    Devuelve los contadores de aciertos y fallos de las cachés de embeddings de consultas.
+
+    Returns:
+        dict: Contadores de la caché en memoria y de la caché persistente.
+    """
+    return {
+        "memoria": query_embedding_cache.estadisticas(),
+        "persistente": get_cache().estadisticas(),
+    }
+
+retrievers = {}
+
+# Backend del índice vectorial en memoria y sus parámetros. Se cambia con configurar_indice().
+configuracion_indice = {"indice": "exacto"}
 
-def buscar_chunks_similares(query: str, max_chunks: int = 5, max_distance=0.90, debug: bool = False):
+def configurar_indice(indice: str = "exacto", **parametros):
     """
-    Busca los chunks más similares a un embedding utilizando la función cosine_similarity.
+    Cambia el backend del índice vectorial en memoria y descarta los índices ya construidos.
+    
+    Args:
+        indice (str): "exacto" para búsqueda por fuerza bruta o "ivfpq" para el índice aproximado IVF-PQ.
+        **parametros: Parámetros del backend (nlist, nprobe, pq_m, refinar para "ivfpq").
+    """
+    if indice not in indices:
+        raise ValueError(f"Índice desconocido: {indice}. Opciones: {sorted(indices)}")
+    configuracion_indice.clear()
+    configuracion_indice.update(indice=indice, **parametros)
+    retrievers.clear()
+
+def filtros_indice(agencias: list[str] = None, categorias: list[str] = None) -> dict:
+    """
+    Traduce los filtros de agencia y categoría de una consulta a los nombres exactos del índice.
+    Los nombres que no se reconocen se ignoran.
+
+    Returns:
+        dict: Argumentos `agencias` y `categorias` para Retriever.buscar y Retriever.buscar_batch.
+    """
+    return {
+        "agencias": resolver_filtro(agencias, list(titulos.values())),
+        "categorias": resolver_filtro(categorias, categorias_ruta),
+    }
+
+def get_retriever() -> Retriever:
+    """
+    Devuelve el índice vectorial en memoria del proceso, creándolo la primera vez.
+    El índice se recarga solo cuando cambia `embeddings.db`.
+    
+    Returns:
+        Retriever: Índice vectorial en memoria.
+    """
+    db_path = os.path.abspath(os.path.join(get_module_dir(), "embeddings.db"))
+    if db_path not in retrievers:
+        retrievers[db_path] = Retriever(db_path, **configuracion_indice)
+    return retrievers[db_path]
+
+def buscar_chunks_similares(query: str, max_chunks: int = 5, max_distance=0.90, agencias: list[str] = None, categorias: list[str] = None, debug: bool = False):
+    """
+    Busca los chunks más similares a una consulta utilizando el índice vectorial en memoria.
     
     Args:
         query(str): La consulta.
         max_chunks (int): Número máximo de chunks a devolver.
         max_distance (float): Umbral máximo de distancia (0-1).
+        agencias (list[str]): Buscar solo en los catálogos de estas agencias. None para no filtrar.
+        categorias (list[str]): Buscar solo en estas categorías de ruta. None para no filtrar.
         debug (bool): Si True, muestra mensajes de depuración.
         
     Returns:
@@ -247,39 +1224,10 @@ def buscar_chunks_similares(query: str, max_chunks: int = 5, max_distance=0.90,
 
     query_embedding = get_embeddings_query(query)
 
-    db_path = os.path.join(get_module_dir(), "embeddings.db")
-    conn = sqlite3.connect(db_path)
-    
-    # Cargar la extensión sqlite-vec
-    load_sqlite_vec(conn)
-    
-    cursor = conn.cursor()
-    
-    # Ejecutar la consulta SQL para obtener los chunks similares usando cosine_similarity
-    dprint("Ejecutando consulta SQL para buscar chunks similares...", debug)
-    
-    # Primero, vamos a comprobar cuántos chunks hay en total en la base de datos
-    cursor.execute("SELECT COUNT(*) FROM embeddings")
-    total_chunks = cursor.fetchone()[0]
-    dprint(f"Total de chunks en la base de datos: {total_chunks}", debug)
-    
-    # Ahora ejecutamos la consulta de similitud pero sin filtros
-    cursor.execute(
-        """
-            select
-                chunk,
-                distance
-            from embeddings
-            where embedding match ?
-            and distance < ?
-            and k = ?
-            order by distance;
-        """,
-        (sqlite_vec.serialize_float32(query_embedding), max_distance, max_chunks),
-    )
-    
-    # Obtener los resultados    
-    results = cursor.fetchall()
+    # Buscar en el índice en memoria (se carga una vez y se recarga si cambia la base de datos)
+    retriever = get_retriever()
+    results = retriever.buscar(query_embedding, k=max_chunks, **filtros_indice(agencias, categorias))
+    dprint(f"Total de chunks en el índice: {len(retriever)}", debug)
     dprint(f"Chunks encontrados antes de filtrar: {len(results)}", debug)
     
     # Mostrar las distancias para diagnóstico
@@ -288,31 +1236,331 @@ def buscar_chunks_similares(query: str, max_chunks: int = 5, max_distance=0.90,
         similarity = 1 - distance
         dprint(f"Chunk {i+1}: Distancia={distance:.4f}, Similitud={similarity:.4f}", debug)
     
-    conn.close()
-    
     # Filtrar por similitud si es necesario (1-distance para convertir distancia a similitud)
     filtered_results = [(chunk, distance) for chunk, distance in results if distance < max_distance]
     dprint(f"Chunks que pasan el filtro de distancia ({max_distance}): {len(filtered_results)}", debug)
     
     return filtered_results
 
-def crear_prompt(query: str, resultados: list[tuple[str, float]], max_chunks: int = 5) -> str:
+def buscar_chunks_con_id(queries: list[str], max_chunks: int = 5, max_distance=0.90, agencias: list[str] = None, categorias: list[str] = None) -> list[list[tuple[int, str, float]]]:
+    """
+    Busca los chunks más similares a cada consulta y los devuelve junto con su id.
+    
+    Args:
+        queries (list[str]): Las consultas.
+        max_chunks (int): Número máximo de chunks a buscar por consulta.
+        max_distance (float): Umbral máximo de distancia (0-1).
+        agencias (list[str]): Buscar solo en los catálogos de estas agencias. None para no filtrar.
+        categorias (list[str]): Buscar solo en estas categorías de ruta. None para no filtrar.
+        
+    Returns:
+        list[list[tuple[int, str, float]]]: Para cada consulta, ternas (id, chunk, distancia).
+    """
+    query_embeddings = get_embeddings_queries(queries)
+    return get_retriever().buscar_batch(query_embeddings, k=max_chunks, max_distance=max_distance, **filtros_indice(agencias, categorias))
+
+def combinar_chunks(resultados: list[list[tuple[int, str, float]]]) -> list[tuple[str, float]]:
+    """
+    Combina los resultados de varias búsquedas eliminando duplicados por id de chunk
+    y conservando la menor distancia.
+    
+    Args:
+        resultados (list[list[tuple[int, str, float]]]): Ternas (id, chunk, distancia) de cada búsqueda.
+        
+    Returns:
+        list[tuple[str, float]]: Los chunks distintos con su distancia, ordenados por distancia.
+    """
+    chunks_unicos = {}
+    for resultados_query in resultados:
+        for chunk_id, chunk, distance in resultados_query:
+            if chunk_id not in chunks_unicos or distance < chunks_unicos[chunk_id][1]:
+                chunks_unicos[chunk_id] = (chunk, distance)
+    return sorted(chunks_unicos.values(), key=lambda x: x[1])
+
+# Tipo de búsqueda de realizar_consulta: "hibrida" (léxica y vectorial) o "vectorial". Se cambia con configurar_busqueda().
+configuracion_busqueda = {"busqueda": "hibrida"}
+
+def configurar_busqueda(busqueda: str = "hibrida"):
+    """
+    Cambia el tipo de búsqueda que usan realizar_consulta y realizar_consulta_stream.
+    """
+    if busqueda not in ("hibrida", "vectorial"):
+        raise ValueError(f"Búsqueda desconocida: {busqueda}. Opciones: ['hibrida', 'vectorial']")
+    configuracion_busqueda["busqueda"] = busqueda
+
+# Constante de la fusión por rango recíproco: cuanto mayor, menos pesan los primeros puestos
+k_rrf = 60
+# Candidatos que aporta cada búsqueda a la fusión, como múltiplo de los chunks pedidos
+candidatos_hibrida = 4
+# Consultas de hasta este número de palabras se buscan primero como nombre exacto
+max_palabras_nombre = 4
+# Palabras en minúscula que pueden ir dentro de un nombre propio ("Picos de Europa")
+conectores_nombre = {"de", "del", "la", "las", "los", "el", "y", "e", "da", "do", "das", "dos"}
+
+def parece_nombre(query: str) -> bool:
+    """
+    Indica si la consulta parece un nombre propio o un código ("Ribeira Sacra", "Picos de Europa",
+    "GR 11"): como mucho `max_palabras_nombre` palabras, todas con mayúscula inicial o con algún
+    dígito, salvo conectores en minúscula entre ellas.
+    """
+    palabras = re.findall(r"\w+", query)
+    if not palabras or len(palabras) > max_palabras_nombre:
+        return False
+    return all(
+        palabra[0].isupper() or any(c.isdigit() for c in palabra) or (0 < i < len(palabras) - 1 and palabra in conectores_nombre)
+        for i, palabra in enumerate(palabras)
+    )
+
+def fusion_rrf(rankings: list[list[int]], k: int = k_rrf) -> list[int]:
+    """
+    Combina varias listas ordenadas de ids con la fusión por rango recíproco (RRF): cada id suma
+    1 / (k + posición) por cada lista en la que aparece.
+
+    Args:
+        rankings (list[list[int]]): Listas de ids, de más a menos relevante.
+        k (int): Constante de la fusión.
+
+    Returns:
+        list[int]: Los ids de todas las listas ordenados por su puntuación combinada.
+    """
+    puntuaciones = {}
+    for ranking in rankings:
+        for posicion, id_chunk in enumerate(ranking, start=1):
+            puntuaciones[id_chunk] = puntuaciones.get(id_chunk, 0.0) + 1.0 / (k + posicion)
+    return sorted(puntuaciones, key=lambda id_chunk: -puntuaciones[id_chunk])
+
+def buscar_chunks_hibrido(query: str, max_chunks: int = 5, max_distance=0.90, agencias: list[str] = None, categorias: list[str] = None, debug: bool = False) -> list[tuple[str, float]]:
+    """
+    Busca los chunks de una consulta combinando la búsqueda léxica (BM25 sobre el índice de texto
+    completo) y la vectorial con la fusión por rango recíproco. La léxica encuentra los nombres
+    exactos (pueblos, códigos de ruta, precios) que los embeddings no distinguen bien.
+
+    Si la consulta parece un nombre propio o un código (ver `parece_nombre`) y aparece tal cual
+    en el catálogo, como "Ribeira Sacra", esas coincidencias van primero y el resto se completa
+    con la fusión. Si ya llenan los `max_chunks`, no se hacen las otras dos búsquedas.
+
+    Args:
+        query (str): La consulta.
+        max_chunks (int): Número máximo de chunks a devolver.
+        max_distance (float): Umbral máximo de distancia de los resultados vectoriales. No se
+            aplica a los que encuentra la búsqueda léxica.
+        agencias (list[str]): Buscar solo en los catálogos de estas agencias. None para no filtrar.
+        categorias (list[str]): Buscar solo en estas categorías de ruta. None para no filtrar.
+        debug (bool): Si True, muestra mensajes de depuración.
+
+    Returns:
+        list[tuple[str, float]]: Pares (chunk, distancia al embedding de la consulta) en el
+            orden de la fusión.
+    """
+    filtros = filtros_indice(agencias, categorias)
+    retriever = get_retriever()
+    query_embedding = get_embeddings_query(query)
+
+    # Un nombre que aparece tal cual en el catálogo va delante de los resultados de la fusión
+    exactos = retriever.buscar_lexico(query, k=max_chunks, frase=True, **filtros) if parece_nombre(query) else []
+    dprint(f"Coincidencias exactas de '{query}': {len(exactos)}", debug)
+    vectoriales, lexicos = [], []
+    if len(exactos) < max_chunks:
+        candidatos = max_chunks * candidatos_hibrida
+        vectoriales = retriever.buscar_batch([query_embedding], k=candidatos, max_distance=max_distance, **filtros)[0]
+        lexicos = retriever.buscar_lexico(query, k=candidatos, **filtros)
+        dprint(f"Candidatos vectoriales: {len(vectoriales)}, léxicos: {len(lexicos)}", debug)
+
+    ids_exactos = [id_chunk for id_chunk, _, _ in exactos]
+    fusion = fusion_rrf([[id_chunk for id_chunk, _, _ in vectoriales], [id_chunk for id_chunk, _, _ in lexicos]])
+    orden = (ids_exactos + [id_chunk for id_chunk in fusion if id_chunk not in ids_exactos])[:max_chunks]
+    textos = {id_chunk: chunk for id_chunk, chunk, _ in vectoriales + lexicos + exactos}
+    distancias = {id_chunk: distancia for id_chunk, _, distancia in vectoriales}
+    distancias.update(retriever.distancias(query_embedding, [id_chunk for id_chunk in orden if id_chunk not in distancias]))
+    return [(textos[id_chunk], distancias.get(id_chunk, 2.0)) for id_chunk in orden]
+
+def buscar_chunks(query: str, max_chunks: int = 5, max_distance=0.90, agencias: list[str] = None, categorias: list[str] = None, debug: bool = False) -> list[tuple[str, float]]:
+    """
+    Busca los chunks de una consulta con el tipo de búsqueda configurado (ver `configurar_busqueda`).
+    """
+    if configuracion_busqueda["busqueda"] == "hibrida":
+        return buscar_chunks_hibrido(query, max_chunks=max_chunks, max_distance=max_distance, agencias=agencias, categorias=categorias, debug=debug)
+    return buscar_chunks_similares(query, max_chunks=max_chunks, max_distance=max_distance, agencias=agencias, categorias=categorias, debug=debug)
+
+# Reordenado local de los candidatos antes de crear el prompt. Se cambia con configurar_reordenado().
+configuracion_reordenado = {"reordenador": None, "candidatos": 50}
+
+def configurar_reordenado(reordenador: str = None, candidatos: int = 50, **parametros):
+    """
+    Activa o desactiva el reordenado local de los chunks encontrados. Con un reordenador, cada
+    búsqueda pide `candidatos` chunks, el reordenador los puntúa en la CPU con la consulta y solo
+    se quedan los mejores para el prompt.
+
+    Args:
+        reordenador (str): Una de las claves de `reordenadores`, o None para no reordenar.
+        candidatos (int): Número de chunks que se piden a la búsqueda para reordenarlos.
+        **parametros: Parámetros del reordenador (por ejemplo, los pesos de `ReordenadorLexico`).
+    """
+    if reordenador is not None and reordenador not in reordenadores:
+        raise ValueError(f"Reordenador desconocido: {reordenador}. Opciones: {sorted(reordenadores)}")
+    configuracion_reordenado["reordenador"] = reordenadores[reordenador](**parametros) if reordenador else None
+    configuracion_reordenado["candidatos"] = candidatos
+
+def candidatos_busqueda(max_chunks: int) -> int:
+    """
+    Devuelve cuántos chunks hay que pedir a la búsqueda para quedarse después con `max_chunks`.
+    """
+    if configuracion_reordenado["reordenador"] is None:
+        return max_chunks
+    return max(max_chunks, configuracion_reordenado["candidatos"])
+
+def reordenar_chunks(query: str, resultados: list[tuple[str, float]], max_chunks: int, debug: bool = False) -> list[tuple[str, float]]:
+    """
+    Reordena los chunks encontrados con el reordenador configurado y se queda con los `max_chunks`
+    mejores. Sin reordenador, conserva el orden de la búsqueda.
+
+    Args:
+        query (str): La consulta.
+        resultados (list[tuple[str, float]]): Pares (chunk, distancia) de la búsqueda.
+        max_chunks (int): Número de chunks a conservar.
+        debug (bool): Si True, muestra mensajes de depuración.
+
+    Returns:
+        list[tuple[str, float]]: Los pares (chunk, distancia) elegidos, de más a menos relevante.
+    """
+    reordenador = configuracion_reordenado["reordenador"]
+    if reordenador is None:
+        return resultados[:max_chunks]
+    inicio = time.perf_counter()
+    reordenados = reordenador.reordenar(query, resultados, max_chunks)
+    dprint(f"Reordenados {len(resultados)} candidatos en {(time.perf_counter() - inicio) * 1000:.1f} ms", debug)
+    return reordenados
+
+# Presupuesto de tokens del contexto del prompt. Se cambia con configurar_contexto().
+configuracion_contexto = {"max_tokens": 3000}
+
+def configurar_contexto(max_tokens: int = 3000):
+    """
+    Cambia el número máximo de tokens del contexto que se envía al modelo en cada consulta.
+    """
+    if max_tokens <= 0:
+        raise ValueError("El presupuesto de tokens del contexto debe ser positivo")
+    configuracion_contexto["max_tokens"] = max_tokens
+
+def separar_agencia(chunk: str) -> tuple[str, str]:
+    """
+    Separa de un chunk la primera línea con el nombre de la agencia (ver `fragmentar`).
+
+    Returns:
+        tuple[str, str]: La agencia (vacía si el chunk no la lleva) y el texto del fragmento.
+    """
+    if chunk.startswith(prefijo_agencia) and "\n" in chunk:
+        agencia, texto = chunk[len(prefijo_agencia):].split("\n", 1)
+        return agencia, texto
+    return "", chunk
+
+def agrupar_contexto(piezas: list[tuple]) -> str:
+    """
+    Da formato al contexto de una consulta. Las piezas se agrupan por agencia, que se indica
+    una sola vez por grupo, y las piezas del mismo archivo que se solapan o son contiguas se
+    funden en un solo texto, sin repetir la parte común. Los grupos y los textos conservan el
+    orden de relevancia de su primera pieza.
+
+    Args:
+        piezas (list[tuple]): Tuplas (agencia, archivo, inicio, fin, texto) en orden de relevancia.
+            `inicio` y `fin` son None si no se conoce la posición del texto en su archivo.
+
+    Returns:
+        str: El contexto formateado.
+    """
+    grupos = {}
+    for agencia, archivo, inicio, fin, texto in piezas:
+        grupos.setdefault(agencia, []).append((archivo, inicio, fin, texto))
+
+    bloques = []
+    for agencia, del_grupo in grupos.items():
+        textos = []
+        # Último texto de cada archivo, en orden de posición, para fundir con él la siguiente pieza
+        ultimo = {}
+        for orden, (archivo, inicio, fin, texto) in sorted(
+            enumerate(del_grupo), key=lambda x: (x[1][0], x[1][1] is None, x[1][1] or 0, x[0])
+        ):
+            if texto in (t for _, t in textos):
+                continue
+            anterior = ultimo.get(archivo) if inicio is not None and archivo else None
+            if anterior is not None and inicio <= anterior[1] + hueco_fusion:
+                i, fin_anterior = anterior
+                orden_texto, texto_anterior = textos[i]
+                if fin > fin_anterior:
+                    solape = max(fin_anterior - inicio, 0)
+                    texto_anterior += ("" if solape else "\n") + texto[solape:]
+                    ultimo[archivo] = (i, fin)
+                textos[i] = (min(orden_texto, orden), texto_anterior)
+                continue
+            textos.append((orden, texto))
+            if inicio is not None and archivo:
+                ultimo[archivo] = (len(textos) - 1, fin)
+        cuerpo = "\n\n".join(texto for _, texto in sorted(textos))
+        bloques.append(f"Catálogo de la agencia: {agencia}\n{cuerpo}" if agencia else cuerpo)
+    return "\n\n---\n\n".join(bloques)
+
+# Separación máxima, en caracteres, entre dos fragmentos del mismo archivo para fundirlos
+# (los espacios y saltos de línea que se quitan al dividir el archivo en chunks)
+hueco_fusion = 8
+
+def construir_contexto(resultados: list[tuple[str, float]], max_chunks: int = 5, max_tokens: int = None) -> str:
+    """
+    Construye el contexto de una consulta con los chunks encontrados, sin pasar de un
+    presupuesto de tokens medido con el tokenizador local. Los chunks se añaden en orden de
+    relevancia mientras quepan; la agencia se indica una vez por grupo y los fragmentos
+    contiguos o solapados del mismo archivo se funden (ver `agrupar_contexto`).
+
+    Args:
+        resultados (list[tuple[str, float]]): Pares (chunk, distancia) ordenados por distancia.
+        max_chunks (int): Número máximo de chunks a usar.
+        max_tokens (int): Presupuesto de tokens del contexto. None para usar el configurado.
+
+    Returns:
+        str: El contexto formateado.
+    """
+    max_tokens = max_tokens or configuracion_contexto["max_tokens"]
+    candidatos = [chunk for chunk, _ in resultados[:max_chunks]]
+    origenes = get_retriever().obtener_origen(get_text_hash(chunk) for chunk in candidatos)
+
+    piezas = []
+    for chunk in candidatos:
+        agencia, texto = separar_agencia(chunk)
+        archivo, agencia_origen, inicio, longitud = origenes.get(get_text_hash(chunk), ("", "", None, None))
+        # La posición solo sirve si el texto es exactamente el trozo del archivo del catálogo que indica
+        if longitud != len(texto) or archivo == origen_populate:
+            inicio = None
+        fin = inicio + longitud if inicio is not None else None
+        pieza = (agencia_origen or agencia, archivo, inicio, fin, texto)
+
+        if contar_tokens(agrupar_contexto(piezas + [pieza])) <= max_tokens:
+            piezas.append(pieza)
+        elif not piezas:
+            # Si ni siquiera cabe el chunk más relevante, se recorta
+            cabecera = contar_tokens(agrupar_contexto([pieza[:4] + ("",)]))
+            recortado = recortar_tokens(texto, max(max_tokens - cabecera, 0))
+            # La posición pasa a ser la del trozo recortado, para no fundir con él texto que ya no incluye
+            if inicio is not None and texto.startswith(recortado):
+                fin = inicio + len(recortado)
+            else:
+                inicio = fin = None
+            piezas.append((pieza[0], archivo, inicio, fin, recortado))
+    return agrupar_contexto(piezas)
+
+def crear_prompt(query: str, resultados: list[tuple[str, float]], max_chunks: int = 5, max_tokens: int = None) -> str:
     """
     Crea el prompt para OpenAI combinando la consulta y el contexto relevante.
     
     Args:
         query (str): Pregunta o consulta del usuario
-        resultados (list[Dict[str, Any]]): Lista de chunks relevantes encontrados,
-            cada uno debe contener ruta_archivo y contenido
+        resultados (list[tuple[str, float]]): Pares (chunk, distancia) encontrados, ordenados por distancia
+        max_chunks (int): Número máximo de chunks a usar
+        max_tokens (int): Presupuesto de tokens del contexto. None para usar el configurado
         
     Returns:
         str: Prompt formateado para enviar a OpenAI
     """
-    # Formatear el contexto de los chunks
-    contexto = ("-"*100).join([
-        f"\n{chunk}\n"
-        for chunk, _ in resultados[:max_chunks]
-    ])
+    # Formatear el contexto de los chunks dentro del presupuesto de tokens
+    contexto = construir_contexto(resultados, max_chunks=max_chunks, max_tokens=max_tokens)
     
     # Construir el prompt
     return f"""El usuario necesita que respondas la siguiente pregunta basandote solo en el contexto proporcionado.
@@ -340,7 +1588,7 @@ def obtener_respuesta_openai(prompt: str, test_mode: bool = False) -> str:
         Exception: Si hay un error en la llamada a la API de OpenAI
     """
     
-    client = openai.OpenAI()
+    client = get_client()
     response = client.chat.completions.create(
         model="gpt-4",
         messages=[
@@ -356,13 +1604,208 @@ def obtener_respuesta_openai(prompt: str, test_mode: bool = False) -> str:
     return respuesta
 
 
-def realizar_consulta(query: str, max_chunks: int = 5, max_distance: float = 0.90, debug: bool = False):
+def obtener_respuesta_openai_stream(prompt: str):
+    """
+    Igual que obtener_respuesta_openai, pero devuelve la respuesta según la genera el modelo,
+    para poder mostrarla sin esperar a que termine.
+    
+    Args:
+        prompt (str): Prompt completo con pregunta y contexto
+        
+    Yields:
+        str: Fragmentos de texto de la respuesta
+    """
+    client = get_client()
+    stream = client.chat.completions.create(
+        model="gpt-4",
+        messages=[
+            {"role": "system", "content": "Eres un asistente experto que responde preguntas basándose únicamente en el contexto proporcionado."},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.2,
+        max_tokens=1000,
+        stream=True
+    )
+    
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+class CacheRespuestas:
+    """
+    Caché semántica de respuestas, con expulsión LRU y caducidad por tiempo (TTL), igual que `CacheLRU`.
+
+    Cada entrada guarda el embedding normalizado de la consulta, su texto normalizado, el conjunto
+    de chunks con el que se creó el prompt (sus hashes, los mismos de la tabla `chunks`) y la
+    respuesta. Una consulta reutiliza la respuesta si se recuperaron exactamente los mismos chunks
+    y, además, su texto normalizado es el mismo o la similitud coseno entre los embeddings es al
+    menos `umbral`, así que dos formas de preguntar lo mismo sobre el mismo contexto no pagan dos
+    llamadas al modelo. Las consultas cuyo embedding ya no está en la caché de embeddings de
+    consultas solo se comparan por el texto.
+
+    Las entradas se guardan junto a la firma del índice (ver `firma_indice`); cuando el índice se
+    rehace y la firma cambia, la caché se vacía.
+
+    Args:
+        umbral (float): Similitud coseno mínima entre las consultas.
+        maxsize (int): Número máximo de entradas (0 = desactivada).
+        ttl (float): Segundos de vida de cada entrada (0 = sin caducidad).
+    """
+
+    def __init__(self, umbral: float = 0.95, maxsize: int = 256, ttl: float = 3600.0):
+        self.umbral = umbral
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.datos = OrderedDict()
+        self.lock = threading.Lock()
+        self.firma = None
+        self.siguiente = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalizar(embedding) -> np.ndarray:
+        if embedding is None:
+            return None
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def comprobar_firma(self, firma):
+        """
+        Vacía la caché si el índice ha cambiado desde que se guardaron las entradas.
+        Se llama con el lock tomado.
+        """
+        if firma != self.firma:
+            self.datos.clear()
+            self.firma = firma
+
+    def get(self, embedding, texto: str, chunks: frozenset, firma):
+        """
+        Busca la respuesta de una consulta parecida que recuperó los mismos chunks.
+
+        Args:
+            embedding: Embedding de la consulta, o None si la búsqueda no lo ha calculado.
+            texto (str): Texto normalizado de la consulta.
+            chunks (frozenset): Hashes de los chunks recuperados.
+            firma: Firma del índice sobre el que se ha buscado.
+
+        Returns:
+            La respuesta guardada o None si no hay ninguna.
+        """
+        vector = self.normalizar(embedding)
+        with self.lock:
+            self.comprobar_firma(firma)
+            ahora = time.monotonic()
+            mejor, similitud_mejor = None, self.umbral
+            for clave, (guardado, texto_guardado, chunks_guardados, respuesta, expira) in list(self.datos.items()):
+                if expira and expira <= ahora:
+                    del self.datos[clave]
+                    continue
+                if chunks_guardados != chunks:
+                    continue
+                if texto_guardado == texto:
+                    similitud = 1.0
+                elif vector is not None and guardado is not None:
+                    similitud = float(np.dot(vector, guardado))
+                else:
+                    continue
+                if similitud >= similitud_mejor:
+                    mejor, similitud_mejor = clave, similitud
+            if mejor is None:
+                self.misses += 1
+                return None
+            self.datos.move_to_end(mejor)
+            self.hits += 1
+            return self.datos[mejor][3]
+
+    def put(self, embedding, texto: str, chunks: frozenset, firma, respuesta: str):
+        """
+        Guarda la respuesta de una consulta, expulsando las entradas menos usadas si se supera el tamaño máximo.
+
+        Args:
+            embedding: Embedding de la consulta, o None si la búsqueda no lo ha calculado.
+            texto (str): Texto normalizado de la consulta.
+            chunks (frozenset): Hashes de los chunks con los que se creó el prompt.
+            firma: Firma del índice sobre el que se ha buscado.
+            respuesta (str): La respuesta del modelo.
+        """
+        if not self.maxsize:
+            return
+        with self.lock:
+            self.comprobar_firma(firma)
+            self.datos[self.siguiente] = (self.normalizar(embedding), texto, chunks, respuesta, time.monotonic() + self.ttl if self.ttl else 0)
+            self.siguiente += 1
+            while len(self.datos) > self.maxsize:
+                self.datos.popitem(last=False)
+
+    def clear(self):
+        """
+        Vacía la caché sin reiniciar los contadores.
+        """
+        with self.lock:
+            self.datos.clear()
+
+    def __len__(self):
+        return len(self.datos)
+
+    def estadisticas(self) -> dict:
+        """
+        Devuelve los contadores de la caché.
+
+        Returns:
+            dict: Aciertos, fallos y número de entradas.
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+# Caché semántica de las respuestas de realizar_consulta
+cache_respuestas = CacheRespuestas(umbral=0.95, maxsize=256, ttl=3600)
+
+def configurar_cache_respuestas(umbral: float = 0.95, maxsize: int = 256, ttl: float = 3600.0):
+    """
+    Configura la caché semántica de respuestas. Las entradas guardadas se descartan.
+
+    Args:
+        umbral (float): Similitud coseno mínima para reutilizar una respuesta.
+        maxsize (int): Número máximo de respuestas guardadas (0 = sin caché).
+        ttl (float): Segundos de vida de cada respuesta (0 = sin caducidad).
+    """
+    global cache_respuestas
+    cache_respuestas = CacheRespuestas(umbral=umbral, maxsize=maxsize, ttl=ttl)
+
+def firma_indice():
+    """
+    Devuelve la firma del índice actual: la ruta de `embeddings.db` y su firma (fecha de
+    modificación y tamaño). Cambia cada vez que se reindexa el catálogo.
+    """
+    retriever = get_retriever()
+    return retriever.db_path, retriever.firma_db()
+
+def clave_respuesta(query: str, resultados: list[tuple[str, float]]):
+    """
+    Calcula la clave de la caché de respuestas de una consulta: el embedding que calculó la
+    búsqueda vectorial (se toma de la caché de embeddings de consultas, sin pedirlo a la API),
+    el texto normalizado de la consulta, los hashes de los chunks recuperados y la firma del
+    índice. Si el embedding ya no está en esa caché, la respuesta solo se reutiliza para el
+    mismo texto (ver `CacheRespuestas`).
+
+    Returns:
+        tuple: (embedding, texto, chunks, firma), o None si la caché está desactivada.
+    """
+    if not cache_respuestas.maxsize:
+        return None
+    chunks = frozenset(get_text_hash(chunk) for chunk, _ in resultados)
+    return query_embedding_cache.ver(get_text_hash(query)), normalizar_nombre(query), chunks, firma_indice()
+
+def realizar_consulta(query: str, max_chunks: int = 5, max_distance: float = 0.90, agencias: list[str] = None, categorias: list[str] = None, debug: bool = False):
     """
     Realiza una consulta al sistema de RAG.
 
-    Primero se genera un embedding de la query.
-    Luego se busca el embedding en la base de datos de embeddings.
-    Se obtienen los chunks más similares.
+    Primero se buscan los chunks de la query: por palabras en el índice de texto completo y
+    por similitud de su embedding en el índice vectorial (ver `buscar_chunks`).
+    Se obtienen los chunks más relevantes.
+    Si una consulta parecida ya recuperó los mismos chunks, se devuelve su respuesta
+    (ver `CacheRespuestas`).
     Se contruye un prompt con los chunks más similares.
     Se realiza una consulta a OpenAI con el prompt.
     Se devuelve el resultado de la consulta.
@@ -371,34 +1814,86 @@ def realizar_consulta(query: str, max_chunks: int = 5, max_distance: float = 0.9
         query (str): La consulta del usuario.
         max_chunks (int): Número máximo de chunks a seleccionar.
         max_distance (float): Umbral máximo de distancia.
+        agencias (list[str]): Buscar solo en los catálogos de estas agencias. None para no filtrar.
+        categorias (list[str]): Buscar solo en estas categorías de ruta. None para no filtrar.
         debug (bool): Si True, muestra mensajes de depuración.
         
     Returns:
         str: La respuesta generada por OpenAI.
     """
     
-    # Buscar chunks similares pasando directamente la query como texto
-    similar_chunks = buscar_chunks_similares(query, max_chunks=max_chunks, max_distance=max_distance, debug=debug)
+    # Buscar chunks con la búsqueda configurada (híbrida o vectorial)
+    similar_chunks = buscar_chunks(query, max_chunks=candidatos_busqueda(max_chunks), max_distance=max_distance, agencias=agencias, categorias=categorias, debug=debug)
+    similar_chunks = reordenar_chunks(query, similar_chunks, max_chunks, debug=debug)
 
     dprint(f"Se encontraron {len(similar_chunks)} chunks similares", debug)
+    dprint(f"Caché de embeddings de consultas: {estadisticas_cache_consultas()}", debug)
     # Mostramos el chunk completo y su similitud
     for chunk, distance in similar_chunks[:5]:
         dprint(f"Distancia: {distance:.4f}", debug)
         dprint(chunk, debug)
         dprint("-"*100, debug)
 
+    # Reutilizar la respuesta de una consulta parecida con los mismos chunks
+    clave = clave_respuesta(query, similar_chunks)
+    if clave is not None:
+        respuesta = cache_respuestas.get(*clave)
+        dprint(f"Caché de respuestas: {cache_respuestas.estadisticas()}", debug)
+        if respuesta is not None:
+            return respuesta
+
     prompt = crear_prompt(query, similar_chunks, max_chunks=max_chunks)
 
     respuesta = obtener_respuesta_openai(prompt)
+    if clave is not None:
+        cache_respuestas.put(*clave, respuesta)
 
     return respuesta
 
-def generar_respuestas_hipoteticas(query: str, num_respuestas: int = 3, debug: bool = False):
+def realizar_consulta_stream(query: str, max_chunks: int = 5, max_distance: float = 0.90, agencias: list[str] = None, categorias: list[str] = None, debug: bool = False):
     """
-    Genera múltiples respuestas hipotéticas a la consulta del usuario
-    para mejorar la búsqueda de embeddings.
+    Igual que realizar_consulta, pero devuelve la respuesta de OpenAI según se genera.
+    
+    Args:
+        query (str): La consulta del usuario.
+        max_chunks (int): Número máximo de chunks a seleccionar.
+        max_distance (float): Umbral máximo de distancia.
+        agencias (list[str]): Buscar solo en los catálogos de estas agencias. None para no filtrar.
+        categorias (list[str]): Buscar solo en estas categorías de ruta. None para no filtrar.
+        debug (bool): Si True, muestra mensajes de depuración.
+        
+    Yields:
+        str: Fragmentos de texto de la respuesta generada por OpenAI.
+    """
+    similar_chunks = buscar_chunks(query, max_chunks=candidatos_busqueda(max_chunks), max_distance=max_distance, agencias=agencias, categorias=categorias, debug=debug)
+    similar_chunks = reordenar_chunks(query, similar_chunks, max_chunks, debug=debug)
+    dprint(f"Se encontraron {len(similar_chunks)} chunks similares", debug)
+
+    clave = clave_respuesta(query, similar_chunks)
+    if clave is not None:
+        respuesta = cache_respuestas.get(*clave)
+        if respuesta is not None:
+            yield respuesta
+            return
+
+    prompt = crear_prompt(query, similar_chunks, max_chunks=max_chunks)
+
+    # La respuesta solo se guarda si el stream termina entero
+    fragmentos = []
+    for fragmento in obtener_respuesta_openai_stream(prompt):
+        fragmentos.append(fragmento)
+        yield fragmento
+    if clave is not None:
+        cache_respuestas.put(*clave, "".join(fragmentos))
+
+# Patrón de los bloques de código Python en los que el modelo devuelve cada respuesta hipotética
+patron_respuesta = re.compile(r"```python\s+(.*?)\s+```", re.DOTALL)
+
+def prompt_respuestas_hipoteticas(query: str, num_respuestas: int = 3) -> str:
+    """
+    Crea el prompt que pide al modelo las respuestas hipotéticas a una consulta.
     """
-    prompt = f"""Genera {num_respuestas} posibles respuestas breves a esta pregunta: 
+    return f"""Genera {num_respuestas} posibles respuestas breves a esta pregunta: 
     '{query}'
     Si la pregunta solicita información sobre un viaje las respuestas generadas deben simular respuestas apropiadas para un usuario que busca viajes.
     Las respuestas deben ser diferentes entre sí y cubrir distintos aspectos.
@@ -417,9 +1912,16 @@ def generar_respuestas_hipoteticas(query: str, num_respuestas: int = 3, debug: b
     ```
     
     """
+
+def generar_respuestas_hipoteticas(query: str, num_respuestas: int = 3, debug: bool = False):
+    """
+    Genera múltiples respuestas hipotéticas a la consulta del usuario
+    para mejorar la búsqueda de embeddings.
+    """
+    prompt = prompt_respuestas_hipoteticas(query, num_respuestas)
     
     # Usar un modelo más económico para las respuestas hipotéticas
-    client = openai.OpenAI()
+    client = get_client()
     response = client.chat.completions.create(
         model="gpt-3.5-turbo",
         messages=[{"role": "user", "content": prompt}],
@@ -435,41 +1937,65 @@ def generar_respuestas_hipoteticas(query: str, num_respuestas: int = 3, debug: b
     
     return respuestas
 
-def realizar_consulta_mejorada(query: str, max_chunks: int = 5, max_distance: float = 0.90, responses: int = 3, debug: bool = False):
+def realizar_consulta_mejorada(query: str, max_chunks: int = 5, max_distance: float = 0.90, responses: int = 3, agencias: list[str] = None, categorias: list[str] = None, debug: bool = False):
     """
     Versión mejorada de realizar_consulta que utiliza respuestas hipotéticas
     para mejorar la búsqueda de chunks relevantes.
+    Ejecuta realizar_consulta_mejorada_async en un bucle de eventos propio; desde código
+    asíncrono hay que llamar directamente a realizar_consulta_mejorada_async.
     """
-    # Generar respuestas hipotéticas
-    respuestas_hipoteticas = generar_respuestas_hipoteticas(query, num_respuestas=responses, debug=debug)
-    
-    # Buscar chunks para la consulta original
-    similar_chunks_original = buscar_chunks_similares(query, max_chunks=max_chunks, max_distance=max_distance, debug=debug)
+    return asyncio.run(realizar_consulta_mejorada_async(query, max_chunks=max_chunks, max_distance=max_distance, responses=responses, agencias=agencias, categorias=categorias, debug=debug))
+
+async def realizar_consulta_mejorada_async(query: str, max_chunks: int = 5, max_distance: float = 0.90, responses: int = 3, agencias: list[str] = None, categorias: list[str] = None, debug: bool = False):
+    """
+    Versión asíncrona de realizar_consulta_mejorada.
+    """
+    similar_chunks = await buscar_chunks_mejorada_async(query, max_chunks=max_chunks, max_distance=max_distance, responses=responses, agencias=agencias, categorias=categorias, debug=debug)
     
-    # Buscar chunks para cada respuesta hipotética
-    todos_chunks = similar_chunks_original.copy()
-    for respuesta in respuestas_hipoteticas:
-        chunks_respuesta = buscar_chunks_similares(respuesta, max_chunks=max_chunks, max_distance=max_distance, debug=debug)
-        todos_chunks.extend(chunks_respuesta)
+    # Continuar con el proceso normal
+    prompt = crear_prompt(query, similar_chunks, max_chunks=max_chunks)
+    respuesta = await asyncio.to_thread(obtener_respuesta_openai, prompt)
     
-    # Eliminar duplicados y reordenar por relevancia
-    chunks_unicos = {}
-    for chunk, distance in todos_chunks:
-        if chunk not in chunks_unicos or distance < chunks_unicos[chunk]:
-            chunks_unicos[chunk] = distance
+    return respuesta
+
+def realizar_consulta_mejorada_stream(query: str, max_chunks: int = 5, max_distance: float = 0.90, responses: int = 3, agencias: list[str] = None, categorias: list[str] = None, debug: bool = False):
+    """
+    Igual que realizar_consulta_mejorada, pero devuelve la respuesta de OpenAI según se genera.
     
-    # Convertir a lista ordenada por distancia
-    similar_chunks = [(chunk, dist) for chunk, dist in chunks_unicos.items()]
-    similar_chunks.sort(key=lambda x: x[1])
+    Yields:
+        str: Fragmentos de texto de la respuesta generada por OpenAI.
+    """
+    similar_chunks = asyncio.run(buscar_chunks_mejorada_async(query, max_chunks=max_chunks, max_distance=max_distance, responses=responses, agencias=agencias, categorias=categorias, debug=debug))
+    prompt = crear_prompt(query, similar_chunks, max_chunks=max_chunks)
+
+    yield from obtener_respuesta_openai_stream(prompt)
+
+async def buscar_chunks_mejorada_async(query: str, max_chunks: int = 5, max_distance: float = 0.90, responses: int = 3, agencias: list[str] = None, categorias: list[str] = None, debug: bool = False):
+    """
+    Busca los chunks de la consulta mejorada. La consulta original se busca mientras se generan
+    las respuestas hipotéticas; después, todas las respuestas se buscan a la vez, con una sola
+    petición de embeddings y una única búsqueda en el índice (`buscar_chunks_con_id`).
     
-    # Limitar al número máximo de chunks
-    similar_chunks = similar_chunks[:max_chunks]
+    Returns:
+        list: Los `max_chunks` chunks distintos más relevantes con su distancia.
+    """
+    candidatos = candidatos_busqueda(max_chunks)
+    # Buscar chunks para la consulta original sin esperar a las respuestas hipotéticas
+    busqueda_original = asyncio.create_task(asyncio.to_thread(buscar_chunks_con_id, [query], candidatos, max_distance, agencias, categorias))
+    try:
+        respuestas = await asyncio.to_thread(generar_respuestas_hipoteticas, query, responses, debug)
+        resultados = await asyncio.to_thread(buscar_chunks_con_id, respuestas, candidatos, max_distance, agencias, categorias) if respuestas else []
+    except BaseException:
+        # Recoger la búsqueda original antes de propagar el error, para no dejarla huérfana
+        await asyncio.gather(busqueda_original, return_exceptions=True)
+        raise
     
-    # Continuar con el proceso normal
-    prompt = crear_prompt(query, similar_chunks, max_chunks=max_chunks)
-    respuesta = obtener_respuesta_openai(prompt)
+    # Eliminar duplicados y reordenar por relevancia
+    similar_chunks = combinar_chunks(await busqueda_original + resultados)
+    dprint(f"Chunks distintos tras buscar la consulta y {len(respuestas)} respuestas: {len(similar_chunks)}", debug)
     
-    return respuesta
+    # Reordenar con la consulta original, si hay reordenador, y limitar al número máximo de chunks
+    return reordenar_chunks(query, similar_chunks, max_chunks, debug=debug)
 
 def get_all_file_paths(directory: str=".") -> list[str]:
     """
@@ -509,6 +2035,22 @@ def read_files(directory: str=".", debug: bool = False) -> dict:
     dprint(f"Se encontraron {len(md_files)} archivos .md: {list(md_files.keys())}", debug)
     return md_files
 
+def listar_archivos(directory: str=".", debug: bool = False) -> dict:
+    """
+    Localiza los archivos `.md` del directorio especificado sin leerlos, para indexarlos
+    de forma perezosa con `indexar_archivos`.
+
+    Args:
+        directory (str): El directorio a buscar archivos `.md`. Por defecto es el directorio actual.
+        debug (bool): Si True, muestra mensajes de depuración.
+
+    Returns:
+        dict: Un diccionario con el nombre como clave y la ruta (`Path`) como valor.
+    """
+    md_files = {file_path.name: file_path for file_path in get_all_file_paths(directory)}
+    dprint(f"Se encontraron {len(md_files)} archivos .md: {list(md_files.keys())}", debug)
+    return md_files
+
 def read_file(file_path: Path) -> str:
     """
     Lee el contenido de un archivo `.md` y lo retorna como una cadena de texto.
@@ -523,22 +2065,22 @@ def read_file(file_path: Path) -> str:
     with open(file_path, "r") as file:
         return file.read()
     
-def chunk_files(files: dict, chunk_size: int = 2000, overlap: int = 400) -> list[str]:
+def chunk_files(files: dict, max_tokens: int = 800) -> list[str]:
     """
-    Divide el contenido de cada archivo en fragmentos caracteres, con solapamiento.
+    Divide el contenido de cada archivo en fragmentos siguiendo la estructura del catálogo.
 
     Args:
-        files (dict): Un diccionario con el nombre como clave y el contenido como valor.
-        chunk_size (int): El tamaño de cada fragmento.
-        overlap (int): El número de caracteres solapados entre fragmentos.
+        files (dict): Un diccionario con el nombre como clave y el contenido (o la ruta) como valor.
+        max_tokens (int): Número máximo de tokens estimados de cada fragmento.
 
     Returns:
         list[str]: Una lista de fragmentos de texto, cada uno con el nombre del archivo en la primera línea.
     """
 
     chunks = []
-    for file_name, file_content in files.items():
-        chunks.extend(chunker(file_content, file_name, chunk_size, overlap))
+    with Corpus(files) as corpus:
+        for file_name in corpus:
+            chunks.extend(chunk for _, _, _, chunk in fragmentar(corpus.lineas(file_name), file_name, max_tokens))
 
     return chunks
 
@@ -546,11 +2088,8 @@ def extraer_respuestas(texto: str) -> list[str]:
     """
     Extrae todas las respuestas de un texto que están dentro de bloques de código Python.
     """
-    # Patrón para encontrar bloques de código Python
-    patron = r"```python\s+(.*?)\s+```"
-    
-    # Buscar todas las coincidencias en el texto
-    coincidencias = re.findall(patron, texto, re.DOTALL)
+    # Buscar todas las coincidencias del patrón de bloques de código Python en el texto
+    coincidencias = patron_respuesta.findall(texto)
     
     # Limpiar posibles espacios en blanco al inicio y final de cada respuesta
     respuestas = [resp.strip() for resp in coincidencias]
@@ -559,39 +2098,75 @@ def extraer_respuestas(texto: str) -> list[str]:
 
 @click.command()
 @click.argument('query', required=True)
-@click.option('-c', '--chunk-size', default=2000, help='Tamaño de cada fragmento de texto')
-@click.option('-o', '--overlap', default=400, help='Número de caracteres solapados entre fragmentos')
+@click.option('-t', '--max-tokens', default=800, help='Número máximo de tokens estimados de cada fragmento')
+@click.option('-c', '--chunk-size', type=int, default=None, help='Obsoleto: tamaño de cada fragmento en caracteres, se convierte a --max-tokens')
+@click.option('-o', '--overlap', type=int, default=None, help='Obsoleto: se ignora, los fragmentos ya no se solapan')
 @click.option('-m', '--max-distance', default=0.90, help='Umbral maximo de distancia')
 @click.option('-k', '--max-chunks', default=5, help='Número máximo de chunks a seleccionar')
 @click.option('-r', '--responses', default=3, help='Número de respuestas hipotéticas a generar')
 @click.option('-m', '--mejorada', is_flag=True, default=False, help='Activar búsqueda mejorada')
-@click.option('-f', '--force', is_flag=True, default=False, help='Rehacer la Base de Datos de Embeddings')
+@click.option('-f', '--force', is_flag=True, default=False, help='Rehacer la Base de Datos de Embeddings desde cero')
+@click.option('-b', '--batch-size', default=100, help='Número máximo de chunks por petición de embeddings')
+@click.option('--max-batch-tokens', default=100000, help='Número máximo de tokens estimados por petición de embeddings')
+@click.option('-w', '--workers', default=4, help='Número máximo de peticiones de embeddings simultáneas')
+@click.option('--rpm', default=3000, help='Peticiones de embeddings por minuto permitidas (0 = sin límite)')
+@click.option('--tpm', default=1000000, help='Tokens de embeddings por minuto permitidos (0 = sin límite)')
+@click.option('--indice', type=click.Choice(sorted(indices)), default='exacto', help='Índice vectorial en memoria (exacto o aproximado IVF-PQ)')
+@click.option('--nlist', default=0, help='Listas del índice IVF-PQ (0 = automático)')
+@click.option('--nprobe', default=8, help='Listas del índice IVF-PQ recorridas en cada consulta')
+@click.option('--pq-m', default=16, help='Subespacios de la cuantización por producto del índice IVF-PQ')
+@click.option('--refinar', default=10, help='Factor de candidatos del índice IVF-PQ reordenados con la distancia exacta')
+@click.option('--busqueda', type=click.Choice(['hibrida', 'vectorial']), default='hibrida', help='Búsqueda de chunks: híbrida (léxica y vectorial) o solo vectorial')
+@click.option('--reordenar', type=click.Choice(['ninguno'] + sorted(reordenadores)), default='ninguno', help='Reordenar localmente los candidatos antes de crear el prompt')
+@click.option('--candidatos', default=50, help='Chunks que se piden a la búsqueda para reordenarlos')
+@click.option('--umbral-cache', default=0.95, help='Similitud coseno mínima para reutilizar la respuesta de una consulta parecida')
+@click.option('--sin-cache', is_flag=True, default=False, help='No reutilizar respuestas de consultas parecidas')
+@click.option('--max-tokens-contexto', default=3000, help='Número máximo de tokens del contexto enviado al modelo')
+@click.option('-a', '--agencia', 'agencias', multiple=True, help='Buscar solo en los catálogos de esta agencia (se puede repetir)')
+@click.option('--categoria', 'categorias', multiple=True, help='Buscar solo en esta categoría de ruta (se puede repetir)')
+@click.option('-s', '--stream', is_flag=True, default=False, help='Mostrar la respuesta según se genera')
 @click.option('-d', '--debug', is_flag=True, default=False, help='Activar modo depuración')
-def main(query, chunk_size, overlap, max_distance, max_chunks, responses, mejorada, force, debug):
+def main(query, max_tokens, chunk_size, overlap, max_distance, max_chunks, responses, mejorada, force, batch_size, max_batch_tokens, workers, rpm, tpm, indice, nlist, nprobe, pq_m, refinar, busqueda, reordenar, candidatos, umbral_cache, sin_cache, max_tokens_contexto, agencias, categorias, stream, debug):
     """Inicia RAG básico con metadatos simples."""
 
-    # Si no existe la base de datos de embeddings o se indica con force, se crea una nueva.
-    db_path = os.path.join(get_module_dir(), "embeddings.db")
-    if not os.path.exists(db_path) or force:
-        dprint("Rehaciendo la Base de Datos de Embeddings", debug)
-
-        dprint("Iniciando RAG básico con metadatos simples", debug)
-        dprint(f"Configuración: chunk_size={chunk_size}, overlap={overlap}", debug)
+    # Opciones de la división por caracteres, que se mantienen para no romper los scripts que las usan
+    if chunk_size is not None:
+        max_tokens = max(chunk_size // 3, 1)
+        click.echo(f"Aviso: -c/--chunk-size está obsoleto, se usa --max-tokens {max_tokens}", err=True)
+    if overlap is not None:
+        click.echo("Aviso: -o/--overlap está obsoleto y se ignora, los fragmentos ya no se solapan", err=True)
+
+    # Actualizar la base de datos de embeddings: solo se reindexan los archivos del catálogo que han cambiado
+    dprint(f"Configuración: max_tokens={max_tokens}", debug)
+    files = listar_archivos("./catalogo_md", debug=debug)
+    if files:
+        indexar_archivos(files, max_tokens=max_tokens, force=force, batch_size=batch_size, max_batch_tokens=max_batch_tokens, workers=workers, rpm=rpm, tpm=tpm, debug=debug)
+    else:
+        dprint("No se encontraron archivos del catálogo, se usa la base de datos de embeddings tal cual", debug)
     
-        # Leer archivos y obtener rutas
-        files = read_files("./catalogo_md", debug=debug)
-        
-        # Dividir en chunks con metadatos
-        chunks = chunk_files(files, chunk_size=chunk_size, overlap=overlap)
-
-        populate_embeddings(chunks, debug=debug)
+    if indice == "ivfpq":
+        configurar_indice(indice, nlist=nlist, nprobe=nprobe, pq_m=pq_m, refinar=refinar)
+    configurar_busqueda(busqueda)
+    configurar_reordenado(None if reordenar == 'ninguno' else reordenar, candidatos)
+    configurar_contexto(max_tokens_contexto)
+    configurar_cache_respuestas(umbral_cache, maxsize=0 if sin_cache else 256)
     
     # Realizar la consulta con la query proporcionada
     dprint(f"Realizando consulta: '{query}'", debug)
+    if stream:
+        if mejorada:
+            fragmentos = realizar_consulta_mejorada_stream(query, max_chunks=max_chunks, max_distance=max_distance, responses=responses, agencias=agencias, categorias=categorias, debug=debug)
+        else:
+            fragmentos = realizar_consulta_stream(query, max_chunks=max_chunks, max_distance=max_distance, agencias=agencias, categorias=categorias, debug=debug)
+        for fragmento in fragmentos:
+            print(fragmento, end="", flush=True)
+        print()
+        return
+
     if mejorada:
-        respuesta = realizar_consulta_mejorada(query, max_chunks=max_chunks, max_distance=max_distance, responses=responses, debug=debug)
+        respuesta = realizar_consulta_mejorada(query, max_chunks=max_chunks, max_distance=max_distance, responses=responses, agencias=agencias, categorias=categorias, debug=debug)
     else:
-        respuesta = realizar_consulta(query, max_chunks=max_chunks, max_distance=max_distance, debug=debug)
+        respuesta = realizar_consulta(query, max_chunks=max_chunks, max_distance=max_distance, agencias=agencias, categorias=categorias, debug=debug)
     
     # Esta es la única impresión que no usamos dprint porque es la respuesta final al usuario
     print(respuesta)
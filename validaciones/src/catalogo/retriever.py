@@ -0,0 +1,681 @@
+import os
+import re
+import sqlite3
+import threading
+import numpy as np
+import sqlite_vec
+
+
+def crear_esquema(conn, dimension: int = 1536):
+    """
+    Crea, si no existen, las tablas del índice: la tabla virtual `embeddings` de sqlite-vec, con la
+    agencia como columna de partición y la categoría de ruta como columna de metadatos, y la tabla
+    auxiliar `chunks` con el texto de cada fragmento, el archivo del que sale, su agencia y categoría,
+    su posición en el archivo (inicio y longitud en caracteres) y su hash. Las dos tablas comparten
+    id: el rowid de `embeddings` es el `id` de `chunks`.
+
+    Junto a ellas se crea el índice de texto completo `chunks_fts` (FTS5) sobre el texto de los
+    fragmentos, sin tildes ni mayúsculas. No guarda una copia del texto: lee el de `chunks`, y unos
+    triggers lo mantienen al día con cada inserción o borrado. Si la base de datos ya tenía
+    fragmentos de antes de existir el índice, se construye con ellos.
+
+    Args:
+        conn (sqlite3.Connection): Conexión con la extensión sqlite-vec cargada.
+        dimension (int): Dimensión de los embeddings.
+    """
+    conn.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS embeddings
+        USING vec0(agencia TEXT partition key, categoria TEXT, embedding float[{dimension}])
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS chunks (
+            id INTEGER PRIMARY KEY,
+            archivo TEXT NOT NULL,
+            agencia TEXT NOT NULL,
+            categoria TEXT NOT NULL,
+            inicio INTEGER NOT NULL,
+            longitud INTEGER NOT NULL,
+            hash TEXT NOT NULL,
+            chunk TEXT NOT NULL
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS chunks_archivo ON chunks (archivo)")
+    conn.execute("CREATE INDEX IF NOT EXISTS chunks_hash ON chunks (hash)")
+
+    existia_fts = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'").fetchone()
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts
+        USING fts5(chunk, content='chunks', content_rowid='id', tokenize='unicode61 remove_diacritics 2')
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS chunks_fts_insertar AFTER INSERT ON chunks BEGIN
+            INSERT INTO chunks_fts (rowid, chunk) VALUES (new.id, new.chunk);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS chunks_fts_borrar AFTER DELETE ON chunks BEGIN
+            INSERT INTO chunks_fts (chunks_fts, rowid, chunk) VALUES ('delete', old.id, old.chunk);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS chunks_fts_actualizar AFTER UPDATE OF chunk ON chunks BEGIN
+            INSERT INTO chunks_fts (chunks_fts, rowid, chunk) VALUES ('delete', old.id, old.chunk);
+            INSERT INTO chunks_fts (rowid, chunk) VALUES (new.id, new.chunk);
+        END
+    ''')
+    if not existia_fts:
+        conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')")
+    conn.commit()
+
+
+def expresion_fts(texto: str, frase: bool = False) -> str:
+    """
+    Convierte el texto de una consulta en una expresión de búsqueda de FTS5. Cada palabra va entre
+    comillas, así que los caracteres especiales de la sintaxis de FTS5 no tienen efecto.
+
+    Args:
+        texto (str): El texto de la consulta.
+        frase (bool): Si True, busca las palabras seguidas y en ese orden; si no, cualquiera de ellas.
+
+    Returns:
+        str: La expresión, vacía si el texto no tiene ninguna palabra.
+    """
+    palabras = [f'"{palabra}"' for palabra in re.findall(r"\w+", texto.lower())]
+    if frase:
+        return " + ".join(palabras)
+    return " OR ".join(palabras)
+
+
+def insertar_chunks(conn, filas) -> int:
+    """
+    Inserta fragmentos en `embeddings` y en `chunks` con el mismo id. No hace commit,
+    para que el llamante decida la transacción.
+
+    Args:
+        conn (sqlite3.Connection): Conexión con la extensión sqlite-vec cargada.
+        filas: Tuplas (archivo, agencia, categoria, inicio, longitud, hash, chunk, embedding), con el
+            embedding serializado como float32.
+
+    Returns:
+        int: El número de fragmentos insertados.
+    """
+    siguiente = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM chunks").fetchone()[0]
+    insertados = 0
+    for archivo, agencia, categoria, inicio, longitud, hash_chunk, chunk, embedding in filas:
+        conn.execute(
+            "INSERT INTO embeddings (rowid, agencia, categoria, embedding) VALUES (?, ?, ?, ?)",
+            (siguiente, agencia, categoria, embedding),
+        )
+        conn.execute(
+            "INSERT INTO chunks (id, archivo, agencia, categoria, inicio, longitud, hash, chunk) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (siguiente, archivo, agencia, categoria, inicio, longitud, hash_chunk, chunk),
+        )
+        siguiente += 1
+        insertados += 1
+    return insertados
+
+
+def kmeans(datos: np.ndarray, k: int, iteraciones: int = 20, semilla: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Agrupa vectores en `k` centroides con el algoritmo de Lloyd.
+
+    Args:
+        datos (np.ndarray): Matriz de vectores (n, dim) en float32.
+        k (int): Número de centroides.
+        iteraciones (int): Número de iteraciones.
+        semilla (int): Semilla para la inicialización.
+
+    Returns:
+        tuple: Los centroides (k, dim) y la asignación de cada vector a su centroide.
+    """
+    rng = np.random.default_rng(semilla)
+    k = min(k, len(datos))
+    centroides = datos[rng.choice(len(datos), k, replace=False)].copy()
+    asignaciones = np.zeros(len(datos), dtype=np.int64)
+    for _ in range(iteraciones):
+        asignaciones = asignar(datos, centroides)
+        sumas = np.zeros_like(centroides)
+        np.add.at(sumas, asignaciones, datos)
+        tamanos = np.bincount(asignaciones, minlength=k)
+        vacios = tamanos == 0
+        centroides[~vacios] = sumas[~vacios] / tamanos[~vacios, None]
+        # Los centroides que se quedan sin vectores se reinician en un punto al azar
+        if vacios.any():
+            centroides[vacios] = datos[rng.choice(len(datos), int(vacios.sum()), replace=False)]
+    return centroides, asignar(datos, centroides)
+
+
+def asignar(datos: np.ndarray, centroides: np.ndarray, bloque: int = 8192) -> np.ndarray:
+    """
+    Devuelve el índice del centroide más cercano (distancia euclídea) a cada vector.
+    Se procesa por bloques para no reservar de golpe la matriz completa de distancias.
+    """
+    normas = (centroides ** 2).sum(axis=1)
+    asignaciones = np.empty(len(datos), dtype=np.int64)
+    for inicio in range(0, len(datos), bloque):
+        parte = datos[inicio:inicio + bloque]
+        asignaciones[inicio:inicio + bloque] = np.argmin(normas[None, :] - 2.0 * parte @ centroides.T, axis=1)
+    return asignaciones
+
+
+def top_k(puntuaciones: np.ndarray, k: int) -> np.ndarray:
+    """
+    Devuelve las posiciones de las `k` puntuaciones más altas, ordenadas de mayor a menor.
+    """
+    k = min(k, len(puntuaciones))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    candidatos = np.argpartition(-puntuaciones, k - 1)[:k]
+    return candidatos[np.argsort(-puntuaciones[candidatos])]
+
+
+class IndiceExacto:
+    """
+    Búsqueda exacta por fuerza bruta: un producto matriz-vector contra todos los vectores.
+    """
+
+    def construir(self, matriz: np.ndarray):
+        self.matriz = matriz
+
+    def buscar(self, consulta: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Args:
+            consulta (np.ndarray): Embedding normalizado de la consulta.
+            k (int): Número de vecinos a devolver.
+
+        Returns:
+            tuple: Posiciones de los vecinos y su similitud coseno, de mayor a menor similitud.
+        """
+        similitudes = self.matriz @ consulta
+        candidatos = top_k(similitudes, k)
+        return candidatos, similitudes[candidatos]
+
+    def buscar_batch(self, consultas: np.ndarray, k: int) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        Resuelve varias consultas con un único producto matriz-matriz.
+
+        Args:
+            consultas (np.ndarray): Embeddings normalizados de las consultas (q, dim).
+            k (int): Número de vecinos por consulta.
+
+        Returns:
+            list[tuple]: Para cada consulta, posiciones de los vecinos y su similitud coseno.
+        """
+        similitudes = consultas @ self.matriz.T
+        resultados = []
+        for fila in similitudes:
+            candidatos = top_k(fila, k)
+            resultados.append((candidatos, fila[candidatos]))
+        return resultados
+
+
+class IndiceIVFPQ:
+    """
+    Índice aproximado IVF-PQ (fichero invertido con cuantización por producto).
+
+    Los vectores se reparten en `nlist` listas con k-means. Dentro de cada lista se guarda el residuo
+    respecto a su centroide comprimido con cuantización por producto: `pq_m` subespacios de
+    256 centroides cada uno, un byte por subespacio. Una consulta solo recorre las `nprobe` listas
+    más cercanas y ordena sus vectores con tablas de distancias precalculadas. Los
+    `k * refinar` mejores candidatos se reordenan con los vectores originales.
+
+    Args:
+        nlist (int): Número de listas. Con 0 se usa aproximadamente 4·√n.
+        nprobe (int): Número de listas que se recorren en cada consulta.
+        pq_m (int): Número de subespacios de la cuantización por producto. Debe dividir la dimensión.
+        refinar (int): Factor de candidatos que se reordenan con la distancia exacta. 0 para no refinar.
+        iteraciones (int): Iteraciones de k-means durante la construcción.
+        muestra (int): Número máximo de vectores usados para entrenar los centroides.
+        semilla (int): Semilla de k-means.
+    """
+
+    def __init__(self, nlist: int = 0, nprobe: int = 8, pq_m: int = 16, refinar: int = 10, iteraciones: int = 20, muestra: int = 50000, semilla: int = 0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.pq_m = pq_m
+        self.refinar = refinar
+        self.iteraciones = iteraciones
+        self.muestra = muestra
+        self.semilla = semilla
+
+    def entrenar(self, datos: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Entrena k-means sobre una muestra de los datos y asigna todos los vectores.
+        """
+        if len(datos) > self.muestra:
+            rng = np.random.default_rng(self.semilla)
+            centroides, _ = kmeans(datos[rng.choice(len(datos), self.muestra, replace=False)], k, self.iteraciones, self.semilla)
+            return centroides, asignar(datos, centroides)
+        return kmeans(datos, k, self.iteraciones, self.semilla)
+
+    def construir(self, matriz: np.ndarray):
+        n, dim = matriz.shape
+        if dim % self.pq_m:
+            raise ValueError(f"pq_m ({self.pq_m}) debe dividir la dimensión de los embeddings ({dim})")
+        self.matriz = matriz
+        self.subdim = dim // self.pq_m
+
+        nlist = self.nlist or max(1, int(4 * np.sqrt(n)))
+        self.centroides, asignaciones = self.entrenar(matriz, nlist)
+
+        # Listas invertidas contiguas: los vectores se ordenan por lista y se guarda dónde empieza cada una
+        self.ids = np.argsort(asignaciones, kind="stable")
+        self.inicios = np.concatenate(([0], np.cumsum(np.bincount(asignaciones, minlength=len(self.centroides)))))
+
+        residuos = (matriz - self.centroides[asignaciones])[self.ids]
+        codebooks = []
+        self.codigos = np.empty((n, self.pq_m), dtype=np.uint8)
+        for m in range(self.pq_m):
+            subespacio = np.ascontiguousarray(residuos[:, m * self.subdim:(m + 1) * self.subdim])
+            codebook, codigos = self.entrenar(subespacio, 256)
+            codebooks.append(codebook)
+            self.codigos[:, m] = codigos
+        self.codebooks = np.stack(codebooks)
+        self.lista_de_fila = np.repeat(np.arange(len(self.centroides)), np.diff(self.inicios))
+
+        # ||r - y||² = ||q - c||² + ||y||² - 2·q·y + 2·c·y, con r = q - c el residuo de la consulta.
+        # Todo salvo q·y depende solo del índice y se precalcula por lista, subespacio y centroide.
+        centroides_sub = self.centroides.reshape(len(self.centroides), self.pq_m, self.subdim)
+        self.terminos_listas = (
+            (self.codebooks ** 2).sum(axis=2)[None, :, :]
+            + 2.0 * np.einsum("lmd,mkd->lmk", centroides_sub, self.codebooks)
+        ).astype(np.float32)
+
+    def buscar(self, consulta: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Args:
+            consulta (np.ndarray): Embedding normalizado de la consulta.
+            k (int): Número de vecinos a devolver.
+
+        Returns:
+            tuple: Posiciones de los vecinos y su similitud coseno, de mayor a menor similitud.
+        """
+        distancias_listas = (self.centroides ** 2).sum(axis=1) - 2.0 * self.centroides @ consulta
+        listas = top_k(-distancias_listas, max(self.nprobe, 1))
+
+        filas = np.concatenate([np.arange(self.inicios[lista], self.inicios[lista + 1]) for lista in listas])
+        if not len(filas):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        # Distancias asimétricas: la consulta sin comprimir contra los códigos de cada vector
+        producto = np.einsum("md,mkd->mk", consulta.reshape(self.pq_m, self.subdim), self.codebooks)
+        codigos = self.codigos[filas]
+        subespacios = np.arange(self.pq_m)
+        terminos = self.terminos_listas[self.lista_de_fila[filas][:, None], subespacios, codigos]
+        distancias = (
+            distancias_listas[self.lista_de_fila[filas]] + 1.0
+            + (terminos - 2.0 * producto[subespacios, codigos]).sum(axis=1)
+        )
+        posiciones = self.ids[filas]
+        # Para vectores normalizados, similitud = 1 - distancia² / 2
+        similitudes = 1.0 - distancias / 2.0
+
+        if self.refinar:
+            candidatos = posiciones[top_k(similitudes, k * self.refinar)]
+            similitudes = self.matriz[candidatos] @ consulta
+            mejores = top_k(similitudes, k)
+            return candidatos[mejores], similitudes[mejores]
+
+        mejores = top_k(similitudes, k)
+        return posiciones[mejores], similitudes[mejores]
+
+    def buscar_batch(self, consultas: np.ndarray, k: int) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        Resuelve varias consultas; cada una recorre sus propias listas.
+
+        Args:
+            consultas (np.ndarray): Embeddings normalizados de las consultas (q, dim).
+            k (int): Número de vecinos por consulta.
+
+        Returns:
+            list[tuple]: Para cada consulta, posiciones de los vecinos y su similitud coseno.
+        """
+        return [self.buscar(consulta, k) for consulta in consultas]
+
+
+# Backends disponibles para el índice vectorial en memoria
+indices = {
+    "exacto": IndiceExacto,
+    "ivfpq": IndiceIVFPQ,
+}
+
+
+class Retriever:
+    """
+    Índice vectorial en memoria sobre la tabla `embeddings` de sqlite-vec.
+
+    Carga una sola vez todos los vectores en una matriz contigua de float32 con las filas
+    normalizadas y construye sobre ella el backend elegido: búsqueda exacta con un producto
+    matriz-vector (`exacto`) o un índice aproximado IVF-PQ (`ivfpq`) para catálogos grandes.
+    El índice se recarga solo cuando cambia el fichero de la base de datos. En memoria solo se
+    guardan los vectores, sus ids, su agencia y su categoría; el texto de los resultados se lee
+    después de la tabla `chunks` por id.
+
+    Las búsquedas se pueden filtrar por agencia y por categoría de ruta. El filtro no se aplica
+    sobre los resultados, sino antes de buscar: cada combinación de filtros tiene su propio
+    sub-índice con solo las filas que la cumplen, que se construye la primera vez que se usa.
+
+    Además de la búsqueda vectorial, `buscar_lexico` busca por palabras con BM25 en el índice de
+    texto completo `chunks_fts` de la misma base de datos.
+
+    Las distancias devueltas son distancias euclídeas entre vectores normalizados, las mismas
+    que calcula `vec0` para los embeddings de OpenAI, así que los umbrales de `max_distance`
+    siguen siendo válidos.
+
+    Args:
+        db_path (str): Ruta al fichero `embeddings.db`.
+        indice (str): Backend de búsqueda, una de las claves de `indices`.
+        **parametros: Parámetros del backend (por ejemplo nlist, nprobe o pq_m para `ivfpq`).
+    """
+
+    def __init__(self, db_path: str, indice: str = "exacto", **parametros):
+        if indice not in indices:
+            raise ValueError(f"Índice desconocido: {indice}. Opciones: {sorted(indices)}")
+        self.db_path = db_path
+        self.tipo = indice
+        self.parametros = parametros
+        self.lock = threading.Lock()
+        self.firma = None
+        # Backend, ids, agencias, categorías y sub-índices se sustituyen juntos para que una búsqueda
+        # concurrente vea un estado coherente
+        self.indice = self.vacio()
+
+    # Por debajo de este número de filas los sub-índices filtrados son exactos aunque el backend sea aproximado
+    minimo_aproximado = 10000
+
+    @staticmethod
+    def vacio() -> tuple:
+        """
+        Devuelve el estado de un índice sin vectores.
+        """
+        vacio = np.array([], dtype=object)
+        return None, np.array([], dtype=np.int64), vacio, vacio, {}
+
+    def firma_db(self):
+        """
+        Devuelve una firma del fichero de la base de datos (fecha de modificación y tamaño).
+
+        Returns:
+            tuple: La firma del fichero, o None si no existe.
+        """
+        try:
+            stat = os.stat(self.db_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def cargar(self) -> tuple:
+        """
+        Lee todos los vectores de la base de datos y construye la matriz normalizada.
+
+        Returns:
+            tuple: La matriz de vectores normalizados, sus ids (rowid en `embeddings`), sus agencias
+                y sus categorías.
+        """
+        conn = sqlite3.connect(self.db_path)
+        conn.enable_load_extension(True)
+        sqlite_vec.load(conn)
+        conn.enable_load_extension(False)
+        try:
+            rows = conn.execute("SELECT rowid, agencia, categoria, embedding FROM embeddings ORDER BY rowid").fetchall()
+        finally:
+            conn.close()
+
+        ids = np.array([fila[0] for fila in rows], dtype=np.int64)
+        agencias = np.array([fila[1] for fila in rows], dtype=object)
+        categorias = np.array([fila[2] for fila in rows], dtype=object)
+        if rows:
+            matriz = np.frombuffer(b"".join(fila[3] for fila in rows), dtype=np.float32)
+            matriz = matriz.reshape(len(rows), -1).copy()
+            normas = np.linalg.norm(matriz, axis=1, keepdims=True)
+            matriz /= np.maximum(normas, 1e-12)
+        else:
+            matriz = np.zeros((0, 0), dtype=np.float32)
+
+        return np.ascontiguousarray(matriz), ids, agencias, categorias
+
+    def construir(self) -> tuple:
+        """
+        Carga la base de datos y construye el backend de búsqueda configurado.
+
+        Returns:
+            tuple: El backend construido (o None si no hay vectores), los ids, las agencias, las
+                categorías y un diccionario vacío para los sub-índices filtrados.
+        """
+        matriz, ids, agencias, categorias = self.cargar()
+        if not len(ids):
+            return self.vacio()
+        backend = indices[self.tipo](**self.parametros)
+        backend.construir(matriz)
+        return backend, ids, agencias, categorias, {}
+
+    def actualizar(self):
+        """
+        Recarga el índice si el fichero de la base de datos ha cambiado desde la última carga.
+        """
+        firma = self.firma_db()
+        if firma == self.firma:
+            return
+        with self.lock:
+            if firma != self.firma:
+                self.indice = self.vacio() if firma is None else self.construir()
+                self.firma = firma
+
+    def __len__(self):
+        return len(self.indice[1])
+
+    def particion(self, agencias: list[str] = None, categorias: list[str] = None) -> tuple:
+        """
+        Devuelve el índice sobre el que buscar con los filtros indicados. Sin filtros es el índice
+        completo; con filtros, un sub-índice con solo las filas de esas agencias y categorías, que
+        se construye la primera vez que se pide y se conserva hasta la siguiente recarga.
+
+        Args:
+            agencias (list[str]): Agencias permitidas. None o vacío para no filtrar.
+            categorias (list[str]): Categorías de ruta permitidas. None o vacío para no filtrar.
+
+        Returns:
+            tuple: El backend (None si ninguna fila cumple los filtros) y los ids de sus filas.
+        """
+        self.actualizar()
+        backend, ids, agencias_filas, categorias_filas, particiones = self.indice
+        if backend is None or (not agencias and not categorias):
+            return backend, ids
+
+        clave = (frozenset(agencias or ()), frozenset(categorias or ()))
+        if clave not in particiones:
+            with self.lock:
+                if clave not in particiones:
+                    mascara = np.ones(len(ids), dtype=bool)
+                    if agencias:
+                        mascara &= np.isin(agencias_filas, list(agencias))
+                    if categorias:
+                        mascara &= np.isin(categorias_filas, list(categorias))
+                    posiciones = np.flatnonzero(mascara)
+
+                    subindice = None
+                    if len(posiciones):
+                        aproximado = len(posiciones) >= self.minimo_aproximado
+                        subindice = indices[self.tipo](**self.parametros) if aproximado else IndiceExacto()
+                        subindice.construir(np.ascontiguousarray(backend.matriz[posiciones]))
+                    particiones[clave] = (subindice, ids[posiciones])
+        return particiones[clave]
+
+    def buscar_lexico(self, consulta: str, k: int = 5, agencias: list[str] = None, categorias: list[str] = None, frase: bool = False) -> list[tuple[int, str, float]]:
+        """
+        Busca los chunks que contienen las palabras de una consulta en el índice de texto completo
+        `chunks_fts` y los ordena por BM25. No necesita el embedding de la consulta.
+
+        Args:
+            consulta (str): El texto de la consulta.
+            k (int): Número máximo de chunks a devolver.
+            agencias (list[str]): Buscar solo en los chunks de estas agencias. None para no filtrar.
+            categorias (list[str]): Buscar solo en los chunks de estas categorías de ruta. None para no filtrar.
+            frase (bool): Si True, solo los chunks con todas las palabras seguidas y en orden.
+
+        Returns:
+            list[tuple[int, str, float]]: Ternas (id, chunk, puntuación BM25) de mejor a peor. En
+                FTS5 la puntuación es negativa y menor cuanto más relevante es el chunk.
+        """
+        expresion = expresion_fts(consulta, frase)
+        if not expresion or k <= 0 or not os.path.exists(self.db_path):
+            return []
+        condiciones, parametros = ["chunks_fts MATCH ?"], [expresion]
+        for columna, valores in (("agencia", agencias), ("categoria", categorias)):
+            if valores:
+                condiciones.append(f"c.{columna} IN ({', '.join('?' * len(valores))})")
+                parametros.extend(valores)
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute(f'''
+                SELECT c.id, c.chunk, bm25(chunks_fts) AS puntuacion
+                FROM chunks_fts JOIN chunks c ON c.id = chunks_fts.rowid
+                WHERE {" AND ".join(condiciones)}
+                ORDER BY puntuacion
+                LIMIT ?
+            ''', parametros + [k]).fetchall()
+        except sqlite3.OperationalError:
+            # Base de datos sin índice de texto completo
+            return []
+        finally:
+            conn.close()
+
+    def distancias(self, query_embedding: list[float], ids) -> dict[int, float]:
+        """
+        Calcula la distancia exacta entre un embedding y los vectores de varios chunks, por
+        ejemplo de los que solo ha encontrado la búsqueda léxica.
+
+        Args:
+            query_embedding (list[float]): Embedding de la consulta.
+            ids: Ids de los chunks.
+
+        Returns:
+            dict[int, float]: La distancia de cada id. Los ids que no están en el índice no aparecen.
+        """
+        self.actualizar()
+        backend, ids_indice = self.indice[:2]
+        ids = np.array(list(ids), dtype=np.int64)
+        if backend is None or not len(ids):
+            return {}
+        posiciones = np.minimum(np.searchsorted(ids_indice, ids), len(ids_indice) - 1)
+        encontrados = ids_indice[posiciones] == ids
+        similitudes = backend.matriz[posiciones[encontrados]] @ self.normalizar(query_embedding)[0]
+        distancias = np.sqrt(np.maximum(2.0 - 2.0 * similitudes, 0.0))
+        return {int(id_chunk): float(distancia) for id_chunk, distancia in zip(ids[encontrados], distancias)}
+
+    def obtener_chunks(self, ids) -> dict[int, str]:
+        """
+        Lee de la tabla `chunks` el texto de los fragmentos indicados.
+
+        Args:
+            ids: Ids de los fragmentos.
+
+        Returns:
+            dict[int, str]: El texto de cada id. Los ids que ya no existen no aparecen.
+        """
+        ids = list(dict.fromkeys(int(i) for i in ids))
+        if not ids:
+            return {}
+        conn = sqlite3.connect(self.db_path)
+        try:
+            marcas = ", ".join("?" * len(ids))
+            return dict(conn.execute(f"SELECT id, chunk FROM chunks WHERE id IN ({marcas})", ids))
+        finally:
+            conn.close()
+
+    def obtener_origen(self, hashes) -> dict[str, tuple[str, str, int, int]]:
+        """
+        Lee de la tabla `chunks` de dónde sale cada fragmento, buscándolo por el hash de su texto.
+
+        Args:
+            hashes: Hashes de los fragmentos (ver `get_text_hash`).
+
+        Returns:
+            dict[str, tuple[str, str, int, int]]: Para cada hash encontrado, el archivo, la agencia,
+                el inicio y la longitud del fragmento en el archivo. Si el mismo texto aparece
+                varias veces, se devuelve una de ellas.
+        """
+        hashes = list(dict.fromkeys(hashes))
+        if not hashes or not os.path.exists(self.db_path):
+            return {}
+        conn = sqlite3.connect(self.db_path)
+        try:
+            marcas = ", ".join("?" * len(hashes))
+            filas = conn.execute(f"SELECT hash, archivo, agencia, inicio, longitud FROM chunks WHERE hash IN ({marcas})", hashes)
+            return {fila[0]: tuple(fila[1:]) for fila in filas}
+        except sqlite3.OperationalError:
+            # Base de datos sin tabla `chunks`
+            return {}
+        finally:
+            conn.close()
+
+    def normalizar(self, embeddings) -> np.ndarray:
+        """
+        Convierte uno o varios embeddings en vectores float32 de norma 1.
+        """
+        consultas = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        return consultas / np.maximum(np.linalg.norm(consultas, axis=1, keepdims=True), 1e-12)
+
+    def buscar(self, query_embedding: list[float], k: int = 5, max_distance: float = None, agencias: list[str] = None, categorias: list[str] = None) -> list[tuple[str, float]]:
+        """
+        Devuelve los `k` chunks más cercanos a un embedding.
+
+        Args:
+            query_embedding (list[float]): Embedding de la consulta.
+            k (int): Número máximo de chunks a devolver.
+            max_distance (float): Umbral máximo de distancia. None para no filtrar.
+            agencias (list[str]): Buscar solo en los chunks de estas agencias. None para no filtrar.
+            categorias (list[str]): Buscar solo en los chunks de estas categorías de ruta. None para no filtrar.
+
+        Returns:
+            list[tuple[str, float]]: Pares (chunk, distancia) ordenados por distancia.
+        """
+        backend, ids = self.particion(agencias, categorias)
+        if backend is None or k <= 0:
+            return []
+
+        candidatos, similitudes = backend.buscar(self.normalizar(query_embedding)[0], k)
+        distancias = np.sqrt(np.maximum(2.0 - 2.0 * similitudes, 0.0))
+        encontrados = [
+            (int(ids[i]), float(distancia))
+            for i, distancia in zip(candidatos, distancias)
+            if max_distance is None or distancia < max_distance
+        ]
+
+        textos = self.obtener_chunks(id_chunk for id_chunk, _ in encontrados)
+        return [(textos[id_chunk], distancia) for id_chunk, distancia in encontrados if id_chunk in textos]
+
+    def buscar_batch(self, query_embeddings: list[list[float]], k: int = 5, max_distance: float = None, agencias: list[str] = None, categorias: list[str] = None) -> list[list[tuple[int, str, float]]]:
+        """
+        Devuelve los `k` chunks más cercanos a cada uno de varios embeddings en una sola pasada.
+
+        Args:
+            query_embeddings (list[list[float]]): Embeddings de las consultas.
+            k (int): Número máximo de chunks a devolver por consulta.
+            max_distance (float): Umbral máximo de distancia. None para no filtrar.
+            agencias (list[str]): Buscar solo en los chunks de estas agencias. None para no filtrar.
+            categorias (list[str]): Buscar solo en los chunks de estas categorías de ruta. None para no filtrar.
+
+        Returns:
+            list[list[tuple[int, str, float]]]: Para cada consulta, ternas (id, chunk, distancia)
+                ordenadas por distancia. El id es el rowid del chunk en `embeddings`.
+        """
+        backend, ids = self.particion(agencias, categorias)
+        if backend is None or k <= 0 or not len(query_embeddings):
+            return [[] for _ in query_embeddings]
+
+        encontrados = []
+        for candidatos, similitudes in backend.buscar_batch(self.normalizar(query_embeddings), k):
+            distancias = np.sqrt(np.maximum(2.0 - 2.0 * similitudes, 0.0))
+            encontrados.append([
+                (int(ids[i]), float(distancia))
+                for i, distancia in zip(candidatos, distancias)
+                if max_distance is None or distancia < max_distance
+            ])
+
+        # El texto de todas las consultas se lee con una sola consulta a la tabla `chunks`
+        textos = self.obtener_chunks(id_chunk for resultados in encontrados for id_chunk, _ in resultados)
+        return [
+            [(id_chunk, textos[id_chunk], distancia) for id_chunk, distancia in resultados if id_chunk in textos]
+            for resultados in encontrados
+        ]
@@ -0,0 +1,1016 @@
+import asyncio
+import base64
+import hashlib
+import json
+import sqlite3
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import numpy as np
+import pytest
+from click.testing import CliRunner
+from catalogo import agent, benchmark_reordenado, openai_client, rag
+from catalogo.corpus import Corpus
+from catalogo.reordenador import ReordenadorLexico
+from catalogo.retriever import IndiceExacto, IndiceIVFPQ, Retriever, crear_esquema, insertar_chunks
+
+
+def fake_embedding(text: str, dim: int = 1536) -> list[float]:
+    """
+    Genera un embedding determinista a partir del hash del texto.
+    """
+    semilla = hashlib.sha256(text.encode("utf-8")).digest()
+    return [((semilla[i % len(semilla)] + i) % 255) / 255.0 for i in range(dim)]
+
+
+class FakeEmbeddingHandler(BaseHTTPRequestHandler):
+    """
+    Endpoint local que imita `POST /v1/embeddings` de OpenAI.
+    """
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.path.endswith("/chat/completions"):
+            return self.chat(body)
+
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        self.server.peticiones.append(inputs)
+        self.server.eventos.append(("embeddings", inputs))
+
+        data = []
+        for i, text in enumerate(inputs):
+            embedding = fake_embedding(text)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(struct.pack(f"{len(embedding)}f", *embedding)).decode()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+
+        payload = json.dumps({
+            "object": "list",
+            "data": data,
+            "model": body["model"],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def chat(self, body):
+        """
+        Imita `POST /v1/chat/completions`. En streaming devuelve los fragmentos de `self.server.tokens`
+        o, si no hay, las respuestas hipotéticas de `self.server.respuestas_hipoteticas` una a una,
+        con una pausa entre ellas. Sin streaming, el modelo de las respuestas hipotéticas las
+        devuelve todas tras una pausa y los demás responden "respuesta final".
+        """
+        if not body.get("stream"):
+            contenido = "respuesta final"
+            if body["model"] == "gpt-3.5-turbo" and self.server.respuestas_hipoteticas:
+                time.sleep(0.2)
+                contenido = "".join(f"```python\n{respuesta}\n```\n\n" for respuesta in self.server.respuestas_hipoteticas)
+                self.server.eventos.append(("fin_generacion", None))
+            self.enviar_json({
+                "id": "chat", "object": "chat.completion", "created": 0, "model": body["model"],
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": contenido}}],
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        fragmentos = self.server.tokens or [f"```python\n{respuesta}\n```\n\n" for respuesta in self.server.respuestas_hipoteticas]
+        for fragmento in fragmentos:
+            evento = {
+                "id": "chat", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                "choices": [{"index": 0, "finish_reason": None, "delta": {"content": fragmento}}],
+            }
+            self.wfile.write(f"data: {json.dumps(evento)}\n\n".encode())
+            self.wfile.flush()
+            if not self.server.tokens:
+                time.sleep(0.2)
+        self.server.eventos.append(("fin_stream", None))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def enviar_json(self, datos):
+        payload = json.dumps(datos).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def fake_openai(monkeypatch, tmp_path):
+    """
+    Levanta el endpoint falso y redirige la API de OpenAI y las bases de datos a un directorio temporal.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeEmbeddingHandler)
+    server.peticiones = []
+    server.eventos = []
+    server.respuestas_hipoteticas = []
+    server.tokens = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    monkeypatch.setenv("OPENAI_BASE_URL", f"http://127.0.0.1:{server.server_port}/v1")
+    monkeypatch.setattr(rag, "get_module_dir", lambda: str(tmp_path))
+    monkeypatch.setattr(rag, "query_embedding_cache", rag.CacheLRU(maxsize=16, ttl=60))
+    monkeypatch.setattr(rag, "cache_respuestas", rag.CacheRespuestas(umbral=0.95, maxsize=16, ttl=60))
+    openai_client.configurar_cliente()
+
+    yield server
+
+    openai_client.configurar_cliente()
+    server.shutdown()
+    server.server_close()
+
+
+def test_agrupar_en_lotes_respeta_tamano_y_tokens():
+    textos = ["a" * 30] * 7
+    assert [len(lote) for lote in rag.agrupar_en_lotes(textos, batch_size=3)] == [3, 3, 1]
+    assert [len(lote) for lote in rag.agrupar_en_lotes(textos, batch_size=10, max_batch_tokens=25)] == [2, 2, 2, 1]
+
+
+def test_get_embeddings_batch_agrupa_peticiones(fake_openai):
+    textos = [f"chunk {i}" for i in range(25)]
+    embeddings = rag.get_embeddings_batch(textos, batch_size=10)
+
+    assert sorted(len(lote) for lote in fake_openai.peticiones) == [5, 10, 10]
+    assert embeddings[3] == pytest.approx(fake_embedding("chunk 3"))
+
+
+def test_get_embeddings_batch_en_paralelo_mantiene_el_orden(fake_openai):
+    textos = [f"chunk {i}" for i in range(40)]
+    embeddings = rag.get_embeddings_batch(textos, batch_size=5, workers=4)
+
+    assert len(fake_openai.peticiones) == 8
+    assert all(embedding == pytest.approx(fake_embedding(texto)) for texto, embedding in zip(textos, embeddings))
+
+
+def test_limitador_tasa_espera_cuando_se_agota_el_presupuesto(monkeypatch):
+    esperas = []
+    reloj = [0.0]
+    monkeypatch.setattr(rag.time, "monotonic", lambda: reloj[0])
+
+    def sleep(segundos):
+        esperas.append(segundos)
+        reloj[0] += segundos
+
+    monkeypatch.setattr(rag.time, "sleep", sleep)
+
+    limitador = rag.LimitadorTasa(rpm=2, tpm=100)
+    limitador.adquirir(10)
+    limitador.adquirir(10)
+    assert esperas == []
+
+    limitador.adquirir(10)
+    assert esperas == [60.0]
+
+    limitador.adquirir(95)
+    assert sum(esperas) == 120.0
+
+
+def test_get_embeddings_batch_usa_la_cache(fake_openai):
+    rag.get_embeddings_batch(["uno", "dos"], batch_size=10)
+    fake_openai.peticiones.clear()
+
+    embeddings = rag.get_embeddings_batch(["uno", "dos", "tres", "tres"], batch_size=10)
+
+    assert fake_openai.peticiones == [["tres"]]
+    assert embeddings[2] == embeddings[3]
+
+
+def test_populate_embeddings_inserta_todos_los_chunks(fake_openai, tmp_path):
+    chunks = [f"fragmento {i}" for i in range(12)]
+    rag.populate_embeddings(chunks, batch_size=5)
+
+    conn = rag.sqlite3.connect(tmp_path / "embeddings.db")
+    rag.load_sqlite_vec(conn)
+    assert conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] == 12
+    conn.close()
+    assert len(fake_openai.peticiones) == 3
+
+
+CATALOGO = (
+    "ISLAS\n\n"
+    "MALLORCA\n\n"
+    "ITINERARIO\n8 días / 7 noches\n\n"
+    "DÍA 1. MADRID - MALLORCA\nVuelo a Palma. Cena y alojamiento.\n\n"
+    "DÍA 2. PALMA\nVisita de la catedral y del casco antiguo.\n\n"
+    "DÍA 3. SÓLLER\nExcursión en tren a Sóller y al puerto.\n\n"
+    "CRUCEROS\n\n"
+    "FIORDOS\n\nITINERARIO\nDÍA 1. BERGEN\nEmbarque.\n"
+)
+
+
+def test_fragmentar_corta_entre_rutas_y_dias():
+    fragmentos = list(rag.fragmentar(rag.leer_lineas(CATALOGO), "a.md", max_tokens=50))
+    cuerpos = [chunk.split("\n", 1)[1] for _, _, _, chunk in fragmentos]
+
+    # Sin solapamiento: cada fragmento es un trozo exacto del archivo, en orden y sin pasarse del presupuesto
+    assert len(fragmentos) > 2
+    for (inicio, longitud, _, chunk), siguiente in zip(fragmentos, fragmentos[1:]):
+        assert chunk.endswith(CATALOGO[inicio:inicio + longitud])
+        assert inicio + longitud <= siguiente[0]
+        assert rag.estimar_tokens(chunk) <= 50
+    # Los cortes caen en encabezados, el título de la ruta va con su itinerario y los días no se parten
+    assert all(cuerpo.startswith(("ISLAS", "MALLORCA", "DÍA", "CRUCEROS")) for cuerpo in cuerpos)
+    assert any("MALLORCA\n\nITINERARIO" in cuerpo for cuerpo in cuerpos)
+    for dia in ["DÍA 2. PALMA\nVisita de la catedral y del casco antiguo.", "DÍA 3. SÓLLER\nExcursión en tren a Sóller y al puerto."]:
+        assert sum(dia in cuerpo for cuerpo in cuerpos) == 1
+    # Una categoría nueva empieza siempre un fragmento
+    assert [categoria for _, _, categoria, chunk in fragmentos if "FIORDOS" in chunk] == ["Cruceros"]
+    assert all(categoria == "Islas" for _, _, categoria, chunk in fragmentos if "DÍA 2" in chunk)
+
+
+def test_fragmentar_parte_los_parrafos_que_no_caben():
+    texto = "Roma " * 200
+
+    fragmentos = rag.chunker(texto, max_tokens=50)
+
+    assert all(rag.estimar_tokens(chunk) <= 50 for chunk in fragmentos)
+    assert "".join(fragmentos).replace(" ", "") == texto.replace(" ", "")
+
+
+def test_indexar_archivos_lee_las_rutas_por_lineas(fake_openai, monkeypatch, tmp_path):
+    ruta = tmp_path / "a.md"
+    ruta.write_text(CATALOGO, encoding="utf-8")
+    # Varias ventanas de chunks, cada una decodificada por separado
+    monkeypatch.setattr(rag, "ventana_indexacion", 2)
+
+    assert rag.indexar_archivos({"a.md": ruta}, max_tokens=50)["chunks_insertados"] == len(rag.chunker(CATALOGO, "a.md", 50))
+
+    # El texto guardado de cada chunk es el mismo que al dividir el contenido completo
+    conn = sqlite3.connect(str(tmp_path / "embeddings.db"))
+    assert [chunk for chunk, in conn.execute("SELECT chunk FROM chunks ORDER BY inicio")] == rag.chunker(CATALOGO, "a.md", 50)
+    conn.close()
+    # El hash calculado sobre el archivo proyectado es el mismo que el del contenido completo
+    assert rag.indexar_archivos({"a.md": CATALOGO}, max_tokens=50)["archivos_reindexados"] == 0
+
+
+def test_corpus_decodifica_las_vistas_del_archivo_proyectado(tmp_path):
+    ruta = tmp_path / "a.md"
+    ruta.write_text(CATALOGO, encoding="utf-8")
+
+    with Corpus({"a.md": ruta, "b.md": CATALOGO}) as corpus:
+        assert corpus.hash("a.md") == corpus.hash("b.md") == rag.get_text_hash(CATALOGO)
+        assert "".join(corpus.lineas("a.md")) == CATALOGO
+        fragmentos = list(rag.fragmentar(corpus.lineas("a.md"), "a.md", max_tokens=30))
+        # Las posiciones son de caracteres aunque el archivo tenga tildes, que ocupan dos bytes
+        for inicio, longitud, _, chunk in fragmentos:
+            assert chunk == rag.cabecera_chunk("a.md") + corpus.texto("a.md", inicio, longitud)
+        assert corpus.texto("b.md", CATALOGO.index("SÓLLER"), 6) == "SÓLLER"
+    assert not corpus.datos
+
+
+def filas_embeddings(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "embeddings.db"))
+    rag.load_sqlite_vec(conn)
+    filas = conn.execute("SELECT id, chunk, archivo FROM chunks ORDER BY id").fetchall()
+    # Cada fila de `chunks` tiene su vector en `embeddings` con el mismo id
+    assert [rowid for rowid, in conn.execute("SELECT rowid FROM embeddings ORDER BY rowid")] == [fila[0] for fila in filas]
+    conn.close()
+    return filas
+
+
+def test_main_acepta_las_opciones_obsoletas_de_chunking(monkeypatch):
+    indexados = []
+    monkeypatch.setattr(rag, "listar_archivos", lambda *args, **kwargs: {"a.md": "Roma"})
+    monkeypatch.setattr(rag, "indexar_archivos", lambda files, max_tokens, **kwargs: indexados.append(max_tokens))
+    monkeypatch.setattr(rag, "realizar_consulta", lambda *args, **kwargs: "respuesta")
+    for nombre in ("configurar_busqueda", "configurar_reordenado", "configurar_contexto", "configurar_cache_respuestas"):
+        monkeypatch.setattr(rag, nombre, lambda *args, **kwargs: None)
+
+    resultado = CliRunner().invoke(rag.main, ["Viajes a Roma", "-c", "1200", "-o", "200"])
+
+    assert resultado.exit_code == 0, resultado.output
+    assert indexados == [400]
+    assert "--chunk-size está obsoleto" in resultado.output
+    assert "--overlap está obsoleto" in resultado.output
+
+
+def test_indexar_archivos_solo_reindexa_lo_que_cambia(fake_openai, tmp_path):
+    files = {"a.md": "Roma " * 30, "b.md": "Kenia " * 30}
+    primera = rag.indexar_archivos(files, max_tokens=30)
+    filas = filas_embeddings(tmp_path)
+    assert primera["archivos_reindexados"] == 2
+    assert primera["chunks_insertados"] == len(filas) > 2
+
+    # Sin cambios no se toca nada ni se piden embeddings
+    fake_openai.peticiones.clear()
+    assert rag.indexar_archivos(files, max_tokens=30)["archivos_reindexados"] == 0
+    assert fake_openai.peticiones == []
+    assert filas_embeddings(tmp_path) == filas
+
+    # Al añadir texto a un archivo solo se insertan sus chunks nuevos y se borran los que cambian
+    files["a.md"] += "Florencia " * 5
+    rag.indexar_archivos(files, max_tokens=30)
+    nuevas = filas_embeddings(tmp_path)
+    assert [fila for fila in nuevas if fila[2] == "b.md"] == [fila for fila in filas if fila[2] == "b.md"]
+    assert sorted(chunk for _, chunk, archivo in nuevas if archivo == "a.md") == sorted(rag.chunker(files["a.md"], "a.md", 30))
+
+    # Los chunks de un archivo eliminado desaparecen del índice
+    del files["b.md"]
+    resumen = rag.indexar_archivos(files, max_tokens=30)
+    assert resumen["archivos_eliminados"] == 1
+    assert {archivo for _, _, archivo in filas_embeddings(tmp_path)} == {"a.md"}
+
+
+def test_indexar_archivos_conserva_los_chunks_de_populate_embeddings(fake_openai, monkeypatch, tmp_path):
+    monkeypatch.setattr(rag, "retrievers", {})
+    rag.populate_embeddings(["Roma en verano", "Playas de Mallorca"])
+    rag.indexar_archivos({"a.md": "Kenia " * 30}, max_tokens=30)
+
+    assert [chunk for _, chunk, archivo in filas_embeddings(tmp_path) if archivo == rag.origen_populate] == ["Roma en verano", "Playas de Mallorca"]
+    # No tienen posición en ningún archivo, así que no se funden entre sí
+    contexto = rag.construir_contexto([("Roma en verano", 0.1), ("Playas de Mallorca", 0.2)])
+    assert contexto == "Roma en verano\n\nPlayas de Mallorca"
+
+    # Al rehacer el índice con force se borran
+    rag.indexar_archivos({"a.md": "Kenia " * 30}, max_tokens=30, force=True)
+    assert {archivo for _, _, archivo in filas_embeddings(tmp_path)} == {"a.md"}
+
+
+def test_indexar_archivos_guarda_agencia_y_posicion(fake_openai, tmp_path):
+    contenido = "Roma y Florencia. " * 20
+    rag.indexar_archivos({"rc25_cibeles_v2.md": contenido, "b.md": "Kenia " * 30}, max_tokens=30)
+
+    conn = sqlite3.connect(str(tmp_path / "embeddings.db"))
+    rag.load_sqlite_vec(conn)
+    for agencia, inicio, longitud, chunk in conn.execute("SELECT agencia, inicio, longitud, chunk FROM chunks WHERE archivo = 'rc25_cibeles_v2.md'"):
+        assert agencia == "Cibeles"
+        assert chunk.endswith(contenido[inicio:inicio + longitud])
+
+    # La agencia es la clave de partición de `vec0`: la búsqueda filtrada solo ve los chunks de esa agencia
+    consulta = rag.sqlite_vec.serialize_float32(fake_embedding("Kenia"))
+    rowids = [rowid for rowid, in conn.execute("SELECT rowid FROM embeddings WHERE embedding MATCH ? AND k = 20 AND agencia = 'Cibeles'", (consulta,))]
+    conn.close()
+    assert len(rowids) == len(rag.chunker(contenido, "rc25_cibeles_v2.md", 30))
+
+
+def test_indexar_archivos_guarda_la_categoria_de_cada_seccion(fake_openai, tmp_path):
+    contenido = "Presentación del catálogo.\n" + "ISLAS\n" + "Mallorca y Menorca. " * 10 + "\n## CRUCEROS\n" + "Fiordos noruegos. " * 10
+    rag.indexar_archivos({"a.md": contenido}, max_tokens=30)
+
+    conn = sqlite3.connect(str(tmp_path / "embeddings.db"))
+    rag.load_sqlite_vec(conn)
+    categorias = [categoria for categoria, in conn.execute("SELECT categoria FROM chunks ORDER BY inicio")]
+    conn.close()
+    assert categorias[0] == ""
+    assert set(categorias) == {"", "Islas", "Cruceros"}
+    assert categorias.index("Cruceros") > categorias.index("Islas")
+
+
+def test_resolver_filtro_sin_tildes_ni_mayusculas():
+    agencias = list(rag.titulos.values())
+
+    assert rag.resolver_filtro(["halcón viajes"], agencias) == ["Halcon Viajes"]
+    assert rag.resolver_filtro(["Carrefour"], agencias) == ["B Travel | Carrefour Viajes"]
+    assert rag.resolver_filtro(["B Travel"], agencias) == ["B Travel"]
+    assert rag.resolver_filtro(["Mercadillos Navideños"], rag.categorias_ruta) == ["Mercadillos navideños"]
+    assert rag.resolver_filtro(["Desconocida"], agencias) == []
+    assert rag.resolver_filtro(None, agencias) == []
+
+
+def test_indexar_archivos_rehace_una_db_con_el_esquema_antiguo(fake_openai, tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "embeddings.db"))
+    rag.load_sqlite_vec(conn)
+    conn.execute("CREATE VIRTUAL TABLE embeddings USING vec0(chunk TEXT, embedding float[1536])")
+    conn.execute("INSERT INTO embeddings (embedding, chunk) VALUES (?, ?)", (rag.sqlite_vec.serialize_float32(fake_embedding("x")), "chunk antiguo"))
+    conn.commit()
+    conn.close()
+
+    rag.indexar_archivos({"a.md": "Roma"})
+
+    assert [chunk for _, chunk, _ in filas_embeddings(tmp_path)] == rag.chunker("Roma", "a.md")
+
+
+def test_embedding_cache_get_many_en_una_consulta(tmp_path):
+    cache = rag.EmbeddingCache(str(tmp_path / "cache.db"))
+    cache.put_many([(f"h{i}", f"texto {i}", [float(i)] * 3) for i in range(2000)])
+
+    encontrados = cache.get_many(["h1", "h1999", "no-existe"])
+
+    assert encontrados == {"h1": [1.0] * 3, "h1999": [1999.0] * 3}
+    assert cache.get("no-existe") is None
+    cache.close()
+
+
+def test_embedding_cache_reutiliza_la_conexion_en_wal(tmp_path):
+    cache = rag.EmbeddingCache(str(tmp_path / "cache.db"))
+
+    conn = cache.conexion()
+
+    assert cache.conexion() is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    cache.close()
+
+
+def test_embedding_cache_guarda_float32(tmp_path):
+    cache = rag.EmbeddingCache(str(tmp_path / "cache.db"))
+    cache.put("h", "texto", [0.5, -1.25, 2.0])
+
+    blob = cache.conexion().execute("SELECT embedding FROM embedding_cache").fetchone()[0]
+
+    assert blob == rag.sqlite_vec.serialize_float32([0.5, -1.25, 2.0])
+    assert cache.get("h") == [0.5, -1.25, 2.0]
+    assert cache.get_many(["h"], serializados=True) == {"h": blob}
+    cache.close()
+
+
+def test_embedding_cache_migra_filas_json(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+    conn = rag.sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE embedding_cache (text_hash TEXT PRIMARY KEY, text TEXT, embedding BLOB, created_at DATETIME DEFAULT CURRENT_TIMESTAMP)")
+    conn.execute("INSERT INTO embedding_cache (text_hash, text, embedding) VALUES ('h', 'texto', '[0.5, 0.25]')")
+    conn.commit()
+    conn.close()
+
+    cache = rag.EmbeddingCache(db_path)
+
+    assert cache.get("h") == [0.5, 0.25]
+    assert cache.conexion().execute("SELECT typeof(embedding) FROM embedding_cache").fetchone()[0] == "blob"
+    cache.close()
+
+
+def test_cache_lru_expulsa_y_caduca(monkeypatch):
+    reloj = [0.0]
+    monkeypatch.setattr(rag.time, "monotonic", lambda: reloj[0])
+    cache = rag.CacheLRU(maxsize=2, ttl=10)
+
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    reloj[0] = 11.0
+    assert cache.get("a") is None
+    assert cache.estadisticas() == {"hits": 1, "misses": 2, "size": 1}
+
+
+def test_get_embeddings_query_no_repite_peticiones(fake_openai):
+    primero = rag.get_embeddings_query("viajes a Mallorca en junio")
+    segundo = rag.get_embeddings_query("viajes a Mallorca en junio")
+
+    assert len(fake_openai.peticiones) == 1
+    assert segundo == primero
+    assert rag.query_embedding_cache.estadisticas()["hits"] == 1
+
+    rag.query_embedding_cache.clear()
+    rag.get_embeddings_query("viajes a Mallorca en junio")
+
+    assert len(fake_openai.peticiones) == 1
+    assert rag.estadisticas_cache_consultas()["persistente"]["hits"] == 1
+
+
+def test_cliente_compartido_con_transporte_inyectado(monkeypatch):
+    peticiones = []
+
+    def handler(request):
+        peticiones.append(request)
+        body = json.loads(request.content)
+        return httpx.Response(200, json={
+            "object": "list",
+            "data": [{"object": "embedding", "index": 0, "embedding": [0.1, 0.2]}],
+            "model": body["model"],
+            "usage": {"prompt_tokens": 0, "total_tokens": 0},
+        })
+
+    monkeypatch.setenv("OPENAI_API_KEY", "sk-test")
+    openai_client.configurar_cliente(transport=httpx.MockTransport(handler), base_url="http://stub/v1")
+    try:
+        assert openai_client.get_client() is openai_client.get_client()
+        respuesta = openai_client.get_client().embeddings.create(
+            model="text-embedding-3-small", input="hola", encoding_format="float"
+        )
+    finally:
+        openai_client.configurar_cliente(transport=None, base_url=None)
+
+    assert respuesta.data[0].embedding == [0.1, 0.2]
+    assert str(peticiones[0].url) == "http://stub/v1/embeddings"
+
+
+def test_cliente_sin_api_key(monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    openai_client.configurar_cliente()
+
+    with pytest.raises(ValueError):
+        openai_client.get_client()
+
+
+def crear_embeddings_db(db_path, vectores, agencias=None, categorias=None):
+    conn = rag.sqlite3.connect(db_path)
+    rag.load_sqlite_vec(conn)
+    crear_esquema(conn, vectores.shape[1])
+    agencias = agencias or [""] * len(vectores)
+    categorias = categorias or [""] * len(vectores)
+    insertar_chunks(conn, [
+        ("", agencia, categoria, 0, 0, f"h{i}", f"chunk {i}", vector.astype(np.float32).tobytes())
+        for i, (vector, agencia, categoria) in enumerate(zip(vectores, agencias, categorias))
+    ])
+    conn.commit()
+    return conn
+
+
+def vectores_unitarios(n, dim=64, semilla=0):
+    vectores = np.random.default_rng(semilla).normal(size=(n, dim)).astype(np.float32)
+    return vectores / np.linalg.norm(vectores, axis=1, keepdims=True)
+
+
+def test_retriever_coincide_con_sqlite_vec(tmp_path):
+    db_path = str(tmp_path / "embeddings.db")
+    conn = crear_embeddings_db(db_path, vectores_unitarios(300))
+    consulta = vectores_unitarios(1, semilla=1)[0]
+
+    exactos = conn.execute(
+        "SELECT c.chunk, v.distance FROM (SELECT rowid, distance FROM embeddings WHERE embedding MATCH ? AND k = 10) v"
+        " JOIN chunks c ON c.id = v.rowid ORDER BY v.distance",
+        (consulta.tobytes(),),
+    ).fetchall()
+    conn.close()
+
+    resultados = Retriever(db_path).buscar(consulta.tolist(), k=10)
+
+    assert [chunk for chunk, _ in resultados] == [chunk for chunk, _ in exactos]
+    assert [distancia for _, distancia in resultados] == pytest.approx([d for _, d in exactos], abs=1e-4)
+
+
+def test_retriever_recarga_cuando_cambia_la_db(tmp_path):
+    db_path = str(tmp_path / "embeddings.db")
+    vectores = vectores_unitarios(5)
+    crear_embeddings_db(db_path, vectores).close()
+    retriever = Retriever(db_path)
+
+    assert len(retriever.buscar(vectores[0].tolist(), k=10)) == 5
+    assert retriever.buscar(vectores[0].tolist(), k=10, max_distance=0.01) == [("chunk 0", pytest.approx(0.0, abs=1e-3))]
+
+    crear_embeddings_db(db_path, vectores_unitarios(3, semilla=2)).close()
+
+    assert len(retriever.buscar(vectores[0].tolist(), k=10)) == 8
+
+
+def test_retriever_filtra_por_agencia_y_categoria(tmp_path):
+    db_path = str(tmp_path / "embeddings.db")
+    vectores = vectores_unitarios(300)
+    agencias = [["Cibeles", "B Travel", "Halcon Viajes"][i % 3] for i in range(300)]
+    categorias = [["Islas", "Cruceros"][i % 2] for i in range(300)]
+    crear_embeddings_db(db_path, vectores, agencias, categorias).close()
+    consulta = vectores_unitarios(1, semilla=1)[0]
+    retriever = Retriever(db_path)
+
+    resultados = retriever.buscar(consulta.tolist(), k=10, agencias=["Cibeles"], categorias=["Cruceros"])
+
+    # Coincide con la búsqueda exacta sobre el subconjunto de chunks que cumplen los filtros
+    subconjunto = [i for i in range(300) if agencias[i] == "Cibeles" and categorias[i] == "Cruceros"]
+    distancias = np.linalg.norm(vectores[subconjunto] - consulta, axis=1)
+    esperados = [f"chunk {subconjunto[i]}" for i in np.argsort(distancias)[:10]]
+    assert [chunk for chunk, _ in resultados] == esperados
+    assert retriever.buscar(consulta.tolist(), k=10, agencias=["Cibeles"]) != retriever.buscar(consulta.tolist(), k=10)
+    assert retriever.buscar(consulta.tolist(), k=10, agencias=["Otra"]) == []
+
+
+def vectores_agrupados(n, dim=64, grupos=20, semilla=0):
+    rng = np.random.default_rng(semilla)
+    centros = rng.normal(size=(grupos, dim))
+    vectores = (centros[rng.integers(0, grupos, n)] + 0.3 * rng.normal(size=(n, dim))).astype(np.float32)
+    return vectores / np.linalg.norm(vectores, axis=1, keepdims=True)
+
+
+def test_ivfpq_recorriendo_todas_las_listas_es_exacto():
+    vectores = vectores_agrupados(1000)
+    exacto, ivfpq = IndiceExacto(), IndiceIVFPQ(nlist=16, nprobe=16, pq_m=8, refinar=50)
+    exacto.construir(vectores)
+    ivfpq.construir(vectores)
+
+    for consulta in vectores_agrupados(10, semilla=1):
+        esperados, similitudes = exacto.buscar(consulta, 5)
+        encontrados, aproximadas = ivfpq.buscar(consulta, 5)
+        assert encontrados.tolist() == esperados.tolist()
+        assert aproximadas == pytest.approx(similitudes, abs=1e-5)
+
+
+def test_ivfpq_recall_con_pocas_listas():
+    vectores = vectores_agrupados(2000)
+    exacto, ivfpq = IndiceExacto(), IndiceIVFPQ(nprobe=4, pq_m=8)
+    exacto.construir(vectores)
+    ivfpq.construir(vectores)
+
+    rng = np.random.default_rng(1)
+    consultas = vectores[rng.choice(len(vectores), 50)] + 0.05 * rng.normal(size=(50, 64)).astype(np.float32)
+    aciertos = sum(
+        len(set(exacto.buscar(consulta, 5)[0].tolist()) & set(ivfpq.buscar(consulta, 5)[0].tolist()))
+        for consulta in consultas
+    )
+
+    assert aciertos / (5 * len(consultas)) >= 0.8
+
+
+def test_ivfpq_exige_que_pq_m_divida_la_dimension():
+    with pytest.raises(ValueError):
+        IndiceIVFPQ(pq_m=7).construir(vectores_agrupados(100))
+
+
+def test_configurar_indice(monkeypatch, tmp_path):
+    monkeypatch.setattr(rag, "get_module_dir", lambda: str(tmp_path))
+    monkeypatch.setattr(rag, "retrievers", {})
+    monkeypatch.setattr(rag, "configuracion_indice", {"indice": "exacto"})
+    crear_embeddings_db(str(tmp_path / "embeddings.db"), vectores_agrupados(300)).close()
+
+    rag.configurar_indice("ivfpq", nprobe=2, pq_m=8)
+    retriever = rag.get_retriever()
+
+    assert retriever.tipo == "ivfpq"
+    assert retriever.buscar(vectores_agrupados(1, semilla=1)[0].tolist(), k=3)
+    with pytest.raises(ValueError):
+        rag.configurar_indice("hnsw")
+
+
+def test_get_embeddings_queries_en_una_peticion(fake_openai):
+    rag.get_embeddings_query("consulta en caché")
+    fake_openai.peticiones.clear()
+
+    embeddings = rag.get_embeddings_queries(["uno", "consulta en caché", "dos", "uno"])
+
+    assert fake_openai.peticiones == [["uno", "dos"]]
+    assert embeddings[0] == embeddings[3] == pytest.approx(fake_embedding("uno"))
+    assert embeddings[1] == pytest.approx(fake_embedding("consulta en caché"))
+
+
+def test_buscar_chunks_con_id_en_lote_deduplica_por_id(fake_openai, monkeypatch):
+    monkeypatch.setattr(rag, "retrievers", {})
+    rag.populate_embeddings(["Roma en verano", "Playas de Mallorca", "Roma en verano", "Safari en Kenia"])
+    fake_openai.peticiones.clear()
+
+    resultados = rag.combinar_chunks(rag.buscar_chunks_con_id(
+        ["Roma en verano", "Playas de Mallorca", "Roma en verano"], max_chunks=2, max_distance=0.01
+    ))
+
+    # Los embeddings de las consultas ya están en la caché y los dos chunks "Roma en verano" son filas distintas
+    assert fake_openai.peticiones == []
+    assert sorted(chunk for chunk, _ in resultados) == ["Playas de Mallorca", "Roma en verano", "Roma en verano"]
+
+
+def test_fusion_rrf_premia_los_ids_de_ambas_listas():
+    assert rag.fusion_rrf([[1, 2, 3], [4, 3, 5]]) == [3, 1, 4, 2, 5]
+
+
+def test_parece_nombre_solo_con_nombres_propios_y_codigos():
+    assert rag.parece_nombre("Ribeira Sacra")
+    assert rag.parece_nombre("Picos de Europa")
+    assert rag.parece_nombre("GR 11")
+    assert not rag.parece_nombre("rutas por Galicia")
+    assert not rag.parece_nombre("de Europa")
+    assert not rag.parece_nombre("Viajes A Roma En Verano Baratos")
+
+
+def test_buscar_chunks_hibrido_encuentra_nombres_exactos(fake_openai, monkeypatch):
+    monkeypatch.setattr(rag, "retrievers", {})
+    rag.indexar_archivos({
+        "rc25_cibeles_v2.md": "Ruta por la Ribeira Sacra y el cañón del Sil.\n",
+        "rc25_veci_ok.md": "Mallorca A: Palma, Sóller y Valldemossa.\n",
+        "b.md": "Kenia " * 30,
+    })
+
+    # Un nombre exacto va primero, sin tildes ni mayúsculas, y el resto sale de la fusión
+    resultados = rag.buscar_chunks_hibrido("Ribeira Sacra", max_chunks=3)
+    assert resultados[0][0].endswith("Ribeira Sacra y el cañón del Sil.")
+    assert len(resultados) == 3
+    assert "Sóller" in rag.buscar_chunks_hibrido("Soller")[0][0]
+    # Con filtros, las coincidencias exactas solo miran los chunks permitidos
+    assert all("Sóller" not in chunk for chunk, _ in rag.buscar_chunks_hibrido("Soller", agencias=["Cibeles"]))
+
+    # Las distancias son las reales, también las de las coincidencias exactas
+    retriever = rag.get_retriever()
+    ids = {chunk: id_chunk for id_chunk, chunk, _ in retriever.buscar_lexico("Ribeira Sacra Palma Soller Kenia", k=3)}
+    distancias = retriever.distancias(rag.get_embeddings_query("Ribeira Sacra"), ids.values())
+    assert resultados == [(chunk, pytest.approx(distancias[ids[chunk]])) for chunk, _ in resultados]
+    assert all(distancia > 0 for _, distancia in resultados)
+
+    # Una pregunta combina la búsqueda vectorial y la léxica
+    resultados = rag.buscar_chunks_hibrido("¿Qué incluye el viaje a Valldemossa desde Madrid?", max_chunks=3)
+    assert "Valldemossa" in resultados[0][0]
+    assert len(resultados) == 3 and all(distancia >= 0 for _, distancia in resultados)
+
+
+def test_buscar_chunks_hibrido_no_adelanta_frases_que_no_son_nombres(fake_openai, monkeypatch):
+    monkeypatch.setattr(rag, "retrievers", {})
+    rag.populate_embeddings(["Rutas por Galicia y Asturias", "Playas de Mallorca"])
+    buscar_lexico = rag.get_retriever().buscar_lexico
+    frases = []
+
+    def buscar(consulta, *args, frase=False, **kwargs):
+        frases.append(frase)
+        return buscar_lexico(consulta, *args, frase=frase, **kwargs)
+
+    monkeypatch.setattr(rag.get_retriever(), "buscar_lexico", buscar)
+
+    # Una consulta descriptiva pasa por la fusión y sus distancias son las reales
+    resultados = rag.buscar_chunks_hibrido("rutas por Galicia", max_chunks=3)
+    assert frases == [False]
+    assert resultados[0][0] == "Rutas por Galicia y Asturias"
+    assert all(distancia > 0 for _, distancia in resultados)
+
+
+def test_indice_fts_sigue_a_la_tabla_chunks(fake_openai, monkeypatch, tmp_path):
+    monkeypatch.setattr(rag, "retrievers", {})
+    rag.indexar_archivos({"a.md": "Ruta por la Ribeira Sacra.\n"})
+    assert rag.get_retriever().buscar_lexico("ribeira")
+
+    rag.indexar_archivos({"a.md": "Ruta por los fiordos.\n"})
+    assert not rag.get_retriever().buscar_lexico("ribeira")
+    assert rag.get_retriever().buscar_lexico("fiordos")
+
+
+def test_reordenador_lexico_prioriza_los_terminos_de_la_consulta():
+    resultados = [
+        ("Safari por Kenia y Tanzania.", 0.1),
+        ("Circuito por Europa central: Viena y Praga.", 0.2),
+        ("Senderismo por los Picos de Europa: Covadonga y Cangas de Onís.", 0.3),
+        ("Playas de Menorca.", 0.4),
+    ]
+
+    reordenados = ReordenadorLexico().reordenar("rutas por los picos de europa", resultados, 2)
+
+    # Gana el que tiene el nombre completo, conservando su distancia original
+    assert reordenados[0] == resultados[2]
+    assert reordenados[1] == resultados[1]
+    # Sin términos útiles en la consulta se respeta el orden original
+    assert ReordenadorLexico().reordenar("¿y eso?", resultados, 3) == resultados[:3]
+
+
+def test_reordenado_pide_mas_candidatos_y_se_queda_con_los_mejores(fake_openai, monkeypatch):
+    monkeypatch.setattr(rag, "retrievers", {})
+    monkeypatch.setattr(rag, "configuracion_busqueda", {"busqueda": "vectorial"})
+    monkeypatch.setattr(rag, "configuracion_reordenado", {"reordenador": None, "candidatos": 50})
+    files = {f"k{i}.md": f"Safari número {i} por Kenia y Tanzania.\n" for i in range(20)}
+    files["t.md"] = "Ruta por la Toscana: Florencia, Siena y San Gimignano.\n"
+    rag.indexar_archivos(files)
+    preguntas = [("¿Qué se visita en la Toscana?", "Toscana")]
+
+    assert rag.candidatos_busqueda(1) == 1
+    rag.configurar_reordenado("lexico", candidatos=30)
+    assert rag.candidatos_busqueda(1) == 30
+    assert benchmark_reordenado.evaluar(preguntas, max_chunks=1, max_distance=2.0)["aciertos"] == 1
+    with pytest.raises(ValueError):
+        rag.configurar_reordenado("cross-encoder")
+
+
+def test_construir_contexto_funde_chunks_contiguos_y_solapados(fake_openai, monkeypatch, tmp_path):
+    monkeypatch.setattr(rag, "retrievers", {})
+    texto = "".join(f"Día {i}. Visita a la ciudad número {i}.\n" for i in range(1, 13))
+    rag.indexar_archivos({"rc25_cibeles_v2.md": texto}, max_tokens=40)
+    conn = sqlite3.connect(str(tmp_path / "embeddings.db"))
+    rag.load_sqlite_vec(conn)
+    chunks = [chunk for chunk, in conn.execute("SELECT chunk FROM chunks ORDER BY inicio")]
+    # Un chunk antiguo, solapado con los demás, y otro de una agencia distinta
+    solapado = rag.prefijo_agencia + "Cibeles\n" + texto[30:120]
+    insertar_chunks(conn, [
+        ("rc25_cibeles_v2.md", "Cibeles", "", 30, 90, rag.get_text_hash(solapado), solapado, np.zeros(1536, np.float32).tobytes()),
+    ])
+    conn.commit()
+    conn.close()
+    otro = rag.prefijo_agencia + "Halcon Viajes\nCrucero por los fiordos."
+    assert len(chunks) > 2
+
+    resultados = [(chunks[1], 0.1), (otro, 0.2), (solapado, 0.3), (chunks[0], 0.4)]
+    contexto = rag.construir_contexto(resultados, max_chunks=4, max_tokens=1000)
+
+    # La agencia aparece una vez por grupo y el texto común de los chunks no se repite
+    assert contexto.count("Catálogo de la agencia: Cibeles") == 1
+    assert contexto.count("Catálogo de la agencia: Halcon Viajes") == 1
+    assert rag.prefijo_agencia not in contexto
+    fundido = contexto.split("\n", 1)[1].split("\n\n---\n\n")[0]
+    assert texto.replace("\n", "").startswith(fundido.replace("\n", ""))
+    assert fundido.count("Día 1.") == fundido.count("Día 2.") == 1
+    assert contexto.index("Cibeles") < contexto.index("Halcon Viajes")
+
+
+def test_construir_contexto_respeta_el_presupuesto_de_tokens(fake_openai, monkeypatch):
+    monkeypatch.setattr(rag, "retrievers", {})
+    resultados = [(f"Fragmento {i}: " + "ruta por Italia " * 20, 0.1 * i) for i in range(5)]
+
+    contexto = rag.construir_contexto(resultados, max_chunks=5, max_tokens=150)
+
+    assert rag.contar_tokens(contexto) <= 150
+    assert "Fragmento 0" in contexto and "Fragmento 4" not in contexto
+    # Si no cabe ni el chunk más relevante, se recorta
+    recortado = rag.construir_contexto(resultados, max_chunks=5, max_tokens=20)
+    assert recortado.startswith("Fragmento 0") and rag.contar_tokens(recortado) <= 20
+
+
+def test_construir_contexto_recalcula_la_posicion_del_chunk_recortado(fake_openai, monkeypatch):
+    monkeypatch.setattr(rag, "retrievers", {})
+    texto = "".join(f"Día {i}. Visita a la ciudad número {i}.\n" for i in range(1, 13))
+    rag.indexar_archivos({"rc25_cibeles_v2.md": texto}, max_tokens=200)
+    chunk = rag.chunker(texto, "rc25_cibeles_v2.md", 200)[0]
+    agrupaciones = []
+    agrupar_contexto = rag.agrupar_contexto
+    monkeypatch.setattr(rag, "agrupar_contexto", lambda piezas: agrupaciones.append(piezas) or agrupar_contexto(piezas))
+
+    contexto = rag.construir_contexto([(chunk, 0.1)], max_tokens=30)
+
+    # La pieza recortada solo dice ocupar el texto que conserva, así que no absorbe fragmentos posteriores
+    _, archivo, inicio, fin, recortado = agrupaciones[-1][0]
+    assert recortado in contexto and len(recortado) < len(rag.separar_agencia(chunk)[1])
+    assert texto[inicio:fin] == recortado
+
+
+def test_cache_respuestas_exige_similitud_y_los_mismos_chunks():
+    cache = rag.CacheRespuestas(umbral=0.9, maxsize=2, ttl=60)
+    consulta = np.ones(8)
+    parecida = np.ones(8)
+    parecida[0] = 0.8
+    distinta = np.eye(8)[0]
+    cache.put(consulta, "consulta", frozenset({"a", "b"}), "indice", "respuesta")
+
+    assert cache.get(parecida, "parecida", frozenset({"a", "b"}), "indice") == "respuesta"
+    assert cache.get(parecida, "parecida", frozenset({"a"}), "indice") is None
+    assert cache.get(distinta, "distinta", frozenset({"a", "b"}), "indice") is None
+    # Sin embedding solo se reutiliza la respuesta del mismo texto
+    assert cache.get(None, "parecida", frozenset({"a", "b"}), "indice") is None
+    assert cache.get(None, "consulta", frozenset({"a", "b"}), "indice") == "respuesta"
+
+    # Se expulsa la entrada menos usada
+    cache.put(distinta, "distinta", frozenset({"c"}), "indice", "otra")
+    cache.get(consulta, "consulta", frozenset({"a", "b"}), "indice")
+    cache.put(None, "tercera", frozenset({"d"}), "indice", "tercera")
+    assert cache.get(distinta, "distinta", frozenset({"c"}), "indice") is None
+    assert cache.get(consulta, "consulta", frozenset({"a", "b"}), "indice") == "respuesta"
+    assert cache.get(distinta, "tercera", frozenset({"d"}), "indice") == "tercera"
+
+    # Un índice nuevo invalida todas las respuestas
+    assert cache.get(consulta, "consulta", frozenset({"a", "b"}), "nuevo") is None
+    assert len(cache) == 0
+
+    caduca = rag.CacheRespuestas(umbral=0.9, ttl=0.01)
+    caduca.put(consulta, "consulta", frozenset(), "indice", "respuesta")
+    time.sleep(0.05)
+    assert caduca.get(consulta, "consulta", frozenset(), "indice") is None
+
+
+def test_cache_respuestas_no_pide_un_segundo_embedding(fake_openai, monkeypatch):
+    monkeypatch.setattr(rag, "retrievers", {})
+    monkeypatch.setattr(rag, "configuracion_busqueda", {"busqueda": "hibrida"})
+    rag.populate_embeddings(["Crucero por los Fiordos Noruegos", "Safari en Kenia"])
+    fake_openai.peticiones.clear()
+
+    assert rag.realizar_consulta("Fiordos Noruegos", max_chunks=1) == "respuesta final"
+    assert rag.realizar_consulta("Fiordos Noruegos", max_chunks=1) == "respuesta final"
+
+    # Solo la búsqueda pide el embedding de la consulta; la clave de la caché lo reutiliza
+    assert fake_openai.peticiones == [["Fiordos Noruegos"]]
+    assert rag.cache_respuestas.estadisticas()["hits"] == 1
+
+
+def test_realizar_consulta_reutiliza_la_respuesta_hasta_reindexar(fake_openai, monkeypatch):
+    monkeypatch.setattr(rag, "retrievers", {})
+    rag.populate_embeddings(["Roma en verano", "Playas de Mallorca"])
+    prompts = []
+    obtener_respuesta_openai = rag.obtener_respuesta_openai
+    monkeypatch.setattr(rag, "obtener_respuesta_openai", lambda prompt: prompts.append(prompt) or obtener_respuesta_openai(prompt))
+
+    assert rag.realizar_consulta("Viajes a Roma", max_chunks=1, max_distance=2) == "respuesta final"
+    assert rag.realizar_consulta("Viajes a Roma", max_chunks=1, max_distance=2) == "respuesta final"
+    assert len(prompts) == 1
+    assert rag.cache_respuestas.estadisticas()["hits"] == 1
+
+    # Con otros chunks no se reutiliza la respuesta
+    rag.realizar_consulta("Viajes a Roma", max_chunks=2, max_distance=2)
+    assert len(prompts) == 2
+
+    # Al cambiar el índice se vuelve a preguntar al modelo
+    rag.populate_embeddings(["Safari en Kenia"])
+    rag.realizar_consulta("Viajes a Roma", max_chunks=1, max_distance=2)
+    assert len(prompts) == 3
+
+
+def test_realizar_consulta_mejorada_busca_mientras_genera(fake_openai, monkeypatch):
+    monkeypatch.setattr(rag, "retrievers", {})
+    rag.populate_embeddings(["Roma en verano", "Playas de Mallorca", "Safari en Kenia"])
+    fake_openai.eventos.clear()
+    fake_openai.respuestas_hipoteticas = ["Roma en verano", "Safari en Kenia"]
+    buscar_chunks_con_id = rag.buscar_chunks_con_id
+    prompts = []
+
+    def buscar(queries, *args):
+        fake_openai.eventos.append(("busqueda", queries))
+        return buscar_chunks_con_id(queries, *args)
+
+    monkeypatch.setattr(rag, "buscar_chunks_con_id", buscar)
+    monkeypatch.setattr(rag, "crear_prompt", lambda query, chunks, max_chunks: prompts.append(chunks) or query)
+
+    respuesta = rag.realizar_consulta_mejorada("Viajes a Roma", max_chunks=5, max_distance=0.01)
+
+    # La consulta original se busca antes de que termine la generación y las respuestas, juntas
+    busquedas = [evento for evento in fake_openai.eventos if evento[0] == "busqueda"]
+    assert respuesta == "respuesta final"
+    assert fake_openai.eventos.index(("busqueda", ["Viajes a Roma"])) < fake_openai.eventos.index(("fin_generacion", None))
+    assert busquedas == [("busqueda", ["Viajes a Roma"]), ("busqueda", ["Roma en verano", "Safari en Kenia"])]
+    assert sorted(chunk for chunk, _ in prompts[0]) == ["Roma en verano", "Safari en Kenia"]
+
+
+def test_buscar_chunks_mejorada_espera_la_busqueda_original_si_falla_la_generacion(monkeypatch):
+    terminadas = []
+
+    def buscar(queries, *args):
+        time.sleep(0.1)
+        terminadas.append(queries)
+        return [[]]
+
+    def generar(query, num_respuestas, *args):
+        raise RuntimeError("sin conexión")
+
+    monkeypatch.setattr(rag, "buscar_chunks_con_id", buscar)
+    monkeypatch.setattr(rag, "generar_respuestas_hipoteticas", generar)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(rag.buscar_chunks_mejorada_async("Viajes a Roma"))
+    assert terminadas == [["Viajes a Roma"]]
+
+
+def test_realizar_consulta_stream_devuelve_los_fragmentos(fake_openai, monkeypatch):
+    monkeypatch.setattr(rag, "retrievers", {})
+    rag.populate_embeddings(["Roma en verano"])
+    fake_openai.tokens = ["Hay ", "un viaje ", "a Roma."]
+
+    assert list(rag.realizar_consulta_stream("Viajes a Roma")) == ["Hay ", "un viaje ", "a Roma."]
+
+
+def test_run_agent_stream_respuesta_directa(fake_openai):
+    fake_openai.tokens = ["Hola, ", "¿en qué ", "puedo ayudarte?"]
+
+    assert list(agent.run_agent_stream("Hola")) == ["Hola, ", "¿en qué ", "puedo ayudarte?"]
+
+
+def streams_falsos(monkeypatch, *respuestas):
+    """
+    Sustituye llm_stream por un fake que devuelve, en cada llamada, los fragmentos de la siguiente respuesta.
+    """
+    pendientes = list(respuestas)
+    historiales = []
+
+    def llm_stream(history, debug=False):
+        historiales.append(list(history))
+        yield from pendientes.pop(0)
+
+    monkeypatch.setattr(agent, "llm_stream", llm_stream)
+    return historiales
+
+
+def test_run_agent_stream_muestra_en_streaming_la_respuesta_de_viajes(monkeypatch):
+    historiales = streams_falsos(
+        monkeypatch,
+        ["Voy a buscar. ", "`", "``python\nRAG_VIAJES(\"Roma\")\n```"],
+        ["Hay un ", "viaje a Roma."],
+    )
+    monkeypatch.setattr(agent, "ejecutar_consulta_viajes", lambda consulta, filtros, debug=False: "Roma, 5 días")
+    monkeypatch.setattr(agent, "validar_respuesta", lambda *args, **kwargs: True)
+
+    fragmentos = list(agent.run_agent_stream("Viajes a Roma"))
+
+    # Solo se muestra el texto anterior al bloque y la respuesta final llega por fragmentos
+    assert fragmentos == ["Voy a buscar. ", "\n\n", "Hay un ", "viaje a Roma."]
+    assert historiales[1][-2]["content"] == "Voy a buscar. ```python\nRAG_VIAJES(\"Roma\")\n```"
+    assert historiales[1][-1]["content"].endswith("# resultado: Roma, 5 días\n```")
+
+
+def test_run_agent_stream_muestra_la_respuesta_mejorada_tras_el_separador(monkeypatch):
+    historiales = streams_falsos(
+        monkeypatch,
+        ["```python\nRAG_VIAJES(\"Roma\")\n```"],
+        ["No tengo ", "información."],
+        ["Hay un viaje ", "a Roma."],
+    )
+    monkeypatch.setattr(agent, "ejecutar_consulta_viajes", lambda consulta, filtros, debug=False: "nada")
+    monkeypatch.setattr(agent, "ejecutar_consulta_mejorada_viajes", lambda consulta, filtros, debug=False: "Roma, 5 días")
+    monkeypatch.setattr(agent, "validar_respuesta", lambda prompt, response, debug=False: response != "No tengo información.")
+
+    fragmentos = list(agent.run_agent_stream("Viajes a Roma"))
+
+    assert fragmentos == ["No tengo ", "información.", agent.SEPARADOR_MEJORA, "Hay un viaje ", "a Roma."]
+    # La respuesta mejorada se genera sin la respuesta rechazada en el historial
+    assert [m["content"] for m in historiales[2]][-1].endswith("# resultado: Roma, 5 días\n```")
+    assert "No tengo información." not in [m["content"] for m in historiales[2]]
+
+
+def test_process_agent_pasa_los_filtros_de_rag_viajes(fake_openai, monkeypatch):
+    llamada = '```python\nRAG_VIAJES("cruceros por el Mediterráneo", agencia="Halcón, Cibeles", categoria="Cruceros")\n```'
+    consultas = []
+    monkeypatch.setattr(agent, "ejecutar_consulta_viajes", lambda consulta, filtros, debug=False: consultas.append((consulta, filtros)) or "resultado")
+    monkeypatch.setattr(agent, "validar_respuesta", lambda *args, **kwargs: True)
+    history = [{"role": "user", "content": "Cruceros de Halcón o Cibeles"}]
+
+    agent.process_agent(history, "Cruceros de Halcón o Cibeles", response=llamada)
+
+    assert consultas == [("cruceros por el Mediterráneo", {"agencias": ["Halcón", "Cibeles"], "categorias": ["Cruceros"]})]
+    assert 'agencia="Halcón, Cibeles", categoria="Cruceros") # resultado: resultado' in history[-2]["content"]